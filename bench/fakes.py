@@ -0,0 +1,172 @@
+"""Поддельные серверы, каналы и голосовое подключение: команды бота работают с ними как с настоящими.
+
+FakeVoiceClient вместо отправки в Discord читает кадры из источника в своем потоке, как это делает
+discord.player.AudioPlayer, и записывает, когда начался и закончился каждый трек.
+"""
+import asyncio
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+
+FRAME_SECONDS = 0.02
+
+ids = itertools.count(1000)
+
+
+class FakeMessage:
+    def __init__(self, channel, embed=None, view=None):
+        self.id = next(ids)
+        self.channel = channel
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, **fields):
+        self.channel.edits += 1
+        self.embed = fields.get('embed', self.embed)
+
+    async def delete(self):
+        pass
+
+
+class FakeTextChannel:
+    def __init__(self, guild):
+        self.id = next(ids)
+        self.guild = guild
+        self.sent = 0
+        self.edits = 0
+
+    async def send(self, content=None, *, embed=None, view=None, delete_after=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, embed, view)
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, speed):
+        self.id = next(ids)
+        self.guild = guild
+        self.speed = speed
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoiceClient(self, self.speed)
+        return self.guild.voice_client
+
+
+class FakeVoiceClient:
+    """Голосовое подключение без сети. speed > 1 — читает кадры быстрее реального времени."""
+    def __init__(self, channel, speed=1.0):
+        self.channel = channel
+        self.guild = channel.guild
+        self.speed = speed
+        self.source = None
+        self.player = None
+        self.stopping = None
+        self.paused = threading.Event()
+        self.connected = True
+        # (время первого кадра, время конца) по каждому треку, в порядке проигрывания
+        self.tracks = []
+        self.started = threading.Condition()
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.player is not None and not self.paused.is_set()
+
+    def is_paused(self):
+        return self.player is not None and self.paused.is_set()
+
+    def pause(self):
+        self.paused.set()
+
+    def resume(self):
+        self.paused.clear()
+
+    def play(self, source, *, after=None):
+        if self.player is not None:
+            raise RuntimeError("Already playing audio.")
+        self.source = source
+        self.paused.clear()
+        self.stopping = threading.Event()
+        self.player = threading.Thread(target=self.run, args=(source, after, self.stopping), daemon=True)
+        self.player.start()
+
+    def stop(self):
+        if self.player is not None:
+            self.stopping.set()
+            self.player = None
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+    def run(self, source, after, stopping):
+        record = [None, None]
+        frame_time = FRAME_SECONDS / self.speed
+        next_at = time.perf_counter()
+        error = None
+        try:
+            while not stopping.is_set():
+                if self.paused.is_set():
+                    time.sleep(frame_time)
+                    next_at = time.perf_counter()
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                if record[0] is None:
+                    record[0] = time.perf_counter()
+                    with self.started:
+                        self.tracks.append(record)
+                        self.started.notify_all()
+                next_at += frame_time
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+            record[1] = time.perf_counter()
+            if self.player is threading.current_thread():
+                self.player = None
+            if after is not None:
+                after(error)
+
+    async def wait_tracks(self, count, timeout):
+        """Ждет, пока начнут играть count треков. Возвращает, сколько успело."""
+        deadline = time.monotonic() + timeout
+        while len(self.tracks) < count and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return len(self.tracks)
+
+
+class FakeGuild:
+    def __init__(self, speed=1.0):
+        self.id = next(ids) << 22 # как у настоящих snowflake, чтобы работала формула шардов
+        self.name = f"bench-{self.id}"
+        self.voice_client = None
+        self.text_channel = FakeTextChannel(self)
+        self.voice_channel = FakeVoiceChannel(self, speed)
+        self.member = SimpleNamespace(id=next(ids), name="bench-user", mention="@bench-user",
+                                      voice=SimpleNamespace(channel=self.voice_channel))
+
+
+class FakeContext:
+    """Минимум commands.Context, которым пользуются команды бота."""
+    def __init__(self, guild, command):
+        self.guild = guild
+        self.channel = guild.text_channel
+        self.author = guild.member
+        self.message = SimpleNamespace(id=next(ids), author=guild.member, channel=guild.text_channel)
+        self.command = SimpleNamespace(name=command)
+        # То же, что ставит хук before_invoke в bot.py
+        self.invoked_at = time.perf_counter()
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
@@ -0,0 +1,353 @@
+"""Офлайн-бенчмарк бота: настоящие команды и play_next, но без Discord и без сети.
+
+    python bench/run.py                               # все сценарии
+    python bench/run.py transitions seek              # только выбранные
+    python bench/run.py --latency 0.5 --fail-rate 0.05 --guilds 300 --json before.json
+
+Нужны ffmpeg в PATH и зависимости бота (discord.py, python-dotenv). yt_dlp подменяется заглушкой
+из bench/stubs, голосовое подключение — FakeVoiceClient из bench/fakes.py, звук — тоны, которые
+генерирует ffmpeg во временной папке. Настройки бота (PREFETCH_COUNT, FFMPEG_MAX_PROCESSES и т.д.)
+берутся из окружения как обычно, так что можно сравнивать разные конфигурации.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+STUBS = os.path.join(BENCH_DIR, 'stubs')
+
+SCENARIOS = ('commands', 'transitions', 'seek', 'memory', 'lag')
+# Сколько !skip отправляет разом сценарий transitions
+SKIP_BURST = 10
+
+# Сюда сценарии складывают результаты: имя -> {метрика: значение}
+results = {}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк музыкального бота")
+    parser.add_argument('scenarios', nargs='*', help=f"какие сценарии запускать: {', '.join(SCENARIOS)} (по умолчанию все)")
+    parser.add_argument('--latency', type=float, default=0.2, help="средняя задержка extract_info, с")
+    parser.add_argument('--jitter', type=float, default=0.5, help="разброс задержки, доля от средней")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="доля падающих extract_info")
+    parser.add_argument('--track-seconds', type=float, default=3, help="длина коротких треков")
+    parser.add_argument('--speed', type=float, default=10, help="во сколько раз быстрее реального времени играть треки")
+    parser.add_argument('--rounds', type=int, default=20, help="повторов в сценариях commands, transitions и seek")
+    parser.add_argument('--queue-size', type=int, default=100_000, help="треков в сценарии memory")
+    parser.add_argument('--guilds', type=int, default=200, help="серверов в сценарии lag")
+    parser.add_argument('--duration', type=float, default=30, help="длительность сценария lag, с")
+    parser.add_argument('--json', help="сохранить результаты в файл (для сравнения до/после)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    # Временная папка становится текущей, поэтому путь к отчету запоминаем заранее
+    args.json = os.path.abspath(args.json) if args.json else None
+    return args
+
+
+def prepare_environment(args, workdir):
+    """Все, что бот читает из окружения при импорте, — до import bot."""
+    audio_dir = os.path.join(workdir, 'audio')
+    os.makedirs(audio_dir)
+    generate_audio(audio_dir, args.track_seconds)
+
+    os.environ.update({
+        'BENCH_AUDIO_DIR': audio_dir,
+        'BENCH_EXTRACT_LATENCY': str(args.latency),
+        'BENCH_EXTRACT_JITTER': str(args.jitter),
+        'BENCH_FAIL_RATE': str(args.fail_rate),
+        'BENCH_TRACK_SECONDS': str(args.track_seconds),
+        # Один процесс, без HTTP-сервера метрик и без потока событий в консоль
+        'SHARD_COUNT': '0',
+        'METRICS_PORT': '0',
+        'EVENT_LOG': '',
+        'RESTORE_ON_STARTUP': '0',
+        'DATABASE_FILE': os.path.join(workdir, 'bench.sqlite3'),
+        'SEARCH_CACHE_FILE': '',
+    })
+    # Кэш аудио на диске сравнивали бы сами с собой — по умолчанию выключен, но можно включить
+    os.environ.setdefault('AUDIO_CACHE_MB', '0')
+    os.environ.setdefault('FFMPEG_MAX_PROCESSES', str(max(24, args.guilds + 8)))
+    os.environ.setdefault('FFMPEG_CPU_BUDGET', '100000')
+    os.environ.setdefault('PLAYLIST_MAX_TRACKS', str(max(args.queue_size, 5000)))
+
+    # Заглушка yt_dlp должна найтись раньше настоящего — и у нас, и в процессах пула извлечения
+    sys.path[:0] = [STUBS, ROOT]
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [STUBS, ROOT, os.getenv('PYTHONPATH')]))
+    # Относительные пути бота (settings.json, audio_cache/ и т.п.) — во временную папку
+    os.chdir(workdir)
+
+
+def generate_audio(folder, track_seconds):
+    """Короткий тон в Opus (путь без перекодирования) и длинный в WAV (путь через PCM)."""
+    def ffmpeg(*args):
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', *args], check=True)
+
+    try:
+        ffmpeg('-f', 'lavfi', '-i', f'sine=frequency=440:duration={track_seconds}',
+               '-c:a', 'libopus', '-b:a', '96k', os.path.join(folder, 'short.opus'))
+    except subprocess.CalledProcessError:
+        # ffmpeg без libopus — тогда короткие тоже через PCM
+        ffmpeg('-f', 'lavfi', '-i', f'sine=frequency=440:duration={track_seconds}', os.path.join(folder, 'short.wav'))
+    ffmpeg('-f', 'lavfi', '-i', 'sine=frequency=220:duration=60', '-ar', '48000', '-ac', '2',
+           os.path.join(folder, 'long.wav'))
+
+
+def summarize(values, scale=1000):
+    """p50 / p95 / max в миллисекундах."""
+    if not values:
+        return {'n': 0}
+    ordered = sorted(values)
+    return {
+        'n': len(ordered),
+        'p50': round(statistics.median(ordered) * scale, 1),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * scale, 1),
+        'max': round(ordered[-1] * scale, 1),
+    }
+
+
+def report(scenario, name, values, unit='мс'):
+    stats = summarize(values)
+    results.setdefault(scenario, {})[name] = stats
+    if not stats['n']:
+        print(f"  {name}: нет данных")
+        return
+    print(f"  {name}: p50 {stats['p50']} {unit} · p95 {stats['p95']} {unit} · max {stats['max']} {unit} (n={stats['n']})")
+
+
+def report_value(scenario, name, value, unit=''):
+    results.setdefault(scenario, {})[name] = value
+    print(f"  {name}: {value} {unit}".rstrip())
+
+
+def gaps(voice):
+    """Тишина между концом трека и первым кадром следующего."""
+    return [nxt[0] - cur[1] for cur, nxt in zip(voice.tracks, voice.tracks[1:]) if cur[1] is not None and nxt[0] >= cur[1]]
+
+
+async def scenario_commands(bot, fakes, args):
+    """!play на пустом сервере (до возврата и до первого звука), !play в занятую очередь, !playlist."""
+    handler, first_audio, enqueue, playlist = [], [], [], []
+    for i in range(args.rounds):
+        guild = fakes.FakeGuild(args.speed)
+        ctx = fakes.FakeContext(guild, 'play')
+        await bot.play(ctx, query=f"bench song {i}")
+        handler.append(time.perf_counter() - ctx.invoked_at)
+        voice = guild.voice_client
+        if voice and await voice.wait_tracks(1, 30):
+            first_audio.append(voice.tracks[0][0] - ctx.invoked_at)
+
+        ctx = fakes.FakeContext(guild, 'play')
+        await bot.play(ctx, query=f"https://bench.local/track/{i + 500}")
+        enqueue.append(time.perf_counter() - ctx.invoked_at)
+
+        ctx = fakes.FakeContext(guild, 'playlist')
+        await bot.playlist(ctx, query=f"https://bench.local/sets/cmd{i}?size=200")
+        playlist.append(time.perf_counter() - ctx.invoked_at)
+
+        await bot.stop(fakes.FakeContext(guild, 'stop'))
+
+    report('commands', "!play на пустом сервере → ответ", handler)
+    report('commands', "!play на пустом сервере → первый звук", first_audio)
+    report('commands', "!play в занятую очередь → ответ", enqueue)
+    report('commands', "!playlist на 200 треков → ответ", playlist)
+
+
+async def scenario_transitions(bot, fakes, args):
+    """Очередь коротких треков без повтора: сколько тишины между ними."""
+    guild = fakes.FakeGuild(args.speed)
+    ctx = fakes.FakeContext(guild, 'playlist')
+    bot.get_state(guild.id).loop = False
+    await bot.playlist(ctx, query=f"https://bench.local/sets/transitions?size={args.rounds + 1}")
+    voice = guild.voice_client
+    track_wall = args.track_seconds / args.speed
+    await voice.wait_tracks(args.rounds + 1, (track_wall + args.latency * 4 + 2) * (args.rounds + 1))
+    # Последний трек должен доиграть, чтобы его конец попал в замер
+    await asyncio.sleep(track_wall + 0.5)
+    report('transitions', "тишина между треками", gaps(voice))
+
+    # То же самое, но с !skip посреди трека (остановка FFmpeg + запуск следующего)
+    await bot.stop(fakes.FakeContext(guild, 'stop'))
+    guild = fakes.FakeGuild(args.speed)
+    bot.get_state(guild.id).loop = False
+    await bot.playlist(fakes.FakeContext(guild, 'playlist'), query=f"https://bench.local/sets/skips?size={args.rounds + 1}")
+    voice = guild.voice_client
+    await voice.wait_tracks(1, 30)
+    for i in range(args.rounds):
+        await asyncio.sleep(track_wall / 3)
+        await bot.next_track(fakes.FakeContext(guild, 'next'))
+        await voice.wait_tracks(i + 2, 30)
+    report('transitions', "тишина после !skip", gaps(voice))
+    await bot.stop(fakes.FakeContext(guild, 'stop'))
+
+    # Пачка !skip разом: актор сервера должен сложить их в одно-два переключения, а не запускать FFmpeg на каждый
+    guild = fakes.FakeGuild(args.speed)
+    bot.get_state(guild.id).loop = False
+    await bot.playlist(fakes.FakeContext(guild, 'playlist'), query=f"https://bench.local/sets/burst?size={SKIP_BURST * 2}")
+    voice = guild.voice_client
+    await voice.wait_tracks(1, 30)
+    spawned = bot.ffmpeg_manager.spawned
+    await asyncio.gather(*(bot.next_track(fakes.FakeContext(guild, 'next')) for _ in range(SKIP_BURST)))
+    await voice.wait_tracks(2, 30)
+    await asyncio.sleep(args.latency * 4 + 0.5)
+    report_value('transitions', f"запусков FFmpeg на {SKIP_BURST} !skip разом", bot.ffmpeg_manager.spawned - spawned)
+    # Пропуски должны сложиться: после SKIP_BURST !skip играет трек номер SKIP_BURST, а не следующий за первым
+    current = bot.get_state(guild.id).current
+    expected = f"https://bench.local/track/{SKIP_BURST}"
+    report_value('transitions', f"трек после {SKIP_BURST} !skip разом",
+                 'верный' if current and current.url == expected else f"НЕВЕРНЫЙ: {current and current.url}, ждали {expected}")
+    await bot.stop(fakes.FakeContext(guild, 'stop'))
+
+
+async def scenario_seek(bot, fakes, args):
+    """Перемотка вперед (перезапуск FFmpeg) и назад в пределах буфера."""
+    guild = fakes.FakeGuild(1.0) # перемотка считает позицию по кадрам — играем в реальном времени
+    await bot.play(fakes.FakeContext(guild, 'play'), query="https://bench.local/long/1")
+    voice = guild.voice_client
+    await voice.wait_tracks(1, 30)
+    await asyncio.sleep(1)
+
+    before = len(bot.seek_stats.latencies)
+    forward = []
+    for _ in range(args.rounds):
+        ctx = fakes.FakeContext(guild, 'forward')
+        await bot.forward(ctx, 1)
+        started = len(voice.tracks)
+        await voice.wait_tracks(started + 1, 10)
+        await asyncio.sleep(0.3)
+        await bot.backwards(fakes.FakeContext(guild, 'backwards'), 1)
+        await asyncio.sleep(0.3)
+    latencies = list(bot.seek_stats.latencies)[before:]
+    stats = bot.seek_stats.stats()
+    report('seek', "перемотка (все, от команды до звука)", latencies)
+    report_value('seek', "из буфера / с перезапуском FFmpeg", f"{stats['buffered']} / {stats['restarts']}")
+    await bot.stop(fakes.FakeContext(guild, 'stop'))
+
+
+async def scenario_memory(bot, fakes, args):
+    """Сколько памяти занимает трек в очереди, если загрузить плейлист на queue_size треков."""
+    guild = fakes.FakeGuild(args.speed)
+    ctx = fakes.FakeContext(guild, 'playlist')
+    bot.get_state(guild.id).loop = False
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    await bot.playlist(ctx, query=f"https://bench.local/sets/memory?size={args.queue_size}")
+    # Плейлист дозагружается страницами в фоне — ждем, пока встанет весь
+    while bot.playlist_imports.get(guild.id):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    queued = len(bot.get_queue(guild.id))
+    report_value('memory', "треков в очереди", queued)
+    report_value('memory', "загрузка плейлиста", f"{elapsed:.2f}", 'с')
+    report_value('memory', "памяти на трек", round(used / max(queued, 1)), 'байт')
+
+    # Поиск по большой очереди: первый вызов строит индекс, дальше он уже готов
+    queue = bot.get_queue(guild.id)
+    started = time.perf_counter()
+    queue.find("tone #77777")
+    report_value('memory', "первый !find (строит индекс)", f"{(time.perf_counter() - started) * 1000:.1f}", 'мс')
+    lookups = []
+    for _ in range(100):
+        started = time.perf_counter()
+        queue.find(f"tone #{random.randrange(args.queue_size)}")
+        lookups.append(time.perf_counter() - started)
+    report('memory', "!find по готовому индексу", lookups)
+    await bot.stop(fakes.FakeContext(guild, 'stop'))
+
+
+async def scenario_lag(bot, fakes, args):
+    """Сотни серверов играют одновременно и шлют команды — насколько опаздывает цикл событий."""
+    guilds = [fakes.FakeGuild(1.0) for _ in range(args.guilds)]
+    await asyncio.gather(*(bot.playlist(fakes.FakeContext(guild, 'playlist'), query=f"https://bench.local/sets/lag{i}?size=50")
+                           for i, guild in enumerate(guilds)))
+
+    lags = []
+    interval = 0.05
+
+    async def ticker():
+        expected = time.perf_counter() + interval
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            lags.append(max(0.0, now - expected))
+            expected = now + interval
+
+    async def chatter():
+        """Случайные команды от случайных серверов, ~20 в секунду."""
+        commands = [
+            lambda ctx: bot.next_track(ctx),
+            lambda ctx: bot.find(ctx, query="tone #1"),
+            lambda ctx: bot.shuffle(ctx),
+            lambda ctx: bot.forward(ctx, 5),
+            lambda ctx: bot.play(ctx, query=f"bench lag {random.random()}"),
+        ]
+        while True:
+            await asyncio.sleep(random.expovariate(20))
+            guild = random.choice(guilds)
+            command = random.choice(commands)
+            try:
+                await command(fakes.FakeContext(guild, 'chatter'))
+            except Exception as e:
+                print(f"Ошибка команды в бенчмарке: {e}")
+
+    tasks = [asyncio.create_task(ticker()), asyncio.create_task(chatter())]
+    await asyncio.sleep(args.duration)
+    for task in tasks:
+        task.cancel()
+
+    playing = sum(1 for guild in guilds if guild.voice_client and guild.voice_client.is_playing())
+    report_value('lag', "серверов / играют сейчас", f"{len(guilds)} / {playing}")
+    report_value('lag', "процессов FFmpeg", len(bot.ffmpeg_manager.processes))
+    report('lag', "опоздание цикла событий", lags)
+
+    for guild in guilds:
+        await bot.stop(fakes.FakeContext(guild, 'stop'))
+
+
+async def main(args):
+    import fakes
+    import bot
+
+    # Без логина в Discord: async with поднимает bot.loop, которым пользуются фоновые задачи бота
+    async with bot.bot:
+        bot.ffmpeg_manager.start()
+        for name in args.scenarios:
+            print(f"\n▶ {name}")
+            started = time.perf_counter()
+            await globals()[f'scenario_{name}'](bot, fakes, args)
+            print(f"  (сценарий занял {time.perf_counter() - started:.1f} с)")
+
+        bot.resolver.shutdown()
+        bot.audio_cache.downloader.shutdown()
+        bot.store.flush()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        prepare_environment(args, workdir)
+        asyncio.run(main(args))
+        os.chdir(ROOT)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.json}")
@@ -0,0 +1,132 @@
+"""Подмена yt_dlp для бенчмарков: никакой сети, вместо треков — файлы, сгенерированные bench/run.py.
+
+Настраивается переменными окружения, потому что ее импортируют и процессы пула извлечения:
+    BENCH_AUDIO_DIR        — папка с тонами (short.*, long.*)
+    BENCH_EXTRACT_LATENCY  — средняя задержка extract_info, секунды
+    BENCH_EXTRACT_JITTER   — разброс задержки, доля от средней (0.5 — от 0.5x до 1.5x)
+    BENCH_FAIL_RATE        — доля запросов, которые падают с DownloadError
+    BENCH_TRACK_SECONDS    — длина коротких треков
+
+Ссылки: https://bench.local/track/<номер>, .../long/<номер> (длинный трек для перемотки),
+.../sets/<имя>?size=N&kind=short|long (плейлист), scsearch:<текст> и scsearchN:<текст> (поиск).
+"""
+import os
+import random
+import shutil
+import time
+import urllib.parse
+import zlib
+
+from .utils import DownloadError
+
+__all__ = ['YoutubeDL', 'DownloadError']
+
+HOST = 'https://bench.local'
+
+
+def env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def audio_file(kind):
+    """Короткие треки — Opus (проверяем passthrough), длинные — WAV (путь через PCM)."""
+    folder = os.environ['BENCH_AUDIO_DIR']
+    for name in os.listdir(folder):
+        if name.startswith(kind + '.'):
+            return os.path.join(folder, name)
+    raise DownloadError(f"Нет сгенерированного файла {kind}.* в {folder}")
+
+
+def track_info(kind, number):
+    path = audio_file(kind)
+    duration = env_float('BENCH_TRACK_SECONDS', 3) if kind == 'short' else 60
+    webpage_url = f"{HOST}/{'track' if kind == 'short' else 'long'}/{number}"
+    return {
+        'id': f"{kind}-{number}",
+        'title': f"Bench {kind} tone #{number}",
+        'uploader': f"bench-artist-{number % 17}",
+        'duration': duration,
+        'webpage_url': webpage_url,
+        'url': path,
+        'ext': os.path.splitext(path)[1].lstrip('.'),
+        'acodec': 'opus' if path.endswith('.opus') else 'pcm_s16le',
+    }
+
+
+def flat_entry(kind, number):
+    return {
+        '_type': 'url',
+        'url': f"{HOST}/{'track' if kind == 'short' else 'long'}/{number}",
+        'title': f"Bench {kind} tone #{number}",
+        'uploader': f"bench-artist-{number % 17}",
+        'duration': env_float('BENCH_TRACK_SECONDS', 3) if kind == 'short' else 60,
+    }
+
+
+class YoutubeDL:
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def simulate_network(self):
+        """Возвращает False, если запрос упал, но ignoreerrors велит не бросать исключение."""
+        latency = env_float('BENCH_EXTRACT_LATENCY', 0.2)
+        jitter = env_float('BENCH_EXTRACT_JITTER', 0.5)
+        time.sleep(max(0.0, latency * random.uniform(1 - jitter, 1 + jitter)))
+        if random.random() < env_float('BENCH_FAIL_RATE', 0):
+            # Как настоящий yt_dlp: с ignoreerrors ошибка только печатается, а extract_info возвращает None
+            if self.params.get('ignoreerrors'):
+                return False
+            raise DownloadError("ERROR: [bench] симулированный сбой извлечения")
+        return True
+
+    def extract_info(self, url, download=False):
+        if not self.simulate_network():
+            return None
+
+        if url.startswith('scsearch'):
+            prefix, _, query = url.partition(':')
+            count = int(prefix[len('scsearch'):] or 1)
+            base = zlib.crc32(query.encode()) % 100000
+            entries = [flat_entry('short', base + i) if self.params.get('extract_flat') else track_info('short', base + i)
+                       for i in range(count)]
+            return {'_type': 'playlist', 'title': query, 'entries': entries}
+
+        parsed = urllib.parse.urlparse(url)
+        parts = parsed.path.strip('/').split('/')
+        if parts[0] == 'sets':
+            params = urllib.parse.parse_qs(parsed.query)
+            size = int(params.get('size', ['50'])[0])
+            kind = params.get('kind', ['short'])[0]
+            make = flat_entry if self.params.get('extract_flat') else track_info
+            # Как настоящий yt_dlp: playlist_items "5-10" — только эти записи (с единицы)
+            first, last = 1, size
+            if self.params.get('playlist_items'):
+                first, _, last = self.params['playlist_items'].partition('-')
+                first, last = int(first), min(int(last or first), size)
+            return {'_type': 'playlist', 'title': f"Bench set {parts[-1]}",
+                    'entries': [make(kind, i) for i in range(first - 1, last)]}
+
+        kind = 'long' if parts[0] == 'long' else 'short'
+        info = track_info(kind, int(parts[-1]) if parts[-1].isdigit() else 0)
+        if download:
+            target = self.prepare_filename(info)
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            shutil.copyfile(info['url'], target)
+            info['requested_downloads'] = [{'filepath': target}]
+        return info
+
+    def prepare_filename(self, info):
+        template = self.params.get('outtmpl', '%(id)s.%(ext)s')
+        if isinstance(template, dict):
+            template = template.get('default', '%(id)s.%(ext)s')
+        return template % {'id': info['id'], 'ext': info['ext'], 'title': info['title']}
+
+    @staticmethod
+    def sanitize_info(info):
+        return info
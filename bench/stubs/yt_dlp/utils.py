@@ -0,0 +1,2 @@
+class DownloadError(Exception):
+    """Та же ошибка, что бросает настоящий yt_dlp при неудачном извлечении."""
@@ -0,0 +1,223 @@
+"""Дымовые тесты бенчмарка, чтобы он не сломался молча вместе с ботом.
+
+    python -m pytest -q bench/test_smoke.py
+
+Заглушка yt_dlp, FakeVoiceClient и импорт бота с окружением бенчмарка проверяются без ffmpeg.
+Сами сценарии run.py гоняются на минимальных размерах и пропускаются, если ffmpeg нет в PATH.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+STUBS = os.path.join(BENCH_DIR, 'stubs')
+sys.path.insert(0, BENCH_DIR)
+
+import fakes
+import run
+
+HAS_FFMPEG = shutil.which('ffmpeg') is not None
+
+
+def load_stub():
+    """Заглушка под своим именем, чтобы не перекрыть настоящий yt_dlp, если он установлен."""
+    spec = importlib.util.spec_from_file_location(
+        'bench_yt_dlp', os.path.join(STUBS, 'yt_dlp', '__init__.py'),
+        submodule_search_locations=[os.path.join(STUBS, 'yt_dlp')])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_env(workdir, **extra):
+    """То же окружение, что ставит run.prepare_environment, но с пустыми файлами вместо тонов."""
+    audio_dir = os.path.join(workdir, 'audio')
+    os.makedirs(audio_dir, exist_ok=True)
+    for name in ('short.opus', 'long.wav'):
+        open(os.path.join(audio_dir, name), 'wb').close()
+    env = dict(os.environ)
+    env.update({
+        'BENCH_AUDIO_DIR': audio_dir,
+        'BENCH_EXTRACT_LATENCY': '0',
+        'BENCH_EXTRACT_JITTER': '0',
+        'BENCH_FAIL_RATE': '0',
+        'SHARD_COUNT': '0',
+        'METRICS_PORT': '0',
+        'EVENT_LOG': '',
+        'RESTORE_ON_STARTUP': '0',
+        'DATABASE_FILE': os.path.join(workdir, 'bench.sqlite3'),
+        'SEARCH_CACHE_FILE': '',
+        'AUDIO_CACHE_MB': '0',
+        'PYTHONPATH': os.pathsep.join(filter(None, [STUBS, ROOT, BENCH_DIR, os.getenv('PYTHONPATH')])),
+    })
+    env.update(extra)
+    return env
+
+
+class StubTests(unittest.TestCase):
+    """Заглушка должна отвечать так, как бот ждет от настоящего yt_dlp."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = load_stub()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='bot-bench-test-')
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        env = bench_env(self.workdir)
+        self.saved = {name: os.environ.get(name) for name in ('BENCH_AUDIO_DIR', 'BENCH_EXTRACT_LATENCY', 'BENCH_FAIL_RATE')}
+        for name in self.saved:
+            os.environ[name] = env[name]
+        self.addCleanup(self.restore_env)
+
+    def restore_env(self):
+        for name, value in self.saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def test_track(self):
+        info = self.stub.YoutubeDL({}).extract_info('https://bench.local/track/7')
+        self.assertEqual(info['webpage_url'], 'https://bench.local/track/7')
+        self.assertEqual(info['acodec'], 'opus')
+        self.assertTrue(os.path.exists(info['url']))
+
+    def test_long_track(self):
+        info = self.stub.YoutubeDL({}).extract_info('https://bench.local/long/3')
+        self.assertEqual(info['duration'], 60)
+        self.assertEqual(info['acodec'], 'pcm_s16le')
+
+    def test_playlist_items(self):
+        ydl = self.stub.YoutubeDL({'extract_flat': True, 'playlist_items': '3-5'})
+        info = ydl.extract_info('https://bench.local/sets/test?size=10')
+        self.assertEqual([entry['url'] for entry in info['entries']],
+                         [f'https://bench.local/track/{i}' for i in (2, 3, 4)])
+
+    def test_search(self):
+        info = self.stub.YoutubeDL({'extract_flat': True}).extract_info('scsearch3:bench')
+        self.assertEqual(len(info['entries']), 3)
+
+    def test_failure(self):
+        os.environ['BENCH_FAIL_RATE'] = '1'
+        with self.assertRaises(self.stub.DownloadError):
+            self.stub.YoutubeDL({}).extract_info('https://bench.local/track/1')
+        self.assertIsNone(self.stub.YoutubeDL({'ignoreerrors': True}).extract_info('https://bench.local/track/1'))
+
+
+class ListSource:
+    """Источник из готовых кадров — вместо FFmpeg."""
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.cleaned = False
+
+    def read(self):
+        return self.frames.pop(0) if self.frames else b''
+
+    def cleanup(self):
+        self.cleaned = True
+
+
+class FakeVoiceTests(unittest.TestCase):
+    def test_plays_and_records_tracks(self):
+        async def scenario():
+            guild = fakes.FakeGuild(speed=100)
+            voice = await guild.voice_channel.connect()
+            finished = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            errors = []
+
+            def after(error):
+                errors.append(error)
+                loop.call_soon_threadsafe(finished.set)
+
+            source = ListSource([b'x'] * 5)
+            voice.play(source, after=after)
+            self.assertEqual(await voice.wait_tracks(1, 5), 1)
+            await asyncio.wait_for(finished.wait(), 5)
+            return voice, source, errors
+
+        voice, source, errors = asyncio.run(scenario())
+        self.assertTrue(source.cleaned)
+        self.assertEqual(errors, [None])
+        self.assertIsNotNone(voice.tracks[0][1])
+        self.assertFalse(voice.is_playing())
+
+    def test_context(self):
+        guild = fakes.FakeGuild()
+        ctx = fakes.FakeContext(guild, 'play')
+        asyncio.run(ctx.send("привет"))
+        self.assertEqual(guild.text_channel.sent, 1)
+        self.assertIs(ctx.author.voice.channel, guild.voice_channel)
+
+
+class BotImportTests(unittest.TestCase):
+    """Сценарии зовут бота напрямую — проверяем, что все, чем они пользуются, на месте."""
+
+    def test_bot_has_what_scenarios_use(self):
+        names = ['bot', 'play', 'playlist', 'next_track', 'stop', 'get_state',
+                 'ffmpeg_manager', 'resolver', 'audio_cache', 'store']
+        code = (
+            "import bot\n"
+            f"missing = [name for name in {names!r} if not hasattr(bot, name)]\n"
+            "assert not missing, missing\n"
+            "assert hasattr(bot.ffmpeg_manager, 'spawned')\n"
+            "bot.resolver.shutdown()\n"
+            "bot.audio_cache.downloader.shutdown()\n"
+        )
+        with tempfile.TemporaryDirectory(prefix='bot-bench-test-') as workdir:
+            done = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=bench_env(workdir),
+                                  capture_output=True, text=True, timeout=120)
+        self.assertEqual(done.returncode, 0, done.stderr)
+
+    def test_scenarios_defined(self):
+        for name in run.SCENARIOS:
+            self.assertTrue(callable(getattr(run, f'scenario_{name}', None)), name)
+
+
+@unittest.skipUnless(HAS_FFMPEG, "нужен ffmpeg в PATH")
+class ScenarioTests(unittest.TestCase):
+    """Каждый сценарий на минимальных размерах: должен дойти до конца и записать результаты."""
+
+    def run_scenario(self, name):
+        with tempfile.TemporaryDirectory(prefix='bot-bench-test-') as workdir:
+            report = os.path.join(workdir, 'report.json')
+            done = subprocess.run(
+                [sys.executable, os.path.join(BENCH_DIR, 'run.py'), name, '--rounds', '2', '--queue-size', '2000',
+                 '--guilds', '3', '--duration', '2', '--latency', '0.01', '--track-seconds', '1', '--speed', '20',
+                 '--json', report],
+                cwd=workdir, capture_output=True, text=True, timeout=300)
+            self.assertEqual(done.returncode, 0, done.stdout + done.stderr)
+            with open(report, encoding='utf-8') as f:
+                results = json.load(f)['results']
+        self.assertIn(name, results)
+        self.assertTrue(results[name])
+        return results[name]
+
+    def test_commands(self):
+        self.run_scenario('commands')
+
+    def test_transitions(self):
+        results = self.run_scenario('transitions')
+        self.assertEqual(results[f"трек после {run.SKIP_BURST} !skip разом"], 'верный')
+
+    def test_seek(self):
+        self.run_scenario('seek')
+
+    def test_memory(self):
+        self.run_scenario('memory')
+
+    def test_lag(self):
+        self.run_scenario('lag')
+
+
+if __name__ == '__main__':
+    unittest.main()
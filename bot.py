@@ -1,68 +1,243 @@
 import discord
 from discord.ext import commands
-import yt_dlp
+from aiohttp import web
 import asyncio
+import heapq
+import itertools
 import random
 import time
 import urllib.parse
 import math
+import multiprocessing
 import os
+import threading
 import json
+import sqlite3
+import re
+import base64
+import zlib
+import hashlib
+import sys
+import weakref
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
+import ytdl_worker
 
 load_dotenv()
 
 # --- 1. НАСТРОЙКИ БОТА ---
 intents = discord.Intents.default()
 intents.message_content = True
-# Отключаем стандартный help, чтобы использовать наш красивый
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
-
-# Словари для хранения данных
-queues = {} 
-settings = {} 
-current_tracks = {} 
-playback_info = {} 
-is_seeking = {}
-is_processing = {}
-now_playing_messages = {}
-history_queues = {}
-loop_mode = {}
+# Шарды: SHARD_COUNT — всего шардов, SHARD_IDS — какие из них держит этот процесс (через запятую).
+# Несколько процессов запускает launcher.py; без этих переменных бот работает как раньше, одним процессом
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+SHARD_IDS = [int(i) for i in os.getenv('SHARD_IDS', '').split(',') if i.strip()]
+SHARD_LABEL = os.getenv('SHARD_IDS', '') or 'main'
 
+# Отключаем стандартный help, чтобы использовать наш красивый
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, help_command=None,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+
+def is_own_guild(guild_id):
+    """Обслуживает ли этот процесс данный сервер (формула шарда из документации Discord)."""
+    if not SHARD_COUNT or not SHARD_IDS:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+# --- ХРАНИЛИЩЕ ---
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'bot_data.sqlite3')
+# Общие для всех процессов кэши ссылок и поиска в той же базе (по умолчанию включены, если бот разбит на шарды)
+SHARED_CACHE = os.getenv('SHARED_CACHE', '1' if SHARD_COUNT else '0') == '1'
+SHARED_CACHE_PURGE_INTERVAL = 600
+# Через сколько секунд после изменения данные уходят на диск (все изменения за это время — одной пачкой)
+STORE_FLUSH_DELAY = float(os.getenv('STORE_FLUSH_DELAY', 2))
+
+class GuildStore:
+    """SQLite в режиме WAL с отложенной записью.
+
+    Каждый сервер — отдельная строка, поэтому !vol в одном сервере не переписывает данные остальных.
+    Изменения копятся в памяти и пишутся одной транзакцией в фоновом потоке, не блокируя бота.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS guild_data (namespace TEXT, guild TEXT, data TEXT, PRIMARY KEY (namespace, guild))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shared_cache (namespace TEXT, key TEXT, expires REAL, data TEXT, PRIMARY KEY (namespace, key))")
+        # Здоровье процессов — отдельно: это не сервер, и в выборках по guild_data ему делать нечего
+        self.db.execute("CREATE TABLE IF NOT EXISTS shard_health (label TEXT PRIMARY KEY, data TEXT)")
+        self.db.execute("DELETE FROM guild_data WHERE namespace = 'shard_health'") # старое место
+        self.db.commit()
+        # Одно соединение на все потоки — пишем строго по очереди
+        self.lock = threading.Lock()
+        # Читаем через отдельное соединение со своим замком: запись держит self.lock всю транзакцию
+        # (и может ждать до 5 с, пока пишут другие процессы), а в WAL читателям писатели не мешают
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.execute("PRAGMA query_only = ON")
+        self.read_lock = threading.Lock()
+        self.dirty = {} # (namespace, guild) -> живой объект с данными (None — удалить)
+        self.cache_dirty = {} # (namespace, key) -> (время истечения, значение)
+        self.health_dirty = {} # метка процесса -> его последний отчет
+        self.last_purge = time.time()
+        self.flush_task = None
+
+    def query(self, sql, args):
+        with self.read_lock:
+            return self.reader.execute(sql, args).fetchall()
+
+    def load(self, namespace):
+        rows = self.query("SELECT guild, data FROM guild_data WHERE namespace = ?", (namespace,))
+        return {guild: self.decode(data) for guild, data in rows}
+
+    def load_one(self, namespace, guild):
+        # Еще не записанное на диск (например, снимок только что выгруженного сервера) отдаем из памяти
+        if (namespace, guild) in self.dirty:
+            return self.dirty[(namespace, guild)]
+        rows = self.query("SELECT data FROM guild_data WHERE namespace = ? AND guild = ?", (namespace, guild))
+        return self.decode(rows[0][0]) if rows else None
+
+    def keys(self, namespace):
+        return [row[0] for row in self.query("SELECT guild FROM guild_data WHERE namespace = ?", (namespace,))]
+
+    # Для горячих путей (запуск трека, кэши): то же самое, но чтение идет в фоновом потоке, а не в цикле событий
+    async def fetch(self, namespace):
+        return await asyncio.get_running_loop().run_in_executor(None, self.load, namespace)
+
+    async def fetch_one(self, namespace, guild):
+        if (namespace, guild) in self.dirty:
+            return self.dirty[(namespace, guild)]
+        return await asyncio.get_running_loop().run_in_executor(None, self.load_one, namespace, guild)
+
+    async def fetch_keys(self, namespace):
+        return await asyncio.get_running_loop().run_in_executor(None, self.keys, namespace)
+
+    def put_health(self, label, report):
+        self.health_dirty[label] = report
+        self.schedule_flush()
+
+    def load_health(self):
+        return {label: json.loads(data) for label, data in self.query("SELECT label, data FROM shard_health", ())}
+
+    async def fetch_health(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.load_health)
+
+    @staticmethod
+    def decode(data):
+        # bytes храним как есть (например, сжатые снимки), остальное — json
+        return data if isinstance(data, bytes) else json.loads(data)
+
+    @staticmethod
+    def encode(value):
+        if value is None or isinstance(value, bytes):
+            return value
+        return json.dumps(value, ensure_ascii=False)
+
+    def mark(self, namespace, guild, value):
+        """Помечает данные сервера измененными. Повторные изменения до записи схлопываются в одну."""
+        self.dirty[(namespace, guild)] = value
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_task is None:
+            self.flush_task = bot.loop.create_task(self.delayed_flush())
+
+    async def cache_get(self, namespace, key):
+        """Запись общего кэша, которую мог положить любой процесс: (время истечения, значение) или None."""
+        pending = self.cache_dirty.get((namespace, key))
+        if pending:
+            return pending
+        return await asyncio.get_running_loop().run_in_executor(None, self.read_cache, namespace, key)
+
+    def read_cache(self, namespace, key):
+        rows = self.query("SELECT expires, data FROM shared_cache WHERE namespace = ? AND key = ? AND expires > ?",
+                          (namespace, key, time.time()))
+        return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+    def cache_put(self, namespace, key, value, expires_at):
+        self.cache_dirty[(namespace, key)] = (expires_at, value)
+        self.schedule_flush()
+
+    def take_batch(self):
+        # Сериализуем в потоке бота, чтобы команды не поменяли данные посреди json.dumps
+        batch = [(ns, guild, self.encode(value)) for (ns, guild), value in self.dirty.items()]
+        cache_batch = [(ns, key, expires_at, json.dumps(value, ensure_ascii=False))
+                       for (ns, key), (expires_at, value) in self.cache_dirty.items()]
+        health_batch = [(label, json.dumps(report)) for label, report in self.health_dirty.items()]
+        self.dirty.clear()
+        self.cache_dirty.clear()
+        self.health_dirty.clear()
+        return batch, cache_batch, health_batch
+
+    def write(self, batches):
+        batch, cache_batch, health_batch = batches
+        purge = time.time() - self.last_purge > SHARED_CACHE_PURGE_INTERVAL
+        if not batch and not cache_batch and not health_batch and not purge:
+            return
+        # with self.db — одна транзакция: либо записалась вся пачка, либо ничего
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO guild_data (namespace, guild, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (namespace, guild) DO UPDATE SET data = excluded.data",
+                [row for row in batch if row[2] is not None]
+            )
+            self.db.executemany(
+                "DELETE FROM guild_data WHERE namespace = ? AND guild = ?",
+                [row[:2] for row in batch if row[2] is None]
+            )
+            self.db.executemany(
+                "INSERT INTO shared_cache (namespace, key, expires, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET expires = excluded.expires, data = excluded.data",
+                cache_batch
+            )
+            self.db.executemany(
+                "INSERT INTO shard_health (label, data) VALUES (?, ?) "
+                "ON CONFLICT (label) DO UPDATE SET data = excluded.data",
+                health_batch
+            )
+            if purge:
+                self.last_purge = time.time()
+                self.db.execute("DELETE FROM shared_cache WHERE expires <= ?", (self.last_purge,))
+
+    async def delayed_flush(self):
+        await asyncio.sleep(STORE_FLUSH_DELAY)
+        self.flush_task = None
+        batch = self.take_batch()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.write, batch)
+        except sqlite3.Error as e:
+            print(f"Ошибка записи в базу: {e}")
+
+    def flush(self):
+        """Синхронно дописывает все, что осталось. Вызывается при выключении бота."""
+        self.write(self.take_batch())
+
+    def migrate_json(self, namespace, json_file):
+        """Один раз переносит данные из старого json-файла, если в базе их еще нет."""
+        data = self.load(namespace)
+        if data or not os.path.exists(json_file):
+            return data
+        with open(json_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.write(([(namespace, guild, self.encode(value)) for guild, value in data.items()], [], []))
+        return data
+
+store = GuildStore(DATABASE_FILE)
+
+# Старые файлы нужны только для переезда в базу
 SETTINGS_FILE = "server_settings.json"
-
-# Функция для загрузки настроек из файла
-def load_settings():
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-# Функция для сохранения настроек в файл
-def save_settings(data):
-    with open(SETTINGS_FILE, "w") as f:
-        json.dump(data, f, indent=4)
-
-# Загружаем настройки при старте бота
-persistent_settings = load_settings()
-
 PLAYLIST_HISTORY_FILE = "playlist_history.json"
 
-# Функция для загрузки истории плейлистов из файла
-def load_playlists():
-    if os.path.exists(PLAYLIST_HISTORY_FILE):
-        with open(PLAYLIST_HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+# Загружаем настройки при старте бота (ключи — id сервера строкой)
+persistent_settings = store.migrate_json('settings', SETTINGS_FILE)
 
-# Функция для сохранения истории в файл
-def save_playlists(data):
-    with open(PLAYLIST_HISTORY_FILE, "w", encoding="utf-8") as f:
-        # ensure_ascii=False нужен, чтобы русские буквы сохранялись нормально
-        json.dump(data, f, indent=4, ensure_ascii=False)
-
-# Теперь вместо пустого словаря {} мы сразу загружаем данные из файла
-saved_playlists = load_playlists()
+# Теперь вместо пустого словаря {} мы сразу загружаем историю плейлистов из базы
+saved_playlists = store.migrate_json('playlists', PLAYLIST_HISTORY_FILE)
 
 YTDL_OPTIONS = {
     'format': 'bestaudio/best',
@@ -70,7 +245,10 @@ YTDL_OPTIONS = {
     'quiet': True,
     'ignoreerrors': True, 
 }
-ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+
+# Для одного трека ошибки не глотаем: с ignoreerrors yt-dlp вместо исключения вернет None,
+# и по тексту ошибки уже не понять, удален трек или это был временный сбой
+STREAM_OPTIONS = {**YTDL_OPTIONS, 'noplaylist': True, 'ignoreerrors': False}
 
 # Улучшенные настройки для идеального звука без заиканий
 FFMPEG_OPTIONS = {
@@ -80,6 +258,1369 @@ FFMPEG_OPTIONS = {
     'options': '-vn -threads 1' 
 }
 
+# --- МЕТРИКИ И СОБЫТИЯ ---
+# Prometheus забирает метрики с http://METRICS_HOST:METRICS_PORT/metrics (0 — не поднимать сервер).
+# У процессов-шардов порт сдвигается на номер первого шарда, чтобы они не дрались за один
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+# События в JSON по строке: '-' — в консоль, путь — в файл, пусто — не писать
+EVENT_LOG = os.getenv('EVENT_LOG', '-')
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """Счетчики и гистограммы в текстовом формате Prometheus.
+
+    Пишут в них и цикл событий, и потоки плееров, поэтому все под одним замком.
+    Текущие значения (длина очередей и т.п.) не храним, а собираем функциями-сборщиками в момент запроса.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {} # имя -> (тип, описание)
+        self.values = {} # (имя, метки) -> число или [счетчики по корзинам, сумма, количество]
+        self.collectors = []
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = (kind, text)
+
+    def collector(self, func):
+        """Декоратор: func() отдает [(имя, {метки}, значение)] на момент запроса."""
+        self.collectors.append(func)
+        return func
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                samples.setdefault(name, []).append((labels, value if isinstance(value, (int, float)) else
+                                                     [list(value[0]), value[1], value[2]]))
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                print(f"Ошибка сбора метрик: {e}")
+
+        lines = []
+        for name in sorted(samples):
+            kind, text = self.kinds.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples[name]:
+                if kind != 'histogram':
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+                    continue
+                buckets, total, count = value
+                for bound, hits in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bound),))} {hits}")
+                lines.append(f"{name}_bucket{self.format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {total}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe('bot_extract_seconds', 'histogram', 'Время extract_info с точки зрения вызывающего (с ожиданием в очереди пула)')
+metrics.describe('bot_first_audio_seconds', 'histogram', 'От команды до первого кадра звука')
+metrics.describe('bot_track_gap_seconds', 'histogram', 'Тишина между концом трека и первым кадром следующего')
+metrics.describe('bot_seek_seconds', 'histogram', 'От команды перемотки до первого кадра с новой позиции')
+metrics.describe('bot_ffmpeg_spawns_total', 'counter', 'Запущено процессов FFmpeg')
+metrics.describe('bot_ffmpeg_failures_total', 'counter', 'FFmpeg завершился с ошибкой во время игры')
+metrics.describe('bot_play_errors_total', 'counter', 'Треки, которые не удалось запустить')
+
+event_log_lock = threading.Lock()
+event_log_file = None
+
+def log_event(event, **fields):
+    """Одна строка JSON на событие — удобно грепать и грузить в любой сборщик логов."""
+    global event_log_file
+    if not EVENT_LOG:
+        return
+    line = json.dumps({'ts': round(time.time(), 3), 'shard': SHARD_LABEL, 'event': event, **fields},
+                      ensure_ascii=False, default=str)
+    with event_log_lock:
+        if EVENT_LOG == '-':
+            print(line, flush=True)
+            return
+        if event_log_file is None:
+            event_log_file = open(EVENT_LOG, 'a', encoding='utf-8', buffering=1)
+        event_log_file.write(line + "\n")
+
+metrics_runner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT or metrics_runner is not None:
+        return
+
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+    try:
+        await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+        print(f"📈 Метрики: http://{METRICS_HOST}:{port}/metrics")
+    except OSError as e:
+        print(f"Ошибка запуска сервера метрик на порту {port}: {e}")
+
+# --- ПУЛ ИЗВЛЕЧЕНИЯ ССЫЛОК ---
+# yt-dlp парсит страницы на чистом Python и отнимает GIL у голосовых потоков,
+# поэтому все extract_info выполняются в отдельных процессах
+RESOLVER_WORKERS = int(os.getenv('RESOLVER_WORKERS', 2))
+# Сколько фоновых заявок (предзагрузка, названия) может стоять в очереди
+RESOLVER_QUEUE_SIZE = int(os.getenv('RESOLVER_QUEUE_SIZE', 100))
+RESOLVE_TIMEOUT = float(os.getenv('RESOLVE_TIMEOUT', 30))
+
+# Приоритеты: чем меньше число, тем раньше заявка попадет к воркеру
+PRIORITY_NOW = 0        # то, что нужно прямо сейчас (играющий трек, поиск)
+PRIORITY_PREFETCH = 1   # предзагрузка следующих треков
+PRIORITY_BACKFILL = 2   # подгрузка названий в фоне
+
+# Обычный fork копирует процесс, где уже работают потоки плееров и записи в базу: ребенок может
+# унаследовать чужую захваченную блокировку и зависнуть. forkserver форкает воркеры из чистого процесса
+POOL_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+class ResolveRequest:
+    __slots__ = ('url', 'func', 'args', 'priority', 'future', 'started')
+
+    def __init__(self, url, func, args, priority, future):
+        self.url = url
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.future = future
+        self.started = False
+
+class Resolver:
+    """Пул долгоживущих процессов с прогретым YoutubeDL и очередью заявок с приоритетами."""
+    def __init__(self, workers, queue_size, preload=()):
+        self.workers = workers
+        self.preload = list(preload)
+        self.pool = None
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = None
+        # Фоновые заявки ограничены: если очередь забита, они ждут (backpressure)
+        self.slots = None
+        self.queue_size = queue_size
+        self.pending = {} # url -> заявки, которые еще не ушли в воркер
+        self.dispatchers = []
+
+    def new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=POOL_CONTEXT,
+                                   initializer=ytdl_worker.init_worker, initargs=(self.preload,))
+
+    def start(self):
+        if self.pool:
+            return
+        self.pool = self.new_pool()
+        self.wakeup = asyncio.Condition()
+        self.slots = asyncio.Semaphore(self.queue_size)
+        loop = asyncio.get_running_loop()
+        self.dispatchers = [loop.create_task(self.dispatch()) for _ in range(self.workers)]
+
+    def shutdown(self):
+        for task in self.dispatchers:
+            task.cancel()
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def push(self, request, holds_slot):
+        try:
+            heapq.heappush(self.heap, (request.priority, next(self.counter), request, holds_slot))
+        except BaseException:
+            # Заявка не попала в кучу — диспетчер ее слот не вернет
+            if holds_slot:
+                self.slots.release()
+            raise
+        async with self.wakeup:
+            self.wakeup.notify()
+
+    async def extract(self, url, options, priority=PRIORITY_NOW, timeout=RESOLVE_TIMEOUT, site='other'):
+        """Асинхронно выполняет extract_info в пуле. Бросает asyncio.TimeoutError по таймауту."""
+        return await self.run(ytdl_worker.extract, url, (url, options), priority, timeout, site)
+
+    async def run(self, func, url, args, priority=PRIORITY_NOW, timeout=RESOLVE_TIMEOUT, site='other'):
+        """Выполняет функцию из ytdl_worker в пуле. url — ключ заявки для promote(), site — откуда вызвали (для метрик)."""
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await self.submit(func, url, args, priority, timeout)
+            outcome = 'ok'
+            return result
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe('bot_extract_seconds', elapsed, site=site, outcome=outcome)
+            log_event('extract', site=site, outcome=outcome, seconds=round(elapsed, 3), url=url)
+
+    async def submit(self, func, url, args, priority, timeout):
+        self.start()
+        request = ResolveRequest(url, func, args, priority, asyncio.get_running_loop().create_future())
+
+        holds_slot = priority != PRIORITY_NOW
+        if holds_slot:
+            await self.slots.acquire()
+        try:
+            self.pending.setdefault(url, []).append(request)
+            await self.push(request, holds_slot)
+            # Если ответа не дождались, future отменится и диспетчер выкинет заявку из очереди
+            return await asyncio.wait_for(request.future, timeout)
+        finally:
+            self.forget(request)
+            # Сюда попадаем и когда до wait_for не дошли — заявка в куче не должна уйти в воркер
+            if not request.future.done():
+                request.future.cancel()
+
+    def forget(self, request):
+        waiting = self.pending.get(request.url)
+        if waiting and request in waiting:
+            waiting.remove(request)
+            if not waiting:
+                del self.pending[request.url]
+
+    async def promote(self, url, priority):
+        """Поднимает приоритет заявок на эту ссылку (например, предзагрузка вдруг стала текущим треком)."""
+        for request in list(self.pending.get(url, ())):
+            if not request.started and priority < request.priority:
+                request.priority = priority
+                await self.push(request, False)
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self.wakeup:
+                await self.wakeup.wait_for(lambda: self.heap)
+                _, _, request, holds_slot = heapq.heappop(self.heap)
+            if holds_slot:
+                self.slots.release()
+
+            # Заявку уже отменили, либо она уже ушла в воркер по более высокому приоритету
+            if request.started or request.future.done():
+                continue
+
+            request.started = True
+            self.forget(request)
+            pool = self.pool
+            try:
+                info = await loop.run_in_executor(pool, request.func, *request.args)
+            except BrokenProcessPool as e:
+                # Воркер упал — поднимаем пул заново (один раз, даже если упали сразу все диспетчеры)
+                if self.pool is pool:
+                    print(f"Пул извлечения сломался, перезапускаю: {e}")
+                    self.pool = self.new_pool()
+                if not request.future.done():
+                    request.future.set_exception(e)
+            except Exception as e:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            else:
+                if not request.future.done():
+                    request.future.set_result(info)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queued': sum(1 for _, _, r, _ in self.heap if not r.started and not r.future.done()),
+        }
+
+resolver = Resolver(RESOLVER_WORKERS, RESOLVER_QUEUE_SIZE, preload=[{**YTDL_OPTIONS, 'noplaylist': True}, STREAM_OPTIONS])
+
+# --- КЭШ ПРЯМЫХ ССЫЛОК ---
+class TTLCache:
+    """LRU-кэш с ограничением по размеру и сроком жизни каждой записи.
+
+    Если задан shared, промахи дочитываются из общей таблицы в базе (fetch), а новые записи попадают туда же —
+    так процессы-шарды не ищут одно и то же каждый сам по себе.
+    """
+    def __init__(self, maxsize, ttl, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared if SHARED_CACHE else None
+        self.data = OrderedDict() # ключ -> (время истечения, значение)
+        self.hits = 0
+        self.misses = 0
+
+    async def fetch(self, key):
+        """Как get, но промах сначала ищется в общей таблице — в фоновом потоке, цикл событий не ждет базу."""
+        if self.shared and key not in self.data:
+            item = await store.cache_get(self.shared, key)
+            # Пока читали, запись могла появиться и здесь — она свежее
+            if item and key not in self.data:
+                self.data[key] = item
+                self.trim()
+        return self.get(key)
+
+    def get(self, key):
+        """Только то, что уже в памяти процесса."""
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = item
+        if expires_at <= time.time():
+            # Запись протухла — выкидываем и считаем промахом
+            del self.data[key]
+            self.misses += 1
+            return None
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        self.trim()
+        if self.shared:
+            store.cache_put(self.shared, key, value, expires_at)
+
+    def trim(self):
+        # Выкидываем самые старые записи, если вышли за лимит
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+        if self.shared:
+            # Другие процессы тоже не должны брать эту запись: кладем ее в общую таблицу уже протухшей
+            store.cache_put(self.shared, key, None, 0)
+
+    def dump(self):
+        """Список живых записей [ключ, время истечения, значение] — для сохранения на диск."""
+        now = time.time()
+        return [[key, expires_at, value] for key, (expires_at, value) in self.data.items() if expires_at > now]
+
+    def load(self, items):
+        now = time.time()
+        for key, expires_at, value in items:
+            if expires_at > now:
+                self.data[key] = (expires_at, value)
+        self.trim()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.data),
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+RESOLVE_CACHE_SIZE = int(os.getenv('RESOLVE_CACHE_SIZE', 512))
+# Сколько живет ссылка, если CDN не указал срок годности (в секундах)
+RESOLVE_DEFAULT_TTL = int(os.getenv('RESOLVE_CACHE_TTL', 1800))
+# Запас, чтобы не начать играть ссылку, которая вот-вот протухнет
+RESOLVE_EXPIRY_MARGIN = 120
+
+resolve_cache = TTLCache(RESOLVE_CACHE_SIZE, RESOLVE_DEFAULT_TTL, shared='resolve')
+
+def url_expiry(stream_url):
+    """Достает время истечения (unix time) из подписанной CDN-ссылки, если оно там есть."""
+    params = urllib.parse.parse_qs(urllib.parse.urlparse(stream_url).query)
+
+    # YouTube (expire=...), S3/CloudFront с простой подписью (Expires=...)
+    for key in ('expire', 'Expires', 'expires', 'exp'):
+        if key in params:
+            try:
+                return float(params[key][0])
+            except ValueError:
+                pass
+
+    # SoundCloud отдает ссылки CloudFront с Policy — это base64 от JSON с EpochTime
+    if 'Policy' in params:
+        policy = params['Policy'][0].replace('-', '+').replace('_', '=').replace('~', '/')
+        try:
+            decoded = base64.b64decode(policy + '=' * (-len(policy) % 4)).decode('utf-8', 'ignore')
+        except ValueError:
+            return None
+        match = re.search(r'"AWS:EpochTime"\s*:\s*(\d+)', decoded)
+        if match:
+            return float(match.group(1))
+
+    return None
+
+def stream_ttl(stream_url):
+    """Сколько секунд можно держать ссылку в кэше (0 — кэшировать нельзя)."""
+    expires_at = url_expiry(stream_url)
+    if expires_at is None:
+        return RESOLVE_DEFAULT_TTL
+    return max(0, min(RESOLVE_DEFAULT_TTL, expires_at - time.time() - RESOLVE_EXPIRY_MARGIN))
+
+def extract_title(info, default='Трек'):
+    """Нормальное название трека (SoundCloud иногда отдает вместо него цифры)."""
+    title = info.get('title')
+    if not title or title.isdigit():
+        title = f"{info.get('uploader', 'SoundCloud')} - {info.get('track', default)}"
+    return title
+
+async def fetch_stream_info(url, priority):
+    """Один реальный поход в yt-dlp за прямой ссылкой. Результат кладется в кэш."""
+    failure = await failed_tracks.fetch(canonical_url(url))
+    if failure:
+        raise TrackUnavailable(url, failure)
+    host = url_host(url)
+    host_breaker.check(host)
+
+    site = 'play_next' if priority == PRIORITY_NOW else 'prefetch'
+    try:
+        info = await resolver.extract(url, STREAM_OPTIONS, priority, site=site)
+        if not info or not info.get('url'):
+            # Ошибки yt-dlp сюда не доходят, они уже исключения; пустой ответ считаем временным сбоем
+            raise RuntimeError(f"Пустой ответ без ссылки на поток: {url}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        if classify_error(e) == TRANSIENT:
+            host_breaker.failure(host)
+        else:
+            # Удаленный трек найден заранее (например, предзагрузкой) — в очереди он пропустится мгновенно
+            host_breaker.success(host)
+            remember_failure(url, e)
+        raise
+    host_breaker.success(host)
+
+    resolved = {
+        'url': info['url'],
+        'title': extract_title(info),
+        'duration': info.get('duration') or 0,
+        'acodec': info.get('acodec'),
+        'uploader': info.get('uploader'),
+    }
+
+    ttl = stream_ttl(info['url'])
+    if ttl > 0:
+        resolve_cache.put(url, resolved, ttl)
+    return resolved
+
+# Ссылки, которые прямо сейчас извлекаются: url -> {'task', 'waiters'}
+resolve_inflight = {}
+
+async def resolve_track(url, priority=PRIORITY_NOW):
+    """Возвращает прямую ссылку на поток, название и длину трека. Повторы берутся из кэша."""
+    cached = await resolve_cache.fetch(url)
+    if cached:
+        return cached
+
+    # Если эту ссылку уже кто-то извлекает (например, предзагрузка) — ждем его, а не идем второй раз
+    entry = resolve_inflight.get(url)
+    if entry is None:
+        entry = {'task': asyncio.ensure_future(fetch_stream_info(url, priority)), 'waiters': 0}
+        resolve_inflight[url] = entry
+
+        def forget(t):
+            if resolve_inflight.get(url) is entry:
+                del resolve_inflight[url]
+            if not t.cancelled():
+                t.exception() # чтобы asyncio не ругался на необработанную ошибку
+
+        entry['task'].add_done_callback(forget)
+    else:
+        await resolver.promote(url, priority)
+
+    entry['waiters'] += 1
+    try:
+        # shield: отмена одного ожидающего не должна убивать извлечение для остальных
+        return await asyncio.shield(entry['task'])
+    finally:
+        entry['waiters'] -= 1
+        # Больше никто не ждет (например, отменили устаревшую предзагрузку) — снимаем заявку с пула
+        if entry['waiters'] == 0 and not entry['task'].done():
+            entry['task'].cancel()
+
+# --- НЕРАБОЧИЕ ТРЕКИ ---
+# Удаленный или закрытый трек не открывается и со второго раза: помним такие ссылки и пропускаем их мгновенно
+PERMANENT_FAILURE_TTL = float(os.getenv('PERMANENT_FAILURE_TTL', 6 * 3600))
+# Трек, который не открылся из-за сети даже после повторов, — пропускаем недолго
+TRANSIENT_FAILURE_TTL = float(os.getenv('TRANSIENT_FAILURE_TTL', 120))
+FAILED_CACHE_SIZE = 10000
+# Повторы при временных ошибках: через 0.5 с, потом через 1 с
+RESOLVE_RETRIES = 2
+RESOLVE_RETRY_DELAY = 0.5
+# Столько временных ошибок подряд по одному хосту — и перестаем туда ходить на BREAKER_COOLDOWN секунд
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+# Столько треков подряд не запустилось из-за временных ошибок — останавливаемся, а не крутим очередь
+PLAY_MAX_FAILURES = 5
+
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+
+TRANSIENT_ERROR = re.compile(r"\b(429|5\d\d)\b|timed? ?out|temporar|try again|connection|reset by peer|network|ssl|eof occurred", re.I)
+PERMANENT_ERROR = re.compile(r"\b(404|410)\b|not found|not available|unavailable|private|removed|geo|blocked|copyright|"
+                             r"unsupported url|does not exist|no video formats", re.I)
+
+class TrackUnavailable(Exception):
+    """Трек недавно уже не открылся — ответ из негативного кэша, без похода в сеть."""
+    def __init__(self, url, failure):
+        super().__init__(f"{url}: {failure['error']}")
+        self.kind = failure['kind']
+
+class CircuitOpen(Exception):
+    """Хост сейчас считается лежащим — не ходим туда, пока не истечет пауза."""
+    def __init__(self, host, retry_after):
+        super().__init__(f"{host} временно недоступен, повтор через {retry_after:.0f} с")
+        self.host = host
+        self.retry_after = retry_after
+
+def classify_error(error):
+    """PERMANENT — трек удален, закрыт, недоступен в стране; TRANSIENT — сеть, таймауты, 5xx, все непонятное."""
+    if isinstance(error, TrackUnavailable):
+        return error.kind
+    if isinstance(error, (CircuitOpen, asyncio.TimeoutError, ConnectionError, BrokenProcessPool)):
+        return TRANSIENT
+    message = str(error)
+    if TRANSIENT_ERROR.search(message):
+        return TRANSIENT
+    if PERMANENT_ERROR.search(message):
+        return PERMANENT
+    return TRANSIENT
+
+# canonical_url -> {'kind', 'error'}; общий для всех процессов-шардов
+failed_tracks = TTLCache(FAILED_CACHE_SIZE, TRANSIENT_FAILURE_TTL, shared='failed')
+
+def remember_failure(url, error):
+    kind = classify_error(error)
+    if not isinstance(error, (TrackUnavailable, CircuitOpen)):
+        failed_tracks.put(canonical_url(url), {'kind': kind, 'error': str(error)[:200]},
+                          PERMANENT_FAILURE_TTL if kind == PERMANENT else TRANSIENT_FAILURE_TTL)
+    return kind
+
+def url_host(url):
+    return urllib.parse.urlparse(url).hostname or ''
+
+class HostBreaker:
+    """Автомат по хостам: после серии временных ошибок перестает пускать запросы на время cooldown.
+
+    Когда пауза кончилась, пропускает один пробный запрос: удачный закрывает автомат, неудачный снова открывает.
+    Постоянные ошибки (трек удален) автомат не трогают — хост при этом жив.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {} # хост -> ошибок подряд
+        self.open_until = {} # хост -> до какого момента не пускаем
+        self.trips = 0
+
+    def check(self, host):
+        """Бросает CircuitOpen, если на хост сейчас ходить нельзя."""
+        until = self.open_until.get(host)
+        if until is None:
+            return
+        now = time.monotonic()
+        if now < until:
+            raise CircuitOpen(host, until - now)
+        # Пауза вышла — пробный запрос; до его ответа остальные снова ждут
+        self.open_until[host] = now + self.cooldown
+
+    def success(self, host):
+        self.failures.pop(host, None)
+        self.open_until.pop(host, None)
+
+    def failure(self, host):
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.threshold:
+            if host not in self.open_until:
+                self.trips += 1
+                print(f"Хост {host} не отвечает, пауза {self.cooldown} с")
+            self.open_until[host] = time.monotonic() + self.cooldown
+
+    def retry_after(self, host):
+        return max(0.0, self.open_until.get(host, 0) - time.monotonic())
+
+    def stats(self):
+        now = time.monotonic()
+        return {'open': [host for host, until in self.open_until.items() if until > now], 'trips': self.trips}
+
+host_breaker = HostBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+async def resolve_with_retry(url):
+    """resolve_track с повторами по нарастающей — только для временных ошибок."""
+    for attempt in range(RESOLVE_RETRIES + 1):
+        try:
+            return await resolve_track(url)
+        except Exception as e:
+            if isinstance(e, CircuitOpen) or classify_error(e) == PERMANENT or attempt == RESOLVE_RETRIES:
+                raise
+            await asyncio.sleep(RESOLVE_RETRY_DELAY * 2 ** attempt)
+
+async def skip_failed(guild_id):
+    """Снимает с головы очереди треки из негативного кэша. Возвращает, сколько пропущено.
+
+    Удаленные треки выкидываются насовсем; временно недоступные при включенном цикле уходят в конец очереди.
+    """
+    state = guild_states.get(guild_id)
+    queue = state.queue if state else None
+    skipped = 0
+    # Не больше одного круга: если недоступно все, очередь не крутится бесконечно
+    for _ in range(len(queue) if queue else 0):
+        failure = await failed_tracks.fetch(canonical_url(queue[0].url))
+        # Пока ждали базу, очередь могли очистить
+        if not failure or not queue:
+            break
+        track = queue.popleft()
+        if failure['kind'] == TRANSIENT and state.loop:
+            queue.append(track)
+        skipped += 1
+        metrics.inc('bot_track_skips_total', kind=failure['kind'])
+    return skipped
+
+metrics.describe('bot_track_failures_total', 'counter', 'Треки, которые не удалось запустить, по типу ошибки')
+metrics.describe('bot_track_skips_total', 'counter', 'Треки, пропущенные без попытки (негативный кэш)')
+
+# --- КЭШ ПОИСКОВЫХ ЗАПРОСОВ ---
+# Общий для всех серверов: "!play кино группа крови" в одном сервере ускоряет другой
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 2000))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', 24 * 3600))
+# Если указан файл — кэш переживает перезапуск бота
+SEARCH_CACHE_FILE = os.getenv('SEARCH_CACHE_FILE', '')
+SEARCH_CACHE_SAVE_DELAY = 30
+
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, shared='search')
+search_cache_save_task = None
+
+def normalize_query(query):
+    """Ключ кэша: регистр и лишние пробелы не важны."""
+    return " ".join(query.casefold().split())
+
+def load_search_cache():
+    if SEARCH_CACHE_FILE and os.path.exists(SEARCH_CACHE_FILE):
+        try:
+            with open(SEARCH_CACHE_FILE, "r", encoding="utf-8") as f:
+                search_cache.load(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Не удалось прочитать кэш поиска: {e}")
+
+def save_search_cache():
+    if not SEARCH_CACHE_FILE:
+        return
+    # Пишем во временный файл и подменяем, чтобы при падении не остался обрывок
+    tmp_file = SEARCH_CACHE_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(search_cache.dump(), f, ensure_ascii=False)
+    os.replace(tmp_file, SEARCH_CACHE_FILE)
+
+async def delayed_search_cache_save():
+    global search_cache_save_task
+    await asyncio.sleep(SEARCH_CACHE_SAVE_DELAY)
+    search_cache_save_task = None
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, save_search_cache)
+    except OSError as e:
+        print(f"Не удалось сохранить кэш поиска: {e}")
+
+def remember_search(query, track_info):
+    """Кладет результат поиска в кэш; запись на диск откладывается, чтобы пачка запросов писалась один раз."""
+    global search_cache_save_task
+    search_cache.put(normalize_query(query), track_info)
+    if SEARCH_CACHE_FILE and search_cache_save_task is None:
+        search_cache_save_task = bot.loop.create_task(delayed_search_cache_save())
+
+load_search_cache()
+
+# --- ЛОКАЛЬНЫЙ КЭШ АУДИО ---
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'audio_cache')
+# Сколько места на диске можно занять под кэш (0 — кэш выключен)
+AUDIO_CACHE_MB = int(os.getenv('AUDIO_CACHE_MB', 2048))
+# Закачки живут в своем процессе, чтобы не занимать воркеры, которые ищут ссылки для игры
+AUDIO_CACHE_WORKERS = int(os.getenv('AUDIO_CACHE_WORKERS', 1))
+AUDIO_CACHE_TIMEOUT = 600
+# Каждое проигрывание защищает файл от вытеснения еще на час
+AUDIO_CACHE_HIT_BONUS = 3600
+PRIORITY_CACHE_FILL = 3
+# Берем аудио в исходном виде (лучше всего — opus в webm), без перекодирования
+AUDIO_DOWNLOAD_OPTIONS = {'format': 'bestaudio[acodec=opus]/bestaudio/best', 'quiet': True, 'noplaylist': True}
+# Мусорные параметры, из-за которых одна и та же ссылка выглядит по-разному
+TRACKING_PARAMS = {'si', 'in', 'ref', 'feature', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_content', 'utm_term'}
+# Время старта: поток и файл те же (для кэшей это один трек), но играть ссылку надо с этого места
+PLAYBACK_PARAMS = {'t', 'start'}
+
+def canonical_url(url, keep_playback=False):
+    """Приводит ссылку на трек к единому виду: регистр хоста, хвосты, метки отслеживания.
+
+    По умолчанию это ключ кэшей, и время старта тоже выкидывается; keep_playback=True оставляет его.
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    dropped = TRACKING_PARAMS if keep_playback else TRACKING_PARAMS | PLAYBACK_PARAMS
+    query = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k not in dropped)
+    return urllib.parse.urlunsplit((
+        parts.scheme.lower(),
+        parts.netloc.lower().removeprefix('www.').removeprefix('m.'),
+        parts.path.rstrip('/'),
+        urllib.parse.urlencode(query),
+        '',
+    ))
+
+def is_local_source(source_url):
+    return not source_url.startswith(('http://', 'https://'))
+
+class AudioCache:
+    """Кэш уже закодированного аудио на диске. Ключ — каноническая ссылка на трек.
+
+    Файл скачивается в фоне после первого проигрывания. Когда кэш вылезает за бюджет,
+    выкидываются давно не игравшие файлы, причем часто играемые держатся дольше.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = {} # ключ -> {'url', 'path', 'size', 'duration', 'acodec', 'hits', 'last_used'}
+        self.filling = set()
+        self.downloader = Resolver(AUDIO_CACHE_WORKERS, RESOLVER_QUEUE_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        if not self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for key, entry in store.load('audio_cache').items():
+            if os.path.exists(entry['path']):
+                self.entries[key] = entry
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(canonical_url(url).encode('utf-8')).hexdigest()
+
+    async def lookup(self, url):
+        """Возвращает запись о локальном файле или None."""
+        key = self.key(url)
+        entry = self.entries.get(key)
+        if entry is None and SHARED_CACHE and self.max_bytes:
+            # Файл мог скачать соседний процесс-шард — папка и индекс у нас общие
+            entry = await store.fetch_one('audio_cache', key)
+            if entry:
+                entry = self.entries.setdefault(key, entry)
+        if entry is None or not os.path.exists(entry['path']):
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry['hits'] += 1
+        entry['last_used'] = time.time()
+        store.mark('audio_cache', key, entry)
+        return entry
+
+    def fill(self, url):
+        """Ставит трек на фоновую закачку, если его еще нет в кэше."""
+        if not self.max_bytes:
+            return
+        key = self.key(url)
+        if key in self.entries or key in self.filling:
+            return
+        self.filling.add(key)
+        bot.loop.create_task(self.download(key, url))
+
+    async def download(self, key, url):
+        outtmpl = os.path.join(self.directory, key + '.%(ext)s')
+        # Замок-файл: два процесса-шарда не должны качать один и тот же трек в один файл
+        lock_file = os.path.join(self.directory, key + '.lock')
+        try:
+            lock = os.open(lock_file, os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            # Замок от упавшего процесса не должен блокировать трек навсегда
+            if time.time() - os.path.getmtime(lock_file) < AUDIO_CACHE_TIMEOUT:
+                self.filling.discard(key)
+                return
+            os.remove(lock_file)
+            lock = os.open(lock_file, os.O_CREAT | os.O_EXCL)
+        os.close(lock)
+
+        try:
+            result = await self.downloader.run(ytdl_worker.download, url, (url, outtmpl, AUDIO_DOWNLOAD_OPTIONS),
+                                               PRIORITY_CACHE_FILL, AUDIO_CACHE_TIMEOUT, site='download')
+            if result and os.path.exists(result['path']):
+                entry = {
+                    'url': canonical_url(url),
+                    'path': result['path'],
+                    'size': os.path.getsize(result['path']),
+                    'duration': result['duration'],
+                    'acodec': result.get('acodec'),
+                    'hits': 0,
+                    'last_used': time.time(),
+                }
+                self.entries[key] = entry
+                store.mark('audio_cache', key, entry)
+                # Файл уже на диске — заодно измеряем громкость, без лишнего трафика
+                loudness.analyze(url, result['path'])
+                await self.evict()
+        except Exception as e:
+            print(f"Ошибка загрузки в кэш: {e}")
+        finally:
+            self.filling.discard(key)
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    async def evict(self):
+        if SHARED_CACHE:
+            # Бюджет общий на все процессы — считаем по полному индексу из базы
+            for key, entry in (await store.fetch('audio_cache')).items():
+                self.entries.setdefault(key, entry)
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        by_score = sorted(self.entries.items(), key=lambda item: item[1]['last_used'] + item[1]['hits'] * AUDIO_CACHE_HIT_BONUS)
+        for key, entry in by_score:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue # файл прямо сейчас играет (на Windows его не удалить) — попробуем в другой раз
+            total -= entry['size']
+            del self.entries[key]
+            store.mark('audio_cache', key, None)
+
+    def stats(self):
+        return {
+            'files': len(self.entries),
+            'mb': self.total_bytes() / 1024 / 1024,
+            'hits': self.hits,
+            'misses': self.misses,
+            'filling': len(self.filling),
+        }
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MB * 1024 * 1024)
+audio_cache.load()
+
+# --- ВЫРАВНИВАНИЕ ГРОМКОСТИ ---
+# Треки сильно отличаются по громкости: один раз меряем каждый и подгоняем к общему уровню
+LOUDNESS_NORMALIZE = os.getenv('LOUDNESS_NORMALIZE', '1') == '1'
+LOUDNESS_TARGET = float(os.getenv('LOUDNESS_TARGET', -16)) # LUFS
+LOUDNESS_MAX_GAIN = 12 # дБ, в обе стороны
+# Сколько измерений (процессов FFmpeg) идет одновременно
+LOUDNESS_WORKERS = int(os.getenv('LOUDNESS_WORKERS', 1))
+
+class LoudnessIndex:
+    """Измеренная громкость треков (integrated loudness, LUFS). Ключ — каноническая ссылка, хранится в базе."""
+    def __init__(self):
+        self.values = {}
+        self.pending = set()
+        self.semaphore = None
+
+    def load(self):
+        self.values = {key: entry['lufs'] for key, entry in store.load('loudness').items()}
+
+    async def gain(self, url):
+        """Множитель громкости для трека (1.0 — если трек еще не измерен)."""
+        key = canonical_url(url)
+        lufs = self.values.get(key)
+        if lufs is None and SHARED_CACHE and LOUDNESS_NORMALIZE:
+            # Трек мог измерить соседний процесс-шард
+            entry = await store.fetch_one('loudness', key)
+            if entry:
+                lufs = self.values[key] = entry['lufs']
+        if not LOUDNESS_NORMALIZE or lufs is None:
+            return 1.0
+        gain_db = max(-LOUDNESS_MAX_GAIN, min(LOUDNESS_MAX_GAIN, LOUDNESS_TARGET - lufs))
+        return 10 ** (gain_db / 20)
+
+    def analyze(self, url, source):
+        """Ставит трек на фоновое измерение, если его еще не мерили."""
+        key = canonical_url(url)
+        if not LOUDNESS_NORMALIZE or key in self.values or key in self.pending:
+            return
+        self.pending.add(key)
+        bot.loop.create_task(self.measure(key, source))
+
+    async def measure(self, key, source):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(LOUDNESS_WORKERS)
+        try:
+            async with self.semaphore:
+                # Фоновое измерение не должно отнимать процессор у воспроизведения — ждем, пока есть запас
+                await ffmpeg_manager.admit(timeout=None)
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-hide_banner", "-nostats", "-i", source, "-vn",
+                    "-af", "ebur128=framelog=quiet", "-f", "null", "-",
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+                )
+                ffmpeg_manager.register(process, None, 'loudness')
+                try:
+                    _, stderr = await process.communicate()
+                finally:
+                    ffmpeg_manager.release(process.pid)
+
+            # В конце вывода ebur128 печатает итог: "I: -14.2 LUFS"
+            found = re.findall(r"I:\s+(-?\d+(?:\.\d+)?) LUFS", stderr.decode('utf-8', 'ignore'))
+            if found:
+                self.values[key] = float(found[-1])
+                store.mark('loudness', key, {'lufs': self.values[key]})
+        except Exception as e:
+            print(f"Ошибка измерения громкости: {e}")
+        finally:
+            self.pending.discard(key)
+
+loudness = LoudnessIndex()
+loudness.load()
+
+async def track_gain(guild_volume, url, normalize=True):
+    """Итоговый множитель для фильтра FFmpeg: громкость сервера * поправка трека (normalize=False — без поправки)."""
+    gain = guild_volume * (await loudness.gain(url) if normalize else 1.0)
+    # Разница меньше ~0.5 дБ на слух не заметна, а без фильтра Opus можно не перекодировать
+    return 1.0 if abs(gain - 1.0) < 0.06 else gain
+
+# --- ПРЕДЗАГРУЗКА СЛЕДУЮЩИХ ТРЕКОВ ---
+# Сколько треков из головы очереди подготавливать заранее
+PREFETCH_COUNT = int(os.getenv('PREFETCH_COUNT', 2))
+prefetch_tasks = {} # guild_id -> (задача, список ссылок)
+
+async def prefetch_tracks(urls):
+    """Фоновая задача: по очереди достает прямые ссылки, пока играет текущий трек."""
+    for url in urls:
+        try:
+            await resolve_track(url, PRIORITY_PREFETCH)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ошибка предзагрузки: {e}")
+
+def cancel_prefetch(guild_id):
+    entry = prefetch_tasks.pop(guild_id, None)
+    if entry and not entry[0].done():
+        entry[0].cancel()
+
+def schedule_prefetch(guild_id):
+    """Перенацеливает предзагрузку на текущую голову очереди. Вызывать после любого изменения очереди."""
+    queue = peek_queue(guild_id)
+    if PREFETCH_COUNT <= 0 or not queue:
+        return cancel_prefetch(guild_id)
+
+    urls = [t.url for t in queue[:PREFETCH_COUNT]]
+    entry = prefetch_tasks.get(guild_id)
+    # Голова очереди не поменялась — пусть старая задача спокойно доделает работу
+    if entry and not entry[0].done() and entry[1] == urls:
+        return
+
+    # Старая задача больше не нужна: отменяем, чтобы она не начинала извлекать лишние ссылки
+    cancel_prefetch(guild_id)
+    prefetch_tasks[guild_id] = (bot.loop.create_task(prefetch_tracks(urls)), urls)
+
+# --- ОЧЕРЕДЬ ТРЕКОВ ---
+PENDING_TITLE = "⌛ Ожидает загрузки..."
+# Сколько последних треков помнит кнопка ⏮️
+HISTORY_SIZE = 50
+
+# Сколько совпадений показывает !find
+FIND_LIMIT = 10
+# Нечеткий поиск предлагает только названия, где нашлась хотя бы такая доля триграмм запроса
+FUZZY_MIN_SCORE = 0.5
+
+class Track:
+    """Запись о треке. __slots__ вместо dict — в несколько раз меньше памяти на трек.
+
+    Создавать через intern_track: один и тот же трек во всех очередях — один объект.
+    """
+    __slots__ = ('url', 'title', 'duration', 'uploader', '__weakref__')
+
+    def __init__(self, url, title, duration=0, uploader=None):
+        self.url = url
+        self.title = title
+        self.duration = duration
+        self.uploader = uploader
+
+# Все треки процесса по канонической ссылке. Популярный плейлист в десяти серверах — одни и те же объекты,
+# а название и длительность достаются один раз на всех. Запись пропадает сама, когда трек
+# больше не держит ни одна очередь, история или текущее воспроизведение
+track_store = weakref.WeakValueDictionary()
+
+def intern_track(url, title, duration=0, uploader=None):
+    # Ссылка с ?t= — отдельный трек: иначе она слилась бы с первой попавшейся ссылкой без t и потеряла время старта
+    key = canonical_url(url, keep_playback=True)
+    track = track_store.get(key)
+    if track is None:
+        track = track_store[key] = Track(url, title, duration, uploader)
+        return track
+    # Дополняем то, чего еще не знали: в одном плейлисте есть название, в другом — длительность
+    update_track(
+        track,
+        title=title if track.title == PENDING_TITLE and title != PENDING_TITLE else None,
+        duration=None if track.duration else duration,
+        uploader=uploader,
+    )
+    return track
+
+def update_track(track, title=None, duration=None, uploader=None):
+    """Обновляет метаданные трека — их сразу видят все серверы, у которых он в очереди."""
+    changed = False
+    if title and title != track.title:
+        track.title = title
+        changed = True
+    if duration:
+        track.duration = duration
+    if uploader and not track.uploader:
+        track.uploader = uploader
+        changed = True
+    if changed:
+        # Только индексы, где этот трек есть, а не все серверы подряд
+        for index in list(track_indexes.get(track, ())):
+            index.retitle(track)
+
+# трек -> индексы названий (TitleIndex), где он стоит. Индексы строятся лениво, по !find, поэтому записей мало;
+# обе стороны слабые: выгруженный сервер или забытый трек пропадают отсюда сами
+track_indexes = weakref.WeakKeyDictionary()
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class TitleIndex:
+    """Триграммный индекс очереди для !find: кусок текста -> номера (seq) треков, где он встречается.
+
+    Ищем пересечением самых редких триграмм запроса, а не проходом по всей очереди.
+    Треки с еще не загруженным названием не индексируются, пока подгрузка его не заполнит.
+    """
+    __slots__ = ('grams', 'entries', 'by_track', 'uploaders', '__weakref__')
+
+    def __init__(self):
+        self.grams = {} # триграмма -> {seq}
+        self.entries = {} # seq -> (трек, название в нижнем регистре, число триграмм)
+        self.by_track = {} # id(трека) -> {seq}: один трек может стоять в очереди несколько раз
+        self.uploaders = {} # автор в нижнем регистре -> {seq}
+
+    def add(self, seq, track):
+        seqs = self.by_track.get(id(track))
+        if seqs is None:
+            seqs = self.by_track[id(track)] = set()
+            track_indexes.setdefault(track, weakref.WeakSet()).add(self)
+        seqs.add(seq)
+        if track.uploader:
+            self.uploaders.setdefault(normalize_query(track.uploader), set()).add(seq)
+        if track.title == PENDING_TITLE:
+            self.entries[seq] = (track, '', 0)
+            return
+        title = normalize_query(track.title)
+        grams = trigrams(title)
+        for gram in grams:
+            self.grams.setdefault(gram, set()).add(seq)
+        self.entries[seq] = (track, title, len(grams))
+
+    def remove(self, seq):
+        track, title, _ = self.entries.pop(seq)
+        for gram in trigrams(title):
+            seqs = self.grams[gram]
+            seqs.discard(seq)
+            if not seqs:
+                del self.grams[gram]
+        for key, index in ((id(track), self.by_track), (normalize_query(track.uploader or ''), self.uploaders)):
+            seqs = index.get(key)
+            if seqs is not None:
+                seqs.discard(seq)
+                if not seqs:
+                    del index[key]
+        if id(track) not in self.by_track:
+            indexes = track_indexes.get(track)
+            if indexes is not None:
+                indexes.discard(self)
+
+    def retitle(self, track):
+        """У трека появилось настоящее название (или автор) — переиндексируем все его места в очереди."""
+        for seq in list(self.by_track.get(id(track), ())):
+            self.remove(seq)
+            self.add(seq, track)
+
+    def search(self, query):
+        """Номера треков, в названии которых есть query. Второе значение — False, если совпадения нечеткие."""
+        query = normalize_query(query)
+        grams = trigrams(query)
+        if not grams:
+            # Одна-две буквы: триграмм нет, но и запрос такой редкость
+            return [seq for seq, (_, title, _) in self.entries.items() if query in title], True
+
+        sets = sorted((self.grams.get(gram, ()) for gram in grams), key=len)
+        candidates = set(sets[0]).intersection(*sets[1:])
+        exact = [seq for seq in candidates if query in self.entries[seq][1]]
+        if exact:
+            return exact, True
+
+        # Точных нет — ищем названия, где нашлось больше всего триграмм запроса (опечатки, перестановки слов);
+        # при равенстве выше то, что короче, — в нем запрос занимает большую часть
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+        scored = [(common / len(grams), -self.entries[seq][2], seq) for seq, common in shared.items()
+                  if common >= FUZZY_MIN_SCORE * len(grams)]
+        return [seq for _, _, seq in heapq.nlargest(FIND_LIMIT, scored)], False
+
+    def by_uploader(self, name):
+        name = normalize_query(name)
+        return set().union(*(seqs for uploader, seqs in self.uploaders.items() if name in uploader))
+
+    def memory(self):
+        size = sum(sys.getsizeof(index) for index in (self.grams, self.entries, self.by_track, self.uploaders))
+        for index in (self.grams, self.by_track, self.uploaders):
+            size += sum(sys.getsizeof(seqs) for seqs in index.values())
+        return size + sum(sys.getsizeof(entry) + sys.getsizeof(entry[1]) for entry in self.entries.values())
+
+class TrackQueue:
+    """Очередь на кольцевом буфере: O(1) с обоих концов и O(1) доступ по номеру (для страниц в !queue).
+
+    У каждого места в очереди есть порядковый номер seq, который растет от головы к хвосту и не меняется,
+    пока трек стоит в очереди. По нему индекс названий находит позицию трека бинарным поиском.
+    """
+    __slots__ = ('buf', 'seqs', 'head', 'size', 'version', 'popped', 'top', 'bottom', 'index')
+
+    def __init__(self, tracks=()):
+        self.buf = [None] * 16
+        self.seqs = array('q', bytes(8 * 16))
+        self.head = 0
+        self.size = 0
+        # Растет при изменениях не с концов (удаление, перемешивание, вставка в начало) — тогда снимок
+        # пересохраняет очередь целиком. Снятие с головы и добавление в хвост снимок дописывает по popped и top
+        self.version = 0
+        self.popped = 0 # сколько треков всего снято с головы
+        self.top = 0 # seq для следующего append
+        self.bottom = -1 # seq для следующего appendleft
+        # Индекс названий строится при первом поиске и дальше обновляется по ходу
+        self.index = None
+        for track in tracks:
+            self.append(track)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        buf, head, capacity = self.buf, self.head, len(self.buf)
+        for i in range(self.size):
+            yield buf[(head + i) % capacity]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.buf[(self.head + i) % len(self.buf)] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("индекс за пределами очереди")
+        return self.buf[(self.head + index) % len(self.buf)]
+
+    def grow(self):
+        # Буфер кончился — переезжаем в вдвое больший, заодно разворачивая кольцо
+        capacity = len(self.buf)
+        order = [(self.head + i) % capacity for i in range(self.size)]
+        self.buf = [self.buf[i] for i in order] + [None] * capacity
+        self.seqs = array('q', (self.seqs[i] for i in order)) + array('q', bytes(8 * capacity))
+        self.head = 0
+
+    def append(self, track):
+        if self.size == len(self.buf):
+            self.grow()
+        slot = (self.head + self.size) % len(self.buf)
+        self.buf[slot] = track
+        self.seqs[slot] = self.top
+        if self.index is not None:
+            self.index.add(self.top, track)
+        self.top += 1
+        self.size += 1
+
+    def appendleft(self, track):
+        if self.size == len(self.buf):
+            self.grow()
+        self.head = (self.head - 1) % len(self.buf)
+        self.buf[self.head] = track
+        self.seqs[self.head] = self.bottom
+        if self.index is not None:
+            self.index.add(self.bottom, track)
+        self.bottom -= 1
+        self.size += 1
+        self.version += 1
+
+    def popleft(self):
+        if not self.size:
+            raise IndexError("очередь пуста")
+        track = self.buf[self.head]
+        if self.index is not None:
+            self.index.remove(self.seqs[self.head])
+        self.buf[self.head] = None
+        self.head = (self.head + 1) % len(self.buf)
+        self.size -= 1
+        self.popped += 1
+        return track
+
+    def skip(self, count):
+        """Снимает с головы до count треков за O(count) и возвращает их."""
+        return [self.popleft() for _ in range(min(count, self.size))]
+
+    def clear(self):
+        self.buf = [None] * 16
+        self.seqs = array('q', bytes(8 * 16))
+        self.head = 0
+        self.size = 0
+        self.index = None
+        self.version += 1
+
+    def remove(self, positions):
+        """Убирает треки с номерами из positions за один проход и возвращает их."""
+        positions = set(positions)
+        kept, kept_seqs, removed = [], array('q'), []
+        capacity = len(self.buf)
+        for i in range(self.size):
+            slot = (self.head + i) % capacity
+            if i in positions:
+                removed.append(self.buf[slot])
+                if self.index is not None:
+                    self.index.remove(self.seqs[slot])
+            else:
+                kept.append(self.buf[slot])
+                kept_seqs.append(self.seqs[slot])
+        # Номера seq у оставшихся не трогаем: они по-прежнему растут к хвосту, индекс остается верным
+        self.buf = kept + [None] * (capacity - len(kept))
+        self.seqs = kept_seqs + array('q', bytes(8 * (capacity - len(kept))))
+        self.head = 0
+        self.size = len(kept)
+        self.version += 1
+        return removed
+
+    def seq(self, index):
+        return self.seqs[(self.head + index) % len(self.buf)]
+
+    def position(self, seq):
+        """Позиция трека по его seq — бинарный поиск, потому что seq растут от головы к хвосту."""
+        capacity = len(self.buf)
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.seqs[(self.head + mid) % capacity] < seq:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.size and self.seqs[(self.head + lo) % capacity] == seq:
+            return lo
+        return None
+
+    def get_index(self):
+        if self.index is None:
+            self.index = TitleIndex()
+            capacity = len(self.buf)
+            for i in range(self.size):
+                slot = (self.head + i) % capacity
+                self.index.add(self.seqs[slot], self.buf[slot])
+        return self.index
+
+    def find(self, query, limit=FIND_LIMIT):
+        """Треки с query в названии: [(позиция, трек)] по порядку очереди и флаг точного совпадения."""
+        seqs, exact = self.get_index().search(query)
+        # Точные совпадения показываем по порядку очереди, нечеткие — от самого похожего
+        positions = [self.position(seq) for seq in (heapq.nsmallest(limit, seqs) if exact else seqs[:limit])]
+        return [(i, self[i]) for i in positions], exact
+
+    def find_uploader(self, name):
+        return sorted(self.position(seq) for seq in self.get_index().by_uploader(name))
+
+    def shuffle(self):
+        tracks = list(self)
+        random.shuffle(tracks)
+        self.clear()
+        for track in tracks:
+            self.append(track)
+
+# --- СОСТОЯНИЕ СЕРВЕРОВ ---
+# Сервер без голосового подключения и без команд столько секунд выгружается из памяти (очередь уходит в снимок)
+GUILD_IDLE_TIMEOUT = float(os.getenv('GUILD_IDLE_TIMEOUT', 900))
+# Бот один в голосовом канале столько секунд — выходит сам
+VOICE_ALONE_TIMEOUT = float(os.getenv('VOICE_ALONE_TIMEOUT', 120))
+GUILD_SWEEP_INTERVAL = 30
+
+class GuildState:
+    """Все, что бот держит в памяти про один сервер. Одна запись в guild_states вместо россыпи словарей."""
+    __slots__ = ('guild_id', 'queue', 'history', 'current', 'playback', 'actor',
+                 'now_playing', 'view', 'loop', 'settings', 'ended_at', 'last_active', 'alone_since')
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = TrackQueue()
+        # deque с maxlen — готовое кольцо: старые треки вытесняются сами
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.current = None # трек, который играет сейчас
+        self.playback = None # позиция, прямая ссылка, кодек и источник текущего трека
+        self.actor = PlaybackActor(self) # через него идут все переключения треков
+        self.now_playing = None # карточка "Сейчас играет"
+        self.view = None # ее кнопки
+        self.loop = True # По умолчанию мы считаем, что цикл включен (True)
+        self.settings = None
+        # Когда закончился прошлый трек (не считая перезапусков для перемотки) — для метрики тишины между треками
+        self.ended_at = None
+        self.last_active = time.monotonic()
+        self.alone_since = None # с какого момента в голосовом канале нет никого, кроме бота
+
+    def memory(self):
+        """Примерно, сколько байт держит сервер. Сами треки общие для всех серверов и не считаются."""
+        queue = self.queue
+        size = sys.getsizeof(self) + sys.getsizeof(queue) + sys.getsizeof(queue.buf) + sys.getsizeof(queue.seqs)
+        size += sys.getsizeof(self.history)
+        if queue.index is not None:
+            size += queue.index.memory()
+        if self.playback:
+            size += sys.getsizeof(self.playback)
+        return size
+
+guild_states = {} # guild_id -> GuildState
+
+def get_state(guild_id):
+    """Состояние сервера (создается при первом обращении). Заодно отмечает, что сервер жив."""
+    state = guild_states.get(guild_id)
+    if state is None:
+        state = guild_states[guild_id] = GuildState(guild_id)
+    state.last_active = time.monotonic()
+    return state
+
+def get_queue(guild_id):
+    return get_state(guild_id).queue
+
+def peek_queue(guild_id):
+    """Очередь сервера или None — без создания состояния (для проверок "а есть ли что")."""
+    state = guild_states.get(guild_id)
+    return state.queue if state else None
+
+def get_history(guild_id):
+    return get_state(guild_id).history
+
+def remember_played(guild_id, track):
+    """Кладет трек в историю и, если включен цикл, возвращает его в конец очереди."""
+    state = get_state(guild_id)
+    state.history.append(track)
+    if state.loop:
+        state.queue.append(track)
+
 class QueueView(discord.ui.View):
     def __init__(self, queue_list, playing_now, ctx):
         super().__init__(timeout=60)
@@ -96,7 +1637,7 @@ class QueueView(discord.ui.View):
         embed = discord.Embed(title="📋 Очередь треков", color=discord.Color.blue())
         
         if self.playing_now:
-            embed.add_field(name="🔊 Сейчас играет:", value=self.playing_now['title'], inline=False)
+            embed.add_field(name="🔊 Сейчас играет:", value=self.playing_now.title, inline=False)
 
         if not self.queue_list:
             embed.description = "Очередь пуста."
@@ -106,10 +1647,12 @@ class QueueView(discord.ui.View):
         start = self.current_page * self.per_page
         end = start + self.per_page
         current_list = self.queue_list[start:end]
+        # Названия с открытой страницы подгружаются в первую очередь
+        title_backfill.prioritize(self.ctx.guild.id, start, len(current_list))
 
         queue_text = ""
         for i, t in enumerate(current_list, start + 1):
-            queue_text += f"**{i}.** {t['title']}\n"
+            queue_text += f"**{i}.** {t.title}\n"
 
         embed.add_field(name=f"⏳ Ожидают (стр. {self.current_page + 1}/{self.total_pages}):", value=queue_text, inline=False)
         embed.set_footer(text=f"Всего треков в очереди: {len(self.queue_list)}")
@@ -133,25 +1676,158 @@ class QueueView(discord.ui.View):
             self.current_page += 1
             await interaction.response.edit_message(embed=self.create_embed(), view=self)
         
-async def fetch_missing_titles(tracks):
-    """Фоновая задача: подгружает настоящие названия ВСЕХ треков без остановки бота"""
-    loop = asyncio.get_running_loop()
-    with yt_dlp.YoutubeDL({'quiet': True, 'noplaylist': True}) as ydl:
-        for track in tracks:
-            # Проверяем только те, которые еще не загрузились
-            if track.get('title') == "⌛ Ожидает загрузки...":
-                try:
-                    info = await loop.run_in_executor(None, lambda: ydl.extract_info(track['url'], download=False))
-                    if info:
-                        title = info.get('title')
-                        if not title or title.isdigit():
-                            title = f"{info.get('uploader', 'SoundCloud')} - {info.get('track', 'Трек')}"
-                        track['title'] = title 
-                    
-                    # МАЛЕНЬКАЯ ПАУЗА: чтобы SoundCloud не забанил нас за спам
-                    await asyncio.sleep(0.3) 
-                except Exception:
-                    pass
+# --- ФОНОВАЯ ПОДГРУЗКА НАЗВАНИЙ ---
+# Сколько названий грузим одновременно и сколько запросов в секунду разрешаем на один сайт
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', 3))
+BACKFILL_RATE = float(os.getenv('BACKFILL_RATE', 3))
+BACKFILL_BURST = 5
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate запросов в секунду, с запасом на короткий всплеск."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class TitleBackfill:
+    """Один на весь процесс планировщик подгрузки названий.
+
+    Треки ближе к началу очереди и на открытой странице !queue грузятся первыми,
+    одна и та же ссылка извлекается один раз, а заявки треков, которые ушли из очереди, выбрасываются.
+    """
+    def __init__(self, concurrency, rate, burst):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.heap = [] # (приоритет, порядковый номер, url)
+        self.counter = itertools.count()
+        self.waiting = {} # url -> {'priority', 'tracks': [(guild_id, поколение, seq места в очереди, трек)]}
+        self.running = {} # url -> та же запись, пока идет запрос
+        self.buckets = {} # хост -> TokenBucket
+        self.generations = {} # guild_id -> номер поколения, растет при очистке очереди
+        self.wakeup = None
+        self.workers = []
+
+    def start(self):
+        if self.workers:
+            return
+        self.wakeup = asyncio.Condition()
+        self.workers = [bot.loop.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    def schedule(self, guild_id, start, count, priority_of):
+        queue = peek_queue(guild_id)
+        if queue is None:
+            return
+        self.start()
+        generation = self.generations.get(guild_id, 0)
+        for i in range(start, min(start + count, len(queue))):
+            track = queue[i]
+            if track.title != PENDING_TITLE:
+                continue
+            # Запоминаем место в очереди, а не сам трек: он общий для всех серверов и может стоять в очереди не один раз
+            entry = (guild_id, generation, queue.seq(i), track)
+
+            # Ссылка уже грузится — просто подпишемся на результат
+            job = self.running.get(track.url)
+            if job:
+                if entry not in job['tracks']:
+                    job['tracks'].append(entry)
+                continue
+
+            priority = priority_of(i - start)
+            job = self.waiting.get(track.url)
+            if job is None:
+                job = self.waiting[track.url] = {'priority': None, 'tracks': []}
+            if entry not in job['tracks']:
+                job['tracks'].append(entry)
+            if job['priority'] is not None and priority >= job['priority']:
+                continue
+
+            # Старая запись в куче с худшим приоритетом станет "мусором" и будет пропущена
+            job['priority'] = priority
+            heapq.heappush(self.heap, (priority, next(self.counter), track.url))
+
+        bot.loop.create_task(self.notify())
+
+    async def notify(self):
+        async with self.wakeup:
+            self.wakeup.notify_all()
+
+    def add(self, guild_id, start, count):
+        """Новые треки, которые встали в очередь на позиции start .. start + count - 1."""
+        self.schedule(guild_id, start, count, lambda i: (1, start + i))
+
+    def prioritize(self, guild_id, start, count):
+        """Треки, которые прямо сейчас видны на странице !queue, — вне очереди."""
+        self.schedule(guild_id, start, count, lambda i: (0, i))
+
+    def cancel_guild(self, guild_id):
+        # Не ищем заявки сервера по куче: они отсеются при выборке по номеру поколения
+        self.generations[guild_id] = self.generations.get(guild_id, 0) + 1
+
+    def bucket(self, url):
+        host = urllib.parse.urlparse(url).hostname or ''
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    def alive(self, job):
+        tracks = []
+        for guild_id, generation, seq, track in job['tracks']:
+            if self.generations.get(guild_id, 0) != generation or track.title != PENDING_TITLE:
+                continue
+            # Место пропало — трек убрали (!remove, !dedup, !jump) или он уже заиграл
+            queue = peek_queue(guild_id)
+            if queue is not None and queue.position(seq) is not None:
+                tracks.append(track)
+        return tracks
+
+    async def worker(self):
+        while True:
+            async with self.wakeup:
+                await self.wakeup.wait_for(lambda: self.heap)
+                priority, _, url = heapq.heappop(self.heap)
+
+            job = self.waiting.get(url)
+            if job is None or job['priority'] != priority:
+                continue # устаревшая запись
+            del self.waiting[url]
+
+            # Треки уже удалили из очереди или название пришло из другого места
+            if not self.alive(job):
+                continue
+
+            self.running[url] = job
+            try:
+                await self.bucket(url).take()
+                info = await resolver.extract(url, {'quiet': True, 'noplaylist': True}, PRIORITY_BACKFILL, site='backfill')
+                if info:
+                    title = extract_title(info)
+                    for track in self.alive(job):
+                        update_track(track, title=title, uploader=info.get('uploader'))
+            except Exception:
+                pass
+            finally:
+                del self.running[url]
+
+    def stats(self):
+        return {'waiting': len(self.waiting), 'running': len(self.running)}
+
+title_backfill = TitleBackfill(BACKFILL_CONCURRENCY, BACKFILL_RATE, BACKFILL_BURST)
+
 class PlaybackView(discord.ui.View):
     def __init__(self, ctx):
         super().__init__(timeout=None)
@@ -159,19 +1835,12 @@ class PlaybackView(discord.ui.View):
 
     @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.gray)
     async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        guild_id = self.ctx.guild.id
-        if guild_id not in history_queues or not history_queues[guild_id]:
+        state = get_state(self.ctx.guild.id)
+        if not state.history:
             return await interaction.response.send_message("История пуста!", ephemeral=True)
 
-        prev_track = history_queues[guild_id].pop()
-        current = current_tracks.get(guild_id)
-        if current:
-            queues[guild_id].insert(0, current)
-        
-        queues[guild_id].insert(0, prev_track)
-        
         await interaction.response.defer()
-        self.ctx.voice_client.stop()
+        state.actor.post('previous', self.ctx)
 
     @discord.ui.button(emoji="⏯️", style=discord.ButtonStyle.blurple)
     async def play_pause_button(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -182,30 +1851,35 @@ class PlaybackView(discord.ui.View):
             await interaction.response.send_message("⏸️ Пауза", ephemeral=True)
         elif self.ctx.voice_client.is_paused():
             self.ctx.voice_client.resume()
+            get_state(self.ctx.guild.id).actor.post('unpause', self.ctx)
             await interaction.response.send_message("▶️ Продолжаем", ephemeral=True)
 
     @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.gray)
     async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.ctx.voice_client and (self.ctx.voice_client.is_playing() or self.ctx.voice_client.is_paused()):
             await interaction.response.defer()
-            self.ctx.voice_client.stop()
+            get_state(self.ctx.guild.id).actor.post('skip', self.ctx, 1)
         else:
             await interaction.response.send_message("Ничего не играет.", ephemeral=True)
 
     @discord.ui.button(emoji="🔀", style=discord.ButtonStyle.gray)
     async def shuffle_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         guild_id = self.ctx.guild.id
-        if guild_id in queues and len(queues[guild_id]) > 1:
-            random.shuffle(queues[guild_id])
+        queue = peek_queue(guild_id)
+        if queue and len(queue) > 1:
+            queue.shuffle()
+            # После перемешивания у треков новые места в очереди — старые заявки на названия больше не найдут их
+            title_backfill.add(guild_id, 0, len(queue))
+            schedule_prefetch(guild_id)
             await interaction.response.send_message("🔀 Очередь перемешана!", ephemeral=True)
         else:
             await interaction.response.send_message("Недостаточно треков для перемешивания.", ephemeral=True)
 
     @discord.ui.button(emoji="📋", style=discord.ButtonStyle.gray)
     async def queue_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        guild_id = self.ctx.guild.id
-        playing_now = current_tracks.get(guild_id)
-        queue_list = queues.get(guild_id, [])
+        state = guild_states.get(self.ctx.guild.id)
+        playing_now = state.current if state else None
+        queue_list = state.queue if state else []
 
         if not playing_now and not queue_list:
             return await interaction.response.send_message("Очередь пуста.", ephemeral=True)
@@ -220,162 +1894,1499 @@ class PlaybackView(discord.ui.View):
         else:
             await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# --- ОБНОВЛЕНИЕ СООБЩЕНИЙ ---
+# Discord дает править сообщения в канале примерно 5 раз за 5 секунд. Одно сообщение правим не чаще
+# раза в MESSAGE_EDIT_INTERVAL, а промежуточные состояния (спам !skip, треки, падающие один за другим) выкидываем
+MESSAGE_EDIT_INTERVAL = float(os.getenv('MESSAGE_EDIT_INTERVAL', 1.5))
+
+class MessageUpdater:
+    """Правки сообщений в фоне: на каждый ключ помним только последнее состояние.
+
+    Первая правка уходит сразу, следующие — не раньше чем через interval, и только самая свежая.
+    Если Discord все же ответил 429, канал молчит столько, сколько он попросил в Retry-After.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {} # ключ -> (id канала, корутина-функция, которая делает правку)
+        self.tasks = {}
+        self.blocked = {} # id канала -> до какого момента Discord просил не писать
+        self.sent = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+
+    def submit(self, key, channel_id, render):
+        if key in self.pending:
+            self.coalesced += 1
+        self.pending[key] = (channel_id, render)
+        if key not in self.tasks:
+            self.tasks[key] = bot.loop.create_task(self.worker(key))
+
+    def edit(self, message, **fields):
+        """Неблокирующая замена message.edit: команда не ждет ответа Discord."""
+        self.submit(message.id, message.channel.id, lambda: message.edit(**fields))
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+
+    async def worker(self, key):
+        try:
+            while key in self.pending:
+                channel_id, _ = self.pending[key]
+                wait = self.blocked.get(channel_id, 0) - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                else:
+                    self.blocked.pop(channel_id, None)
+
+                channel_id, render = self.pending.pop(key, (None, None))
+                if render is None:
+                    break
+                try:
+                    await render()
+                    self.sent += 1
+                except discord.NotFound:
+                    pass # сообщение уже удалили
+                except discord.HTTPException as e:
+                    if e.status != 429:
+                        print(f"Ошибка обновления сообщения: {e}")
+                    else:
+                        self.rate_limited += 1
+                        retry_after = float(e.response.headers.get('Retry-After', self.interval))
+                        self.blocked[channel_id] = time.monotonic() + retry_after
+                        # Повторяем, только если за это время не пришло состояние новее
+                        self.pending.setdefault(key, (channel_id, render))
+                await asyncio.sleep(self.interval)
+        finally:
+            self.tasks.pop(key, None)
+
+    def stats(self):
+        return {'sent': self.sent, 'coalesced': self.coalesced, 'rate_limited': self.rate_limited, 'waiting': len(self.pending)}
+
+message_updates = MessageUpdater(MESSAGE_EDIT_INTERVAL)
+
+# Одна панель кнопок на сервер: живет между треками, а не создается заново на каждую карточку
+def get_playback_view(ctx):
+    state = get_state(ctx.guild.id)
+    view = state.view
+    if view is None:
+        view = state.view = PlaybackView(ctx)
+    view.ctx = ctx # кнопки работают с последним каналом, где запускали музыку
+    return view
+
+def show_now_playing(ctx, embed):
+    """Обновляет карточку \"Сейчас играет\" (или присылает новую, если старую удалили)."""
+    state = get_state(ctx.guild.id)
+    view = get_playback_view(ctx)
+
+    async def render():
+        message = state.now_playing
+        if message:
+            try:
+                return await message.edit(embed=embed, view=view)
+            except (discord.NotFound, discord.Forbidden):
+                pass
+        state.now_playing = await ctx.send(embed=embed, view=view)
+
+    message_updates.submit(('now_playing', state.guild_id), ctx.channel.id, render)
+
+async def remove_now_playing(state):
+    """Удаляет карточку "Сейчас играет" (и правку, если она еще ждет отправки)."""
+    message_updates.cancel(('now_playing', state.guild_id))
+    message, state.now_playing = state.now_playing, None
+    if message:
+        try:
+            await message.delete()
+        except discord.HTTPException:
+            pass
+
 # --- 2. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 def get_server_settings(guild_id):
-    if guild_id not in settings:
-        settings[guild_id] = {'shuffle': False, 'repeat': False}
-    return settings[guild_id]
+    state = get_state(guild_id)
+    if state.settings is None:
+        state.settings = {'shuffle': False, 'repeat': False}
+    return state.settings
 # Упрощенные настройки для стабильности на Windows
 FFMPEG_OPTIONS = {
     'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
     'options': '-vn' # Убрали сложные настройки битрейта для теста
 }
+# 1 — если источник уже в Opus, отдаем его в Discord без декодирования и перекодирования
+OPUS_PASSTHROUGH = os.getenv('OPUS_PASSTHROUGH', '1') == '1'
+LOCAL_FFMPEG_OPTIONS = {
+    'before_options': '',
+    'options': '-vn'
+}
 
-async def play_next(ctx, error=None):
-    if error: print(f"Ошибка FFmpeg: {error}")
-    
-    guild_id = ctx.guild.id
-    
-    # 1. Сбрасываем замок обработки, чтобы позволить новый запуск
-    is_processing[guild_id] = False
+# --- ПЕРЕМОТКА ---
+# Discord отдает звук кадрами по 20 мс
+FRAME_SECONDS = 0.02
+# Сколько секунд уже отыгранного звука держим в памяти для мгновенной перемотки назад
+# (1 минута PCM — около 11 МБ на сервер)
+SEEK_BUFFER_SECONDS = int(os.getenv('SEEK_BUFFER_SECONDS', 60))
+
+class SeekStats:
+    """Задержка перемотки: от команды до первого кадра нового звука."""
+    def __init__(self):
+        self.latencies = deque(maxlen=100)
+        self.buffered = 0
+        self.restarts = 0
+
+    def record(self, latency, buffered):
+        # Вызывается из потока плеера — deque.append потокобезопасен
+        self.latencies.append(latency)
+        if buffered:
+            self.buffered += 1
+        else:
+            self.restarts += 1
+        mode = 'buffer' if buffered else 'restart'
+        metrics.observe('bot_seek_seconds', latency, mode=mode)
+        log_event('seek', mode=mode, seconds=round(latency, 3))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'buffered': self.buffered,
+            'restarts': self.restarts,
+            'last_ms': self.latencies[-1] * 1000 if self.latencies else 0.0,
+            'median_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        }
 
-    if not ctx.voice_client or not ctx.voice_client.is_connected():
-        return
+seek_stats = SeekStats()
+
+class TrackedSource(discord.AudioSource):
+    """Обертка над FFmpeg-источником: считает позицию по отданным кадрам и помнит последние кадры.
+
+    Позиция по кадрам, а не по time.time(), поэтому пауза ее не сдвигает.
+    Перемотка назад в пределах буфера просто проигрывает сохраненные кадры заново.
+    """
+    def __init__(self, original, start_offset=0, seek_started=None, mode='pcm', on_start=None):
+        self.original = original
+        self.mode = mode
+        self.start_offset = start_offset
+        self.frames = 0
+        self.history = deque(maxlen=int(SEEK_BUFFER_SECONDS / FRAME_SECONDS))
+        self.replay = deque() # кадры, которые надо отдать повторно после перемотки назад
+        # read() вызывается из потока плеера, перемотка — из цикла событий
+        self.lock = threading.Lock()
+        self.seek_started = seek_started
+        self.seek_buffered = False
+        # Сколько процессора съел поток плеера на этот трек (громкость, кодирование в Opus, отправка)
+        self.player_cpu = 0.0
+        self.last_thread_time = None
+        self.started_at = time.monotonic()
+        # Вызывается один раз, когда в Discord ушел первый кадр (из потока плеера)
+        self.on_start = on_start
+        # Для сторожа потоков: сколько кадров было на прошлой проверке и с какого момента их число не растет
+        self.watch_frames = -1
+        self.watch_since = time.monotonic()
+        self.stalled = False
+        self.eof = False # FFmpeg отдал все кадры
+
+    @property
+    def position(self):
+        return self.start_offset + self.frames * FRAME_SECONDS
+
+    def read(self):
+        # Между двумя вызовами read поток плеера успевает обработать и отправить предыдущий кадр
+        now = time.thread_time()
+        if self.last_thread_time is not None:
+            self.player_cpu += now - self.last_thread_time
+        self.last_thread_time = now
+
+        with self.lock:
+            frame = self.replay.popleft() if self.replay else None
+        fresh = None
+        if frame is None:
+            # Из трубы FFmpeg читаем без блокировки: при зависшей сети read() ждет секундами,
+            # а перемотка из цикла событий ждала бы вместе с ним и морозила весь бот
+            fresh = b'' if self.eof else self.original.read()
+            self.eof = not fresh
+        with self.lock:
+            if fresh is not None:
+                if self.replay:
+                    # Пока ждали FFmpeg, перемотали назад: свежий кадр идет после повторяемых,
+                    # а если FFmpeg уже кончился — сначала доигрываем буфер
+                    if fresh:
+                        self.replay.append(fresh)
+                    frame = self.replay.popleft()
+                else:
+                    frame = fresh
+            if frame:
+                self.history.append(frame)
+                self.frames += 1
+                if self.seek_started is not None:
+                    seek_stats.record(time.perf_counter() - self.seek_started, self.seek_buffered)
+                    self.seek_started = None
+                if self.on_start is not None:
+                    self.on_start()
+                    self.on_start = None
+        return frame
+
+    def seek_frames(self, delta):
+        """Перемотка на delta кадров внутри буфера. Возвращает False, если нужных кадров в памяти нет."""
+        with self.lock:
+            if delta < 0:
+                if -delta > len(self.history):
+                    return False
+                for _ in range(-delta):
+                    self.replay.appendleft(self.history.pop())
+            else:
+                # Вперед можно только по уже прочитанным, но еще не отыгранным повторно кадрам
+                if delta > len(self.replay):
+                    return False
+                for _ in range(delta):
+                    self.history.append(self.replay.popleft())
+            self.frames += delta
+            self.seek_started = time.perf_counter()
+            self.seek_buffered = True
+            return True
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def ffmpeg_pid(self):
+        process = getattr(self.original, '_process', None)
+        return process.pid if process else None
+
+    def abort(self):
+        """Убивает зависший FFmpeg: поток плеера, который ждет от него кадр, сразу получит конец потока."""
+        process = getattr(self.original, '_process', None)
+        if process and process.poll() is None:
+            process.kill()
+
+    def cpu_seconds(self):
+        """Процессорное время на этот поток: FFmpeg + поток плеера в боте."""
+        return self.player_cpu + (process_cpu_seconds(self.ffmpeg_pid()) or 0.0)
+
+    def cleanup(self):
+        # Замер берем до остановки FFmpeg, пока его /proc еще на месте
+        stream_cpu.finish(self)
+        ffmpeg_manager.release(self.ffmpeg_pid())
+        self.original.cleanup()
+        self.history.clear()
+        self.replay.clear()
+
+# --- ЗДОРОВЬЕ ПОТОКОВ ---
+# Подписанная ссылка на поток протухает, и FFmpeg (даже с -reconnect) просто заканчивает трек раньше времени.
+# Трек, оборвавшийся дальше чем за столько секунд до конца, считаем оборванным, а не доигравшим
+STREAM_EOF_TOLERANCE = float(os.getenv('STREAM_EOF_TOLERANCE', 5))
+# Играет, но ни одного нового кадра столько секунд — поток завис
+STREAM_STALL_TIMEOUT = float(os.getenv('STREAM_STALL_TIMEOUT', 10))
+STREAM_CHECK_INTERVAL = 2
+# Больше стольких восстановлений подряд на один трек не делаем — переходим к следующему
+STREAM_MAX_RECOVERIES = 3
+
+class StreamHealth:
+    """Обрывы потоков и восстановления после них: по новой ссылке с той же позиции."""
+    def __init__(self):
+        self.breaks = Counter() # eof / stall / expired -> сколько раз
+        self.recovered = 0
+        self.gave_up = 0
+        self.latencies = deque(maxlen=100)
+
+    def broken(self, guild_id, kind, position, duration):
+        self.breaks[kind] += 1
+        metrics.inc('bot_stream_breaks_total', kind=kind)
+        log_event('stream_break', guild=guild_id, kind=kind, position=round(position, 1), duration=duration)
+
+    def record_recovery(self, guild_id, latency):
+        # Вызывается из потока плеера, как и SeekStats.record
+        self.recovered += 1
+        self.latencies.append(latency)
+        metrics.observe('bot_stream_recovery_seconds', latency)
+        log_event('stream_recovered', guild=guild_id, seconds=round(latency, 3))
+
+    def record_give_up(self, guild_id):
+        self.gave_up += 1
+        metrics.inc('bot_stream_gave_up_total')
+        log_event('stream_gave_up', guild=guild_id)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'eof': self.breaks['eof'],
+            'stall': self.breaks['stall'],
+            'expired': self.breaks['expired'],
+            'recovered': self.recovered,
+            'gave_up': self.gave_up,
+            'median_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        }
 
-    if ctx.voice_client.is_playing() and not is_seeking.get(guild_id):
-        return
+stream_health = StreamHealth()
+
+metrics.describe('bot_stream_breaks_total', 'counter', 'Обрывы потоков: eof — раньше конца трека, stall — завис, expired — ссылка протухла на паузе')
+metrics.describe('bot_stream_recovery_seconds', 'histogram', 'От обрыва потока до первого кадра с новой ссылки')
+metrics.describe('bot_stream_gave_up_total', 'counter', 'Треки, которые не удалось восстановить после обрывов')
+
+def stream_broken(state):
+    """Трек закончился, а играл не до конца: FFmpeg оборвался или его убил сторож. Возвращает вид обрыва или None."""
+    playback = state.playback
+    source = playback.get('source') if playback else None
+    if not source or not state.current:
+        return None
+    if source.stalled:
+        return 'stall'
+    # Локальный файл по новой ссылке не починить, а без длительности не понять, что трек не доиграл
+    duration = state.current.duration
+    if is_local_source(playback['stream_url']) or not duration:
+        return None
+    return 'eof' if source.position < duration - STREAM_EOF_TOLERANCE else None
+
+def stream_expired(state):
+    """Ссылка текущего трека протухла (например, пока стояла пауза)."""
+    stream_url = state.playback.get('stream_url') if state.playback else None
+    expires_at = url_expiry(stream_url) if stream_url and not is_local_source(stream_url) else None
+    return bool(expires_at) and expires_at - time.time() < RESOLVE_EXPIRY_MARGIN
+
+async def stream_watchdog():
+    """Ищет зависшие потоки: плеер играет, а новых кадров нет. Зависший FFmpeg убиваем — актор восстановит трек."""
+    while True:
+        await asyncio.sleep(STREAM_CHECK_INTERVAL)
+        now = time.monotonic()
+        for state in list(guild_states.values()):
+            source = state.playback.get('source') if state.playback else None
+            if not source or source.stalled:
+                continue
+            guild = bot.get_guild(state.guild_id)
+            voice = guild.voice_client if guild else None
+            if not voice or not voice.is_playing() or source.frames != source.watch_frames:
+                # На паузе кадров и не должно быть — отсчет начинается заново
+                source.watch_frames = source.frames
+                source.watch_since = now
+            elif now - source.watch_since >= STREAM_STALL_TIMEOUT:
+                print(f"Поток завис на {source.position:.0f} с, перезапускаю: {state.current.title if state.current else '?'}")
+                source.stalled = True
+                source.abort()
+
+def process_rss_mb(pid):
+    """Память процесса по /proc (только Linux). None, если узнать нельзя."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def process_cpu_seconds(pid):
+    """Процессорное время процесса по /proc (только Linux). None, если узнать нельзя."""
+    if not pid:
+        return None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime и stime — 14-е и 15-е поля, после имени процесса это 12-й и 13-й элементы
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class StreamCpuStats:
+    """Средняя загрузка процессора на один поток — отдельно для PCM и для Opus без перекодирования."""
+    def __init__(self):
+        self.totals = {'pcm': [0.0, 0.0], 'opus': [0.0, 0.0]} # режим -> [секунды CPU, секунды игры]
+
+    def finish(self, source):
+        wall = time.monotonic() - source.started_at
+        if wall > 1:
+            total = self.totals.setdefault(source.mode, [0.0, 0.0])
+            total[0] += source.cpu_seconds()
+            total[1] += wall
+
+    def stats(self, active_sources):
+        result = {}
+        for mode, (cpu, wall) in self.totals.items():
+            for source in active_sources:
+                if source.mode == mode:
+                    cpu += source.cpu_seconds()
+                    wall += time.monotonic() - source.started_at
+            result[mode] = cpu / wall * 100 if wall else None
+        return result
+
+stream_cpu = StreamCpuStats()
+
+# --- УЧЕТ ПРОЦЕССОВ FFMPEG ---
+# Сколько FFmpeg может жить одновременно и сколько процессора им всем можно съесть (100 = одно ядро)
+FFMPEG_MAX_PROCESSES = int(os.getenv('FFMPEG_MAX_PROCESSES', 24))
+FFMPEG_CPU_BUDGET = float(os.getenv('FFMPEG_CPU_BUDGET', 300))
+# Сколько трек ждет свободного места, прежде чем играть в облегченном режиме
+FFMPEG_ADMISSION_TIMEOUT = float(os.getenv('FFMPEG_ADMISSION_TIMEOUT', 3))
+FFMPEG_DEGRADED_BITRATE = 64
+FFMPEG_SAMPLE_INTERVAL = 5
+
+class FFmpegProcess:
+    __slots__ = ('process', 'guild_id', 'kind', 'started_at', 'last_cpu', 'last_sample', 'cpu_percent')
+
+    def __init__(self, process, guild_id, kind):
+        self.process = process
+        self.guild_id = guild_id
+        self.kind = kind
+        self.started_at = time.monotonic()
+        self.last_cpu = process_cpu_seconds(process.pid) or 0.0
+        self.last_sample = self.started_at
+        self.cpu_percent = 0.0
+
+    def alive(self):
+        # subprocess.Popen обновляет returncode только в poll(), у asyncio-процесса он обновляется сам
+        if hasattr(self.process, 'poll'):
+            self.process.poll()
+        return self.process.returncode is None
+
+class FFmpegManager:
+    """Учет всех запущенных FFmpeg: лимит на количество и процессор, уборка сирот, статистика."""
+    def __init__(self, max_processes, cpu_budget):
+        self.max_processes = max_processes
+        self.cpu_budget = cpu_budget
+        self.processes = {} # pid -> FFmpegProcess
+        self.spawned = 0
+        self.failed = 0
+        self.degraded = 0
+        self.reaped = 0
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = bot.loop.create_task(self.monitor())
+
+    def cpu_load(self):
+        return sum(entry.cpu_percent for entry in self.processes.values())
+
+    def over_budget(self):
+        return len(self.processes) >= self.max_processes or self.cpu_load() >= self.cpu_budget
+
+    async def admit(self, timeout=FFMPEG_ADMISSION_TIMEOUT):
+        """Ждет, пока появится место под новый FFmpeg. False — места не дождались (timeout=None — ждать сколько угодно)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.over_budget():
+            if deadline is not None and time.monotonic() >= deadline:
+                self.degraded += 1
+                return False
+            await asyncio.sleep(0.2)
+        return True
+
+    def register(self, process, guild_id, kind):
+        if process is None:
+            return
+        self.processes[process.pid] = FFmpegProcess(process, guild_id, kind)
+        self.spawned += 1
+        metrics.inc('bot_ffmpeg_spawns_total', kind=kind)
+        log_event('ffmpeg_spawn', guild=guild_id, kind=kind, pid=process.pid)
+
+    def release(self, pid):
+        self.processes.pop(pid, None)
+
+    def sample(self):
+        """Обновляет загрузку процессора и выкидывает из учета уже завершившиеся процессы."""
+        now = time.monotonic()
+        for pid, entry in list(self.processes.items()):
+            cpu = process_cpu_seconds(pid)
+            if not entry.alive():
+                self.release(pid)
+                continue
+            if cpu is not None and now > entry.last_sample:
+                entry.cpu_percent = (cpu - entry.last_cpu) / (now - entry.last_sample) * 100
+                entry.last_cpu = cpu
+                entry.last_sample = now
+
+    def reap(self):
+        """Убивает FFmpeg, которые ничего не играют: бот вышел из канала, а процесс остался."""
+        for pid, entry in list(self.processes.items()):
+            if entry.kind == 'loudness':
+                continue
+            guild = bot.get_guild(entry.guild_id)
+            voice = guild.voice_client if guild else None
+            state = guild_states.get(entry.guild_id)
+            info = state.playback if state else None
+            current = info['source'].ffmpeg_pid() if info and info.get('source') else None
+            if voice and voice.is_connected() and current == pid:
+                continue
+            try:
+                entry.process.kill()
+            except ProcessLookupError:
+                pass
+            self.release(pid)
+            self.reaped += 1
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(FFMPEG_SAMPLE_INTERVAL)
+            try:
+                self.sample()
+                self.reap()
+            except Exception as e:
+                print(f"Ошибка учета FFmpeg: {e}")
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'running': len(self.processes),
+            'cpu_percent': self.cpu_load(),
+            'rss_mb': sum(process_rss_mb(pid) or 0.0 for pid in self.processes),
+            'spawned': self.spawned,
+            'failed': self.failed,
+            'degraded': self.degraded,
+            'reaped': self.reaped,
+            'processes': [
+                {
+                    'pid': pid,
+                    'guild_id': entry.guild_id,
+                    'kind': entry.kind,
+                    'cpu_percent': entry.cpu_percent,
+                    'rss_mb': process_rss_mb(pid),
+                    'lifetime': now - entry.started_at,
+                }
+                for pid, entry in self.processes.items()
+            ],
+        }
 
-    # 2. Достаем трек из очереди
-    if is_seeking.get(guild_id):
-        track = current_tracks.get(guild_id)
-        seek_offset = playback_info[guild_id]['seek_offset']
-        is_seeking[guild_id] = False 
-    else:
-        # 1. Вытаскиваем старый трек и сохраняем его в историю
-        old_track = current_tracks.get(guild_id)
-        if old_track:
-            if guild_id not in history_queues: history_queues[guild_id] = []
-            history_queues[guild_id].append(old_track)
-            if len(history_queues[guild_id]) > 50: history_queues[guild_id].pop(0)
-            
-            # ---> МАГИЯ: Возвращаем трек в конец очереди (если включен цикл)
-            # По умолчанию мы считаем, что цикл включен (True)
-            if loop_mode.get(guild_id, True): 
-                if guild_id not in queues: queues[guild_id] = []
-                queues[guild_id].append(old_track)
-
-        # 2. Берем следующий трек на воспроизведение
-        if guild_id in queues and len(queues[guild_id]) > 0:
-            track = queues[guild_id].pop(0)
-            current_tracks[guild_id] = track
-            seek_offset = 0 
+ffmpeg_manager = FFmpegManager(FFMPEG_MAX_PROCESSES, FFMPEG_CPU_BUDGET)
+
+def current_position(guild_id):
+    """Текущая позиция трека в секундах."""
+    state = guild_states.get(guild_id)
+    info = state.playback if state else None
+    if not info:
+        return 0
+    tracker = info.get('source')
+    return tracker.position if tracker else info['seek_offset']
+
+def playback_started(guild_id, title, command=None, invoked_at=None, ended_at=None):
+    """Первый кадр нового трека ушел в Discord: считаем тишину после прошлого и задержку от команды."""
+    now = time.perf_counter()
+    fields = {}
+    if ended_at is not None:
+        fields['gap'] = round(now - ended_at, 3)
+        metrics.observe('bot_track_gap_seconds', now - ended_at)
+    if invoked_at is not None:
+        fields['since_command'] = round(now - invoked_at, 3)
+        metrics.observe('bot_first_audio_seconds', now - invoked_at, command=command)
+    log_event('track_start', guild=guild_id, title=title, command=command, **fields)
+
+# --- УПРАВЛЕНИЕ ВОСПРОИЗВЕДЕНИЕМ ---
+class PlaybackActor:
+    """Почтовый ящик сервера: команды, кнопки и колбэки плеера только кладут сюда сообщения,
+    а одна задача разбирает их по очереди — два переключения трека никогда не идут одновременно.
+
+    Все, что накопилось, пока шло прошлое переключение, разбирается одной пачкой и дает не больше одного
+    нового запуска FFmpeg: десять !skip подряд — один переход, три перемотки — одна перемотка на их сумму.
+
+    Сообщения: start (заиграть, если ничего не играет), ended (трек доиграл или оборвался), skip, previous,
+    seek (сдвиг в секундах), seek_to (позиция), restart (перезапуск FFmpeg с позиции — новая громкость),
+    unpause (снята пауза), resume (трек из снимка),
+    stop, leave (выйти из пустого канала).
+    """
+    __slots__ = ('state', 'mailbox', 'task', 'ctx', 'generation', 'recoveries')
+
+    def __init__(self, state):
+        self.state = state
+        self.mailbox = deque() # (тип, ctx, аргумент, future)
+        self.task = None
+        self.ctx = None # последний канал, откуда управляли музыкой
+        # Растет при каждом переключении: колбэк остановленного нами трека приходит со старым номером и не считается концом трека
+        self.generation = 0
+        self.recoveries = 0 # восстановлений потока подряд у текущего трека
+
+    @property
+    def busy(self):
+        return self.task is not None and not self.task.done()
+
+    def post(self, kind, ctx, arg=None):
+        """Кладет сообщение в ящик. Возвращает future, который завершится, когда сообщение разберут."""
+        future = bot.loop.create_future()
+        self.mailbox.append((kind, ctx, arg, future))
+        metrics.inc('bot_playback_messages_total', kind=kind)
+        if not self.busy:
+            self.task = bot.loop.create_task(self.run())
+        return future
+
+    async def run(self):
+        while self.mailbox:
+            batch = list(self.mailbox)
+            self.mailbox.clear()
+            try:
+                await self.handle(batch)
+            except Exception as e:
+                print(f"Ошибка управления воспроизведением: {e}")
+            finally:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def handle(self, batch):
+        state = self.state
+        transition = None # 'next' — следующий трек, 'seek' — текущий с позиции target, 'recover' — тот же с новой ссылкой
+        target = None
+        broken = None
+        # Перезапустить FFmpeg обязательно, даже если позиция есть в буфере (иначе новая громкость не применится)
+        restart = False
+        # Переход 'next' уже заказан командой (а не концом трека): каждый следующий !skip пропускает еще arg треков
+        advancing = False
+        for kind, ctx, arg, _ in batch:
+            if ctx is not None:
+                self.ctx = ctx
+            voice = self.ctx.voice_client if self.ctx else None
+
+            if kind == 'ended':
+                generation, error, ended_at = arg
+                if error:
+                    print(f"Ошибка FFmpeg: {error}")
+                    ffmpeg_manager.failed += 1
+                    metrics.inc('bot_ffmpeg_failures_total')
+                    log_event('ffmpeg_error', guild=state.guild_id, error=str(error))
+                # Старый номер — этот трек остановили мы сами, переход уже сделан
+                if generation == self.generation and transition is None:
+                    broken = stream_broken(state)
+                    if broken and self.recoveries < STREAM_MAX_RECOVERIES:
+                        transition = 'recover'
+                    else:
+                        if broken:
+                            stream_health.record_give_up(state.guild_id)
+                        state.ended_at = ended_at
+                        transition = 'next'
+            elif kind == 'start':
+                if transition is None and voice and not voice.is_playing() and not voice.is_paused():
+                    transition = 'next'
+                    advancing = True
+            elif kind == 'skip':
+                if not voice or not (voice.is_playing() or voice.is_paused() or transition):
+                    continue
+                # Первый !skip пачки уберет текущий трек сам переходом; следующие снимают треки с головы очереди,
+                # иначе пять !skip подряд сдвигали бы очередь всего на один трек
+                count = arg if transition == 'next' and advancing else arg - 1
+                # Сохраняем пропущенные треки в историю и, если включен повтор очереди, отправляем их в конец списка
+                for skipped_track in state.queue.skip(count):
+                    remember_played(state.guild_id, skipped_track)
+                transition = 'next'
+                advancing = True
+            elif kind == 'previous':
+                if not state.history:
+                    continue
+                if state.current:
+                    state.queue.appendleft(state.current)
+                    # Трек вернулся в очередь — в историю его класть не нужно
+                    state.current = None
+                state.queue.appendleft(state.history.pop())
+                transition = 'next'
+                advancing = True
+            elif kind == 'unpause':
+                # После долгой паузы ссылка могла протухнуть — продолжаем по новой, пока FFmpeg не оборвался сам
+                if transition is None and state.current and stream_expired(state):
+                    broken = 'expired'
+                    transition = 'recover'
+            elif kind == 'resume':
+                # Трек из снимка после перезапуска — продолжаем его с сохраненной позиции
+                if state.current and state.playback:
+                    transition = 'resume'
+            elif kind in ('seek', 'seek_to', 'restart'):
+                # Трек все равно сменится — перематывать нечего
+                if transition == 'next' or not state.current or not state.playback:
+                    continue
+                base = target if target is not None else current_position(state.guild_id)
+                target = max(0, base + arg if kind == 'seek' else arg)
+                transition = 'seek'
+                restart = restart or kind == 'restart'
+            elif kind in ('stop', 'leave'):
+                self.generation += 1
+                transition = target = None
+                advancing = False
+                if kind == 'stop':
+                    await stop_playback(state, voice)
+                elif arg.is_connected():
+                    await leave_empty_channel(state, arg)
+
+        if transition is None:
+            return
+        metrics.inc('bot_playback_transitions_total', kind=transition)
+        if transition != 'recover':
+            self.recoveries = 0
+        if transition == 'recover':
+            await self.recover(broken)
+        elif transition == 'seek':
+            await self.seek(target, restart)
         else:
-            if guild_id in current_tracks: del current_tracks[guild_id]
+            await self.switch(was_seeking=transition == 'resume')
+
+    async def switch(self, was_seeking=False):
+        """Останавливает то, что играет, и запускает следующий трек (или текущий с новой позиции)."""
+        self.generation += 1
+        voice = self.ctx.voice_client
+        if voice and (voice.is_playing() or voice.is_paused()):
+            voice.stop()
+        await play_next(self.ctx, was_seeking)
+
+    async def recover(self, kind):
+        """Тот же трек с той же позиции, но по свежей ссылке: старая протухла или FFmpeg завис."""
+        state = self.state
+        position = current_position(state.guild_id)
+        stream_health.broken(state.guild_id, kind, position, state.current.duration)
+        self.recoveries += 1
+        # Протухшую ссылку забываем везде, иначе resolve_track отдаст ее же из кэша
+        resolve_cache.pop(state.current.url)
+        state.playback.update(stream_url=None, seek_offset=position, seek_started=None,
+                              recovery_started=time.perf_counter())
+        await self.switch(was_seeking=True)
+
+    async def seek(self, position, restart=False):
+        state = self.state
+        # Если пытаемся перемотать дальше конца песни - просто переключаем на следующую
+        duration = state.current.duration
+        if duration and position >= duration - 2:
+            return await self.switch()
+
+        # Назад на пару минут (или вперед после такого отката) — играем из памяти, без FFmpeg и сети
+        tracker = state.playback.get('source')
+        current = current_position(state.guild_id)
+        if not restart and tracker and tracker.seek_frames(round((position - current) / FRAME_SECONDS)):
             return
 
-    is_processing[guild_id] = True
+        # Иначе перезапускаем FFmpeg с нужного места, но по уже известной прямой ссылке
+        state.playback.update(seek_offset=position, seek_started=time.perf_counter(), recovery_started=None)
+        await self.switch(was_seeking=True)
 
-    try:
-        loop = asyncio.get_running_loop()
-        
-        # 3. Извлекаем прямую ссылку. 
-        with yt_dlp.YoutubeDL({**YTDL_OPTIONS, 'noplaylist': True}) as ydl:
-            info = await loop.run_in_executor(None, lambda: ydl.extract_info(track['url'], download=False))
-            real_url = info['url']
-            
-            real_title = info.get('title')
-            if not real_title or real_title.isdigit():
-                uploader = info.get('uploader', 'SoundCloud')
-                track_name = info.get('track', 'Трек')
-                real_title = f"{uploader} - {track_name}"
-
-            # Обновляем инфо в словаре
-            current_tracks[guild_id]['title'] = real_title
-            current_tracks[guild_id]['duration'] = info.get('duration', 0) # <--- СОХРАНЯЕМ ДЛИНУ ПЕСНИ
-            title = real_title 
-
-        playback_info[guild_id] = {'start_time': time.time(), 'seek_offset': seek_offset}
-        
-        ffmpeg_params = dict(FFMPEG_OPTIONS)
-        if seek_offset > 0:
-            # <--- ФИКС FFmpeg: ставим -ss целым числом В САМОЕ НАЧАЛО настроек!
-            # Это решает проблему зависания и ошибок декодирования
-            ffmpeg_params['before_options'] = f"-ss {int(seek_offset)} {FFMPEG_OPTIONS['before_options']}"
+metrics.describe('bot_playback_messages_total', 'counter', 'Сообщения акторам воспроизведения по типу')
+metrics.describe('bot_playback_transitions_total', 'counter', 'Реальные переключения треков (после схлопывания сообщений)')
+
+async def stop_playback(state, voice):
+    """!stop: очередь, текущий трек и фоновые задачи сервера — все долой, бот выходит из канала."""
+    guild_id = state.guild_id
+    cancel_playlist_imports(guild_id)
+    state.queue.clear()
+    cancel_prefetch(guild_id)
+    title_backfill.cancel_guild(guild_id)
+    state.current = None
+    state.playback = None
+
+    # ---> УДАЛЯЕМ СООБЩЕНИЕ <---
+    await remove_now_playing(state)
+
+    if voice:
+        await voice.disconnect()
+
+async def play_next(ctx, was_seeking=False):
+    """Запускает следующий трек очереди, а с was_seeking — текущий с позиции из state.playback.
+
+    Вызывает только PlaybackActor сервера: он же перед этим останавливает то, что играло.
+    """
+    guild_id = ctx.guild.id
+    state = get_state(guild_id)
+    actor = state.actor
+
+    # Если дальше трек не запустится (очередь кончилась, бота выгнали), тишина не считается
+    ended_at, state.ended_at = state.ended_at, None
+
+    if not ctx.voice_client or not ctx.voice_client.is_connected():
+        return
+
+    # Команда (play, playlist, ...), которая запустила музыку, — считаем ей время до первого звука один раз
+    invoked_at = getattr(ctx, 'invoked_at', None)
+    ctx.invoked_at = None
+    # Нерабочие треки пропускаем циклом, без рекурсии и пауз; временные сбои подряд ограничены
+    skipped = 0
+    failures = 0
+
+    while ctx.voice_client and ctx.voice_client.is_connected():
+        # 2. Достаем трек из очереди
+        stream_url = None
+        seek_started = None
+        recovery_started = None
+        if was_seeking:
+            track = state.current
+            seek_offset = state.playback['seek_offset']
+            seek_started = state.playback.get('seek_started')
+            recovery_started = state.playback.get('recovery_started')
+            # Ссылка на поток уже есть — при перемотке не ходим за ней заново, пока она не протухла
+            stream_url = state.playback.get('stream_url')
+            codec = state.playback.get('codec')
+            expires_at = url_expiry(stream_url) if stream_url else None
+            if expires_at and expires_at - time.time() < RESOLVE_EXPIRY_MARGIN:
+                stream_url = None
+        else:
+            # Заведомо нерабочие треки (недавно не открылись) пропускаем сразу, без похода в сеть
+            skipped += await skip_failed(guild_id)
+            # 1. Вытаскиваем старый трек и сохраняем его в историю
+            old_track = state.current
+            if old_track:
+                # ---> МАГИЯ: Возвращаем трек в конец очереди (если включен цикл)
+                remember_played(guild_id, old_track)
+
+            # 2. Берем следующий трек на воспроизведение
+            if state.queue:
+                track = state.queue.popleft()
+                state.current = track
+                seek_offset = 0 
+            else:
+                state.current = None
+                break
+
+        try:
+            # 3. Ищем трек в локальном кэше, иначе извлекаем прямую ссылку (повторы и ⏮️ берут ее из кэша)
+            local = None if stream_url else await audio_cache.lookup(track.url)
+            if stream_url:
+                real_url = stream_url
+            elif local:
+                real_url = local['path']
+                codec = local.get('acodec')
+                track.duration = track.duration or local['duration']
+            else:
+                resolved = await resolve_with_retry(track.url)
+                real_url = resolved['url']
+                codec = resolved.get('acodec')
+
+                # Обновляем инфо о треке (и заодно у всех серверов, где он стоит в очереди)
+                update_track(track, resolved['title'], resolved['duration'], resolved.get('uploader')) # <--- СОХРАНЯЕМ ДЛИНУ ПЕСНИ
+
+                # Трек играет первый раз — параллельно скачиваем его, чтобы в следующий раз играть с диска
+                audio_cache.fill(track.url)
+            title = track.title
+
+            # Громкость трека еще не измеряли — измерим в фоне (с диска, если он уже скачан)
+            if local:
+                loudness.analyze(track.url, local['path'])
+            elif not stream_url and not audio_cache.max_bytes:
+                loudness.analyze(track.url, real_url)
+
+            # Локальному файлу не нужны сетевые -reconnect флаги
+            ffmpeg_params = dict(LOCAL_FFMPEG_OPTIONS if is_local_source(real_url) else FFMPEG_OPTIONS)
+            if seek_offset > 0:
+                # <--- ФИКС FFmpeg: ставим -ss В САМОЕ НАЧАЛО настроек!
+                # Это решает проблему зависания и ошибок декодирования.
+                # Позицию передаем с миллисекундами: после восстановления потока или перемотки
+                # целое число повторяло бы до секунды звука, а позиция по кадрам разошлась бы с реальной
+                seek_offset = round(seek_offset, 3)
+                ffmpeg_params['before_options'] = f"-ss {seek_offset:.3f} {ffmpeg_params['before_options']}"
             
-        # Базовый источник звука
-        base_source = discord.FFmpegPCMAudio(real_url, executable="ffmpeg", **ffmpeg_params)
-        
-        # Достаем сохраненную громкость (по умолчанию 1.0, то есть 100%)
-        # JSON хранит ключи как строки, поэтому переводим guild_id в строку
-        guild_str = str(guild_id)
-        current_vol = persistent_settings.get(guild_str, {}).get("volume", 1.0)
-        
-        # Оборачиваем звук в трансформатор громкости
-        source = discord.PCMVolumeTransformer(base_source, volume=current_vol)
+            # Достаем сохраненную громкость (по умолчанию 1.0, то есть 100%)
+            # JSON хранит ключи как строки, поэтому переводим guild_id в строку
+            guild_str = str(guild_id)
+            current_vol = persistent_settings.get(guild_str, {}).get("volume", 1.0)
+
+            # Хост перегружен FFmpeg-ами — ждем свободного места, а если не дождались, играем в облегченном режиме
+            full_quality = await ffmpeg_manager.admit()
+
+            # Громкость сервера и выравнивание громкости трека делает сам FFmpeg, а не Python на каждом кадре
+            # (в облегченном режиме не выравниваем громкость трека, но !vol сервера остается)
+            gain = await track_gain(current_vol, track.url, normalize=full_quality)
+            if gain != 1.0:
+                ffmpeg_params['options'] = f"{ffmpeg_params['options']} -af volume={gain:.3f}"
+
+            # Обертка над источником считает позицию и помнит последние кадры для перемотки
+            if (OPUS_PASSTHROUGH and codec == 'opus') or not full_quality:
+                # Источник уже в Opus: без фильтра громкости отдаем пакеты в Discord как есть,
+                # иначе в Opus кодирует FFmpeg — все равно без PCM и перекодирования в Python
+                base_source = discord.FFmpegOpusAudio(
+                    real_url,
+                    codec='copy' if codec == 'opus' and gain == 1.0 else None,
+                    bitrate=None if full_quality else FFMPEG_DEGRADED_BITRATE,
+                    executable="ffmpeg",
+                    **ffmpeg_params
+                )
+                mode = 'opus'
+            else:
+                base_source = discord.FFmpegPCMAudio(real_url, executable="ffmpeg", **ffmpeg_params)
+                mode = 'pcm'
+            on_start = None
+            if not was_seeking:
+                command = ctx.command.name if invoked_at and ctx.command else None
+                on_start = lambda: playback_started(guild_id, title, command, invoked_at, ended_at)
+            elif recovery_started:
+                on_start = lambda: stream_health.record_recovery(guild_id, time.perf_counter() - recovery_started)
+            source = TrackedSource(base_source, seek_offset, seek_started, mode=mode, on_start=on_start)
+
+            state.playback = {'seek_offset': seek_offset, 'stream_url': real_url, 'codec': codec, 'source': source}
+            ffmpeg_manager.register(source.original._process, guild_id, 'playback' if full_quality else 'degraded')
         
-        def after_playing(e):
-            is_processing[guild_id] = False
-            asyncio.run_coroutine_threadsafe(play_next(ctx, e), bot.loop)
+            # Колбэк приходит из потока плеера — только кладем сообщение в ящик актора
+            generation = actor.generation
+            def after_playing(e):
+                bot.loop.call_soon_threadsafe(actor.post, 'ended', ctx, (generation, e, time.perf_counter()))
 
-        ctx.voice_client.play(source, after=after_playing)
-        is_processing[guild_id] = False
+            ctx.voice_client.play(source, after=after_playing)
+
+            # Пока играет этот трек — готовим ссылки для следующих
+            schedule_prefetch(guild_id)
         
-        # 4. Отправляем или обновляем карточку
-        if not is_seeking.get(guild_id):
-            embed = discord.Embed(
-                description=f"🎶 **Сейчас играет:**\n**{title}**", 
-                color=discord.Color.green()
-            )
-            
-            # Создаем нашу новую панель с 5 кнопками
-            view = PlaybackView(ctx) 
-            
-            old_message = now_playing_messages.get(guild_id)
-            if old_message:
-                try:
-                    await old_message.edit(embed=embed, view=view)
-                except:
-                    now_playing_messages[guild_id] = await ctx.send(embed=embed, view=view)
-            else:
-                now_playing_messages[guild_id] = await ctx.send(embed=embed, view=view)
+            # 4. Отправляем или обновляем карточку (после перемотки трек тот же — карточку не трогаем)
+            if not was_seeking:
+                embed = discord.Embed(
+                    description=f"🎶 **Сейчас играет:**\n**{title}**", 
+                    color=discord.Color.green()
+                )
+                # Правка уходит в фоне: следующий трек не ждет Discord, а частые смены схлопываются
+                show_now_playing(ctx, embed)
+            break
             
-    except Exception as e:
-        print(f"Ошибка при попытке играть: {e}")
-        is_processing[guild_id] = False
-        # В случае ошибки ждем 2 секунды и идем к следующему треку
-        await asyncio.sleep(2)
-        await play_next(ctx)
+        except CircuitOpen as e:
+            print(f"Ошибка при попытке играть: {e}")
+            if was_seeking:
+                # Следующий трек, скорее всего, с того же хоста — продолжим этот же с той же позиции, когда автомат отпустит
+                state.playback.update(source=None, seek_started=None, recovery_started=None)
+                bot.loop.call_later(e.retry_after + 0.1, actor.post, 'resume', ctx)
+                break
+            # Источник лежит целиком — нет смысла перебирать его треки; возвращаем трек и ждем паузу автомата
+            state.queue.appendleft(track)
+            state.current = None
+            if ended_at is not None:
+                state.ended_at = ended_at
+            bot.loop.call_later(e.retry_after + 0.1, actor.post, 'start', ctx)
+            break
+        except Exception as e:
+            print(f"Ошибка при попытке играть: {e}")
+            was_seeking = False
+            kind = remember_failure(track.url, e)
+            metrics.inc('bot_play_errors_total')
+            metrics.inc('bot_track_failures_total', kind=kind)
+            log_event('track_failed', guild=guild_id, url=track.url, kind=kind, error=str(e))
+            skipped += 1
+            # Незаигравший трек не считается сыгранным: в историю его не кладем. Мертвый пропадает совсем,
+            # временно недоступный при включенном цикле уходит в конец очереди (как в skip_failed)
+            state.current = None
+            if kind == PERMANENT:
+                continue
+            if state.loop:
+                state.queue.append(track)
+            failures += 1
+            if failures >= PLAY_MAX_FAILURES:
+                # Сеть лежит — не крутим очередь по кругу, ждем следующей команды
+                print(f"Подряд {failures} треков не запустились, останавливаем воспроизведение")
+                await ctx.send(embed=discord.Embed(
+                    description="❌ Треки подряд не запускаются — похоже, источник недоступен. Попробуйте позже.",
+                    color=discord.Color.red()))
+                skipped = 0
+                break
+
+    if skipped:
+        await ctx.send(f"⚠️ Пропущено недоступных треков: {skipped}", delete_after=10)
 
 async def seek_music(ctx, delta_seconds: int):
-    guild_id = ctx.guild.id
     if not ctx.voice_client or not ctx.voice_client.is_playing():
         await ctx.send(embed=discord.Embed(description="❌ Сейчас ничего не играет.", color=discord.Color.red()))
         return
-        
-    if guild_id not in current_tracks or guild_id not in playback_info: return
-        
-    elapsed = time.time() - playback_info[guild_id]['start_time']
-    current_position = playback_info[guild_id]['seek_offset'] + elapsed
-    
-    # 1. Защита от ухода в минус
-    new_position = max(0, current_position + delta_seconds)
-    
-    # 2. Если пытаемся перемотать дальше конца песни - просто переключаем на следующую
-    duration = current_tracks[guild_id].get('duration', 0)
-    if duration and new_position >= duration - 2:
-        is_seeking[guild_id] = False # Отменяем статус перемотки
-        ctx.voice_client.stop() # Остановка вызовет play_next автоматически
+    # Несколько перемоток подряд актор сложит в одну
+    get_state(ctx.guild.id).actor.post('seek', ctx, delta_seconds)
+
+def restart_playback(ctx, position):
+    """Перезапускает текущий трек с позиции position (например, чтобы применить новую громкость)."""
+    get_state(ctx.guild.id).actor.post('restart', ctx, position)
+
+# --- СНИМКИ СОСТОЯНИЯ ---
+# Раз в SNAPSHOT_INTERVAL секунд сохраняем очередь и позицию каждого активного сервера,
+# чтобы после перезапуска не заставлять людей заново грузить плейлисты
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', 15))
+# 1 — после перезапуска сам заходит в голосовые каналы и продолжает с того же места
+RESTORE_ON_STARTUP = os.getenv('RESTORE_ON_STARTUP', '0') == '1'
+
+# guild_id -> (version, top, popped) очереди на момент, когда ее целиком записали на диск
+snapshot_versions = {}
+# Сколько добавленных в хвост треков дописываем в заголовок, прежде чем пересохранить всю очередь
+SNAPSHOT_TAIL_LIMIT = 256
+snapshot_headers = {} # guild_id -> последний сохраненный заголовок
+pending_restore = set() # серверы со снимком, которые еще не подняты в память
+snapshot_task = None
+
+def pack_track(track):
+    return [track.url, track.title, track.duration, track.uploader]
+
+def unpack_track(data):
+    return intern_track(*data)
+
+def snapshot_header(guild_id):
+    """Маленькая часть снимка: текущий трек, позиция, история, каналы. Пишется часто."""
+    state = guild_states[guild_id]
+    current = state.current
+    guild = bot.get_guild(guild_id)
+    voice = guild.voice_client if guild else None
+    message = state.now_playing
+    return {
+        'current': pack_track(current) if current else None,
+        'position': round(current_position(guild_id), 1) if current else 0,
+        'loop': state.loop,
+        'history': [pack_track(t) for t in state.history],
+        'voice': voice.channel.id if voice and voice.channel else None,
+        'text': message.channel.id if message else None,
+    }
+
+def take_snapshots():
+    """Один проход: сохраняет только то, что поменялось с прошлого раза."""
+    for guild_id in set(guild_states) | set(snapshot_headers):
+        # Сервер еще не поднят из старого снимка — его данные на диске и так актуальны
+        if guild_id not in pending_restore:
+            snapshot_guild(guild_id)
+
+def snapshot_guild(guild_id):
+    guild_str = str(guild_id)
+    state = guild_states.get(guild_id)
+    if not state or (not state.queue and not state.current):
+        # Все остановили — снимок больше не нужен
+        if guild_id in snapshot_headers:
+            store.mark('snapshot', guild_str, None)
+            store.mark('snapshot_queue', guild_str, None)
+            del snapshot_headers[guild_id]
+            snapshot_versions.pop(guild_id, None)
+        return
+
+    # Очередь может быть на сотни тысяч треков — целиком и сжатой пересохраняем ее, только если ее меняли
+    # не с концов. Сыгранные треки с головы и добавленные в хвост записываются в заголовок
+    queue = state.queue
+    saved = snapshot_versions.get(guild_id)
+    appended = queue.top - saved[1] if saved and saved[0] == queue.version else None
+    if appended is None or appended > SNAPSHOT_TAIL_LIMIT:
+        saved = snapshot_versions[guild_id] = (queue.version, queue.top, queue.popped)
+        appended = 0
+        packed = json.dumps([pack_track(t) for t in queue], ensure_ascii=False)
+        store.mark('snapshot_queue', guild_str, zlib.compress(packed.encode('utf-8')))
+
+    header = snapshot_header(guild_id)
+    # Сначала из сохраненной очереди выкидываем queue_skip треков с головы, потом дописываем queue_tail
+    header['queue_skip'] = queue.popped - saved[2]
+    header['queue_tail'] = [pack_track(t) for t in queue[max(0, len(queue) - appended):]] if appended else []
+    if header != snapshot_headers.get(guild_id):
+        snapshot_headers[guild_id] = header
+        store.mark('snapshot', guild_str, header)
+
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            take_snapshots()
+        except Exception as e:
+            print(f"Ошибка снимка состояния: {e}")
+
+restoring = {} # guild_id -> задача, которая прямо сейчас поднимает снимок сервера
+
+async def restore_state(guild_id):
+    """Поднимает сохраненное состояние сервера в память (лениво — только когда сервер понадобился).
+
+    Заголовок снимка получает только первый вызов; остальные ждут, пока очередь поднимется, и получают None.
+    """
+    task = restoring.get(guild_id)
+    if task is None:
+        if guild_id not in pending_restore:
+            return None
+        pending_restore.discard(guild_id)
+        task = restoring[guild_id] = bot.loop.create_task(load_state(guild_id))
+        task.add_done_callback(lambda _: restoring.pop(guild_id, None))
+        # Команда может отмениться, а поднятие очереди — нет
+        return await asyncio.shield(task)
+    await asyncio.shield(task)
+    return None
+
+def unpack_queue(packed):
+    return json.loads(zlib.decompress(packed).decode('utf-8')) if packed else []
+
+async def load_state(guild_id):
+    guild_str = str(guild_id)
+    header = await store.fetch_one('snapshot', guild_str)
+    packed = await store.fetch_one('snapshot_queue', guild_str)
+    if not header:
+        return None
+    # Очередь может быть на сотни тысяч треков — распаковываем ее не в цикле событий
+    saved = await asyncio.get_running_loop().run_in_executor(None, unpack_queue, packed)
+
+    state = get_state(guild_id)
+    queue = state.queue
+    for data in saved[header.get('queue_skip', 0):] + header.get('queue_tail', []):
+        queue.append(unpack_track(data))
+
+    for data in header['history']:
+        state.history.append(unpack_track(data))
+    state.loop = header['loop']
+
+    # Названия, которые так и не успели загрузиться, догружаем заново
+    title_backfill.add(guild_id, 0, len(queue))
+    snapshot_headers[guild_id] = header
+    # Очередь на диске еще с пропусками и хвостом из заголовка — следующий снимок запишет ее заново
+    snapshot_versions.pop(guild_id, None)
+    return header
+
+class RestoredContext:
+    """Замена commands.Context для воспроизведения, восстановленного без команды пользователя."""
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.author = None
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+async def resume_guild(guild_id):
+    """Заходит в тот же голосовой канал и продолжает трек с сохраненной позиции."""
+    guild = bot.get_guild(guild_id)
+    if not guild:
+        return
+    header = await restore_state(guild_id)
+    if not header or not header['current'] or not header['voice'] or not header['text']:
+        # Играть нечего или некуда — текущий трек просто становится первым в очереди
+        if header and header['current']:
+            get_queue(guild_id).appendleft(unpack_track(header['current']))
         return
 
-    playback_info[guild_id]['seek_offset'] = new_position
-    is_seeking[guild_id] = True
-    ctx.voice_client.stop()
+    voice_channel = guild.get_channel(header['voice'])
+    text_channel = guild.get_channel(header['text'])
+    if not voice_channel or not text_channel:
+        get_queue(guild_id).appendleft(unpack_track(header['current']))
+        return
+
+    await voice_channel.connect()
+    ctx = RestoredContext(guild, text_channel)
+    state = get_state(guild_id)
+    state.current = unpack_track(header['current'])
+    state.playback = {'seek_offset': header['position']}
+    await ctx.send(embed=discord.Embed(description=f"♻️ **Продолжаю после перезапуска:** {state.current.title}", color=discord.Color.blue()))
+    await state.actor.post('resume', ctx)
+
+# --- ЗДОРОВЬЕ ПРОЦЕССА ---
+# Каждый процесс-шард раз в HEALTH_INTERVAL секунд пишет в общую базу свою нагрузку (видно в !shards и в launcher.py)
+HEALTH_INTERVAL = 15
+# Процесс, который молчит дольше этого, считаем зависшим
+HEALTH_STALE_AFTER = HEALTH_INTERVAL * 4
+
+health_sample = [time.monotonic(), 0.0] # [когда, сколько CPU было у процесса]
+
+def shard_health():
+    now = time.monotonic()
+    cpu = sum(os.times()[:2])
+    cpu_percent = (cpu - health_sample[1]) / (now - health_sample[0]) * 100 if now > health_sample[0] else 0.0
+    health_sample[:] = [now, cpu]
+
+    latency = bot.latency
+    return {
+        'pid': os.getpid(),
+        'shards': SHARD_IDS or list(range(SHARD_COUNT or 1)),
+        'guilds': len(bot.guilds),
+        'voice_clients': len(bot.voice_clients),
+        'playing': sum(1 for voice in bot.voice_clients if voice.is_playing()),
+        'queued_tracks': sum(len(state.queue) for state in guild_states.values()),
+        'ffmpeg': len(ffmpeg_manager.processes),
+        'latency_ms': round(latency * 1000) if math.isfinite(latency) else None,
+        'cpu_percent': round(cpu_percent, 1),
+        'rss_mb': process_rss_mb(os.getpid()),
+        'updated': time.time(),
+    }
+
+async def health_loop():
+    while True:
+        try:
+            store.put_health(SHARD_LABEL, shard_health())
+        except Exception as e:
+            print(f"Ошибка отчета о здоровье: {e}")
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+@metrics.collector
+def playback_gauges():
+    samples = [
+        ('bot_voice_clients', {}, len(bot.voice_clients)),
+        ('bot_ffmpeg_processes', {}, len(ffmpeg_manager.processes)),
+        ('bot_resolver_queued', {}, resolver.stats()['queued']),
+        ('bot_guild_states', {}, len(guild_states)),
+    ]
+    for guild_id, state in guild_states.items():
+        samples.append(('bot_queue_length', {'guild': guild_id}, len(state.queue)))
+    for voice in bot.voice_clients:
+        samples.append(('bot_voice_playing', {'guild': voice.guild.id}, int(voice.is_playing())))
+    return samples
+
+metrics.describe('bot_voice_clients', 'gauge', 'Подключений к голосовым каналам')
+metrics.describe('bot_ffmpeg_processes', 'gauge', 'Живых процессов FFmpeg')
+metrics.describe('bot_resolver_queued', 'gauge', 'Заявок в очереди пула извлечения')
+metrics.describe('bot_guild_states', 'gauge', 'Серверов, чье состояние сейчас в памяти')
+metrics.describe('bot_queue_length', 'gauge', 'Треков в очереди сервера')
+metrics.describe('bot_voice_playing', 'gauge', 'Играет ли сейчас бот на сервере (1/0)')
+
+# --- ЗАГРУЗКА ПЛЕЙЛИСТОВ ---
+# Плейлист читаем страницами: первая маленькая, чтобы музыка заиграла сразу, остальное дозагружается в фоне
+PLAYLIST_FIRST_PAGE = int(os.getenv('PLAYLIST_FIRST_PAGE', 10))
+PLAYLIST_PAGE_SIZE = int(os.getenv('PLAYLIST_PAGE_SIZE', 100))
+# Больше стольких треков из одного плейлиста не берем (можно и меньше: !playlist <ссылка> 200)
+PLAYLIST_MAX_TRACKS = int(os.getenv('PLAYLIST_MAX_TRACKS', 5000))
+PLAYLIST_OPTIONS = {
+    'extract_flat': True,
+    'noplaylist': False,
+    'quiet': True,
+}
+
+# Сохраненный состав плейлиста моложе этого не сверяем с источником при !replay
+PLAYLIST_REFRESH_AFTER = float(os.getenv('PLAYLIST_REFRESH_AFTER', 600))
+# Сколько плейлистов помнит !history на сервер
+PLAYLIST_HISTORY_SIZE = 10
+
+playlist_imports = {} # guild_id -> {задачи дозагрузки}
+
+async def fetch_playlist_page(url, start, count, priority=PRIORITY_NOW):
+    """Записи плейлиста с номерами start..start+count-1 (с единицы) и сам ответ yt-dlp."""
+    options = {**PLAYLIST_OPTIONS, 'playlist_items': f"{start}-{start + count - 1}"}
+    # Большие плейлисты читаются долго, поэтому таймаут побольше
+    data = await resolver.extract(url, options, priority, timeout=RESOLVE_TIMEOUT * 4, site='playlist')
+    if not data or 'entries' not in data:
+        return None, data
+    entries = list(data['entries'])
+    if len(entries) > count:
+        # Экстрактор не умеет отдавать страницы и вернул весь плейлист — вырезаем нужный кусок сами
+        entries = entries[start - 1:start - 1 + count]
+    return entries, data
+
+def playlist_tracks(entries):
+    tracks = []
+    for entry in entries:
+        if not entry: continue
+
+        title = entry.get('title')
+        if not title or title.isdigit():
+            title = PENDING_TITLE
+
+        url = entry.get('url') or entry.get('webpage_url')
+        if url:
+            tracks.append(intern_track(url, title, entry.get('duration') or 0, entry.get('uploader')))
+    return tracks
+
+def enqueue_playlist_tracks(guild_id, tracks):
+    queue = get_queue(guild_id)
+    for track in tracks:
+        queue.append(track)
+    # Названия подгружаем только у только что добавленных треков
+    title_backfill.add(guild_id, len(queue) - len(tracks), len(tracks))
+
+async def import_playlist_rest(guild_id, url, title, message, start, tracks, limit):
+    """Дозагружает плейлист страницами, пока он не кончится или не упрется в limit.
+
+    tracks — уже добавленные треки плейлиста; дочитанный до конца плейлист сохраняется для !replay.
+    """
+    def status(text, color):
+        message_updates.edit(message, embed=discord.Embed(description=text, color=color))
+
+    try:
+        while len(tracks) < limit:
+            count = min(PLAYLIST_PAGE_SIZE, limit - len(tracks))
+            entries, _ = await fetch_playlist_page(url, start, count, PRIORITY_PREFETCH)
+            if not entries:
+                break
+            page = playlist_tracks(entries)
+            enqueue_playlist_tracks(guild_id, page)
+            tracks.extend(page)
+            start += len(entries)
+            if len(entries) < count:
+                break
+            status(f"⏳ **{title}**: добавлено **{len(tracks)}** треков, загружаю дальше...", discord.Color.orange())
+        save_playlist_snapshot(url, title, tracks, limit)
+        status(f"✅ Добавлено **{len(tracks)}** треков из плейлиста: **{title}**", discord.Color.green())
+    except asyncio.CancelledError:
+        status(f"⏹️ Загрузка плейлиста **{title}** остановлена, успели добавить **{len(tracks)}** треков.", discord.Color.orange())
+        raise
+    except Exception as e:
+        print(f"Ошибка дозагрузки плейлиста: {e}")
+        status(f"⚠️ Из плейлиста **{title}** добавлено **{len(tracks)}** треков, дальше прочитать не удалось.", discord.Color.orange())
+
+def start_playlist_import(guild_id, *args, worker=import_playlist_rest):
+    task = bot.loop.create_task(worker(guild_id, *args))
+    tasks = playlist_imports.setdefault(guild_id, set())
+    tasks.add(task)
+
+    def done(_):
+        tasks.discard(task)
+        if not tasks and playlist_imports.get(guild_id) is tasks:
+            del playlist_imports[guild_id]
+    task.add_done_callback(done)
+
+def cancel_playlist_imports(guild_id):
+    for task in playlist_imports.pop(guild_id, ()):
+        task.cancel()
+
+# --- СОХРАНЕННЫЕ ПЛЕЙЛИСТЫ ---
+# Состав плейлиста (ссылка, название, длительность, автор) лежит в базе, общий для всех серверов:
+# !replay ставит его в очередь сразу, без извлечения, а с источником сверяется уже в фоне
+def save_playlist_snapshot(url, title, tracks, limit):
+    snapshot = {'title': title, 'limit': limit, 'updated': time.time(), 'tracks': [pack_track(t) for t in tracks]}
+    packed = json.dumps(snapshot, ensure_ascii=False)
+    store.mark('playlist_snapshot', canonical_url(url), zlib.compress(packed.encode('utf-8')))
+
+def unpack_playlist_snapshot(packed):
+    return json.loads(zlib.decompress(packed).decode('utf-8')) if packed else None
+
+async def load_playlist_snapshot(url):
+    packed = await store.fetch_one('playlist_snapshot', canonical_url(url))
+    return await asyncio.get_running_loop().run_in_executor(None, unpack_playlist_snapshot, packed)
+
+def remember_playlist(guild_id, title, url, query):
+    """Поднимает плейлист наверх !history (повторная загрузка не плодит дубликатов)."""
+    guild_str = str(guild_id)
+    history = [item for item in saved_playlists.get(guild_str, []) if item['url'] != url]
+    history.append({'title': title, 'url': url, 'query': query})
+    # Оставляем только 10 последних
+    saved_playlists[guild_str] = history[-PLAYLIST_HISTORY_SIZE:]
+    # Сохраняем обновленный список (запись уйдет на диск в фоне)
+    store.mark('playlists', guild_str, saved_playlists[guild_str])
+
+async def refresh_playlist(guild_id, url, title, message, snapshot, slots):
+    """Перечитывает плейлист целиком и применяет к очереди только разницу с сохраненным составом.
+
+    slots — seq мест в очереди, куда !replay поставил треки снимка (в том же порядке).
+    """
+    def status(text, color):
+        message_updates.edit(message, embed=discord.Embed(description=text, color=color))
+
+    limit = snapshot.get('limit') or PLAYLIST_MAX_TRACKS
+    fresh = []
+    try:
+        while len(fresh) < limit:
+            count = min(PLAYLIST_PAGE_SIZE, limit - len(fresh))
+            entries, _ = await fetch_playlist_page(url, len(fresh) + 1, count, PRIORITY_PREFETCH)
+            if not entries:
+                break
+            fresh.extend(playlist_tracks(entries))
+            if len(entries) < count:
+                break
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Ошибка обновления плейлиста: {e}")
+        status(f"⚡ **{title}**: добавлено **{len(snapshot['tracks'])}** треков из сохраненного (источник сейчас недоступен).",
+               discord.Color.orange())
+        return
+
+    old = {canonical_url(data[0]) for data in snapshot['tracks']}
+    new = {canonical_url(track.url) for track in fresh}
+    added = [track for track in fresh if canonical_url(track.url) not in old]
+    removed = old - new
+
+    # Порядок не трогаем: добавленные в источнике треки встают в конец, удаленные пропадают из очереди.
+    # Убираем только места, которые поставил этот !replay: тот же трек, добавленный руками или другим плейлистом, остается
+    queue = get_queue(guild_id)
+    if removed:
+        positions = (queue.position(seq) for seq, data in zip(slots, snapshot['tracks']) if canonical_url(data[0]) in removed)
+        queue.remove([i for i in positions if i is not None])
+    if added:
+        enqueue_playlist_tracks(guild_id, added)
+    if added or removed:
+        schedule_prefetch(guild_id)
+    # Названия и длительности обновились через intern_track сами, сохраняем свежий состав
+    save_playlist_snapshot(url, title, fresh, limit)
+    status(f"✅ **{title}**: **{len(snapshot['tracks'])}** треков из сохраненного, сверено с источником: "
+           f"+{len(added)} / −{len(removed)}", discord.Color.green())
+
+# --- УБОРКА СЕРВЕРОВ ---
+def release_guild(guild_id):
+    """Останавливает фоновые задачи сервера и убирает его состояние из памяти."""
+    cancel_playlist_imports(guild_id)
+    cancel_prefetch(guild_id)
+    title_backfill.cancel_guild(guild_id)
+    message_updates.cancel(('now_playing', guild_id))
+    snapshot_headers.pop(guild_id, None)
+    snapshot_versions.pop(guild_id, None)
+    return guild_states.pop(guild_id, None)
+
+def park_guild(guild_id):
+    """Выгружает простаивающий сервер: очередь остается только в снимке и поднимется со следующей командой."""
+    snapshot_guild(guild_id)
+    state = release_guild(guild_id)
+    if state and state.queue:
+        pending_restore.add(guild_id)
+    metrics.inc('bot_guilds_evicted_total')
+
+def forget_guild(guild_id):
+    """Бота убрали с сервера — очередь и снимок больше не понадобятся."""
+    release_guild(guild_id)
+    pending_restore.discard(guild_id)
+    store.mark('snapshot', str(guild_id), None)
+    store.mark('snapshot_queue', str(guild_id), None)
+
+async def leave_empty_channel(state, voice):
+    """В голосовом канале никого не осталось — выходим, очередь (с текущим треком в начале) сохраняем."""
+    # Вызывается из актора: колбэк остановленного трека он уже не примет за конец трека
+    if state.current:
+        state.queue.appendleft(state.current)
+        state.current = None
+    state.playback = None
+    cancel_prefetch(state.guild_id)
+    channel = state.now_playing.channel if state.now_playing else None
+    await remove_now_playing(state)
+    await voice.disconnect()
+    state.alone_since = None
+    state.last_active = time.monotonic()
+    log_event('voice_left_empty', guild=state.guild_id)
+    if channel:
+        await channel.send(embed=discord.Embed(description="👋 В канале никого не осталось — я вышел. Очередь сохранена.",
+                                               color=discord.Color.orange()))
+
+async def sweep_guilds():
+    now = time.monotonic()
+    for guild_id, state in list(guild_states.items()):
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            # Сервера больше нет, а событие об этом мы пропустили (например, во время переподключения)
+            forget_guild(guild_id)
+            continue
+
+        voice = guild.voice_client
+        if voice and voice.is_connected():
+            if any(not member.bot for member in voice.channel.members):
+                state.alone_since = None
+            elif state.alone_since is None:
+                state.alone_since = now
+            elif now - state.alone_since >= VOICE_ALONE_TIMEOUT:
+                state.actor.post('leave', None, voice)
+            continue
+
+        if not state.actor.busy and now - state.last_active >= GUILD_IDLE_TIMEOUT:
+            park_guild(guild_id)
+
+async def guild_sweep_loop():
+    while True:
+        await asyncio.sleep(GUILD_SWEEP_INTERVAL)
+        try:
+            await sweep_guilds()
+        except Exception as e:
+            print(f"Ошибка уборки серверов: {e}")
+
+metrics.describe('bot_guilds_evicted_total', 'counter', 'Простаивающие серверы, выгруженные из памяти в снимки')
 
 # --- 3. КОМАНДЫ БОТА ---
 @bot.event
 async def on_ready():
+    global snapshot_task
     print(f'✅ Бот {bot.user.name} успешно запущен!')
 
+    # on_ready приходит и после каждого переподключения — запускаем все только один раз
+    if snapshot_task is not None:
+        return
+    # Со снимков грузим только список серверов: сами очереди поднимутся, когда понадобятся
+    pending_restore.update(guild_id for guild_id in map(int, await store.fetch_keys('snapshot')) if is_own_guild(guild_id))
+    snapshot_task = bot.loop.create_task(snapshot_loop())
+    ffmpeg_manager.start()
+    bot.loop.create_task(health_loop())
+    bot.loop.create_task(guild_sweep_loop())
+    bot.loop.create_task(stream_watchdog())
+    await start_metrics_server()
+
+    if RESTORE_ON_STARTUP:
+        for guild_id in list(pending_restore):
+            header = await store.fetch_one('snapshot', str(guild_id))
+            if header and header['voice'] and header['current']:
+                try:
+                    await resume_guild(guild_id)
+                except Exception as e:
+                    print(f"Не удалось восстановить сервер {guild_id}: {e}")
+
+@bot.event
+async def on_guild_remove(guild):
+    forget_guild(guild.id)
+
+@bot.before_invoke
+async def restore_before_command(ctx):
+    # Отсюда считается время до первого звука, если команда запустит музыку
+    ctx.invoked_at = time.perf_counter()
+    # Любая команда продлевает серверу жизнь в памяти
+    state = guild_states.get(ctx.guild.id) if ctx.guild else None
+    if state:
+        state.last_active = time.monotonic()
+    # Первая команда на сервере после перезапуска поднимает его очередь из снимка
+    if ctx.guild and ctx.guild.id in pending_restore:
+        header = await restore_state(ctx.guild.id)
+        if header and header['current']:
+            get_queue(ctx.guild.id).appendleft(unpack_track(header['current']))
+
 @bot.command()
 async def play(ctx, *, query: str):
     if not ctx.message.author.voice:
@@ -391,48 +3402,57 @@ async def play(ctx, *, query: str):
     message = await ctx.send(embed=search_embed)
 
     # Если это не прямая ссылка, ищем в SoundCloud
-    if not query.startswith('http'):
-        query = f"scsearch:{query}"
+    is_search = not query.startswith('http')
 
     try:
-        loop = asyncio.get_event_loop()
-        # Извлекаем информацию о треке
-        with yt_dlp.YoutubeDL({**YTDL_OPTIONS, 'noplaylist': True}) as ydl:
-            data = await loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
-        
-        if 'entries' in data:
-            data = data['entries'][0]
-            
-        track_info = {
-            'url': data['webpage_url'], # Используем webpage_url для повторной экстракции в play_next
-            'title': data.get('title', 'Неизвестный трек')
-        }
+        # Популярные запросы берем из кэша, без похода в SoundCloud
+        track_info = await search_cache.fetch(normalize_query(query)) if is_search else None
+
+        if not track_info:
+            # Извлекаем информацию о треке
+            data = await resolver.extract(f"scsearch:{query}" if is_search else query, {**YTDL_OPTIONS, 'noplaylist': True}, site='play')
+
+            if 'entries' in data:
+                data = data['entries'][0]
+
+            track_info = {
+                'url': data['webpage_url'], # Используем webpage_url для повторной экстракции в play_next
+                'title': data.get('title', 'Неизвестный трек'),
+                'uploader': data.get('uploader'),
+            }
+
+            if is_search:
+                remember_search(query, track_info)
         
         guild_id = ctx.guild.id
-        if guild_id not in queues: 
-            queues[guild_id] = []
         
-        # Добавляем трек в список очереди
-        queues[guild_id].append(track_info)
+        # Добавляем трек в очередь
+        get_queue(guild_id).append(intern_track(track_info['url'], track_info['title'], uploader=track_info.get('uploader')))
+        schedule_prefetch(guild_id)
 
         # Сообщаем об успехе
         success_embed = discord.Embed(
             description=f"✅ **Добавлено в очередь:**\n{track_info['title']}", 
             color=discord.Color.green()
         )
-        await message.edit(embed=success_embed)
+        message_updates.edit(message, embed=success_embed)
 
         # Если сейчас ничего не играет и бот не занят обработкой — запускаем!
-        if not ctx.voice_client.is_playing() and not is_processing.get(guild_id, False):
-            await play_next(ctx)
+        get_state(guild_id).actor.post('start', ctx)
 
     except Exception as e:
         error_embed = discord.Embed(description="❌ Не удалось найти этот трек или произошла ошибка.", color=discord.Color.red())
-        await message.edit(embed=error_embed)
+        message_updates.edit(message, embed=error_embed)
         print(f"Ошибка yt-dlp: {e}")
 
 @bot.command(aliases=['pl'])
 async def playlist(ctx, *, query: str):
+    # Последнее число — сколько треков максимум взять (например: !playlist <ссылка> 200)
+    limit = PLAYLIST_MAX_TRACKS
+    parts = query.rsplit(maxsplit=1)
+    if len(parts) == 2 and parts[1].isdigit():
+        query, limit = parts[0], max(1, min(int(parts[1]), PLAYLIST_MAX_TRACKS))
+
     original_query = query
     
     if query.lower().strip() == "noize mc":
@@ -450,90 +3470,52 @@ async def playlist(ctx, *, query: str):
     loading_embed = discord.Embed(description="⏳ Читаю плейлист... Это может занять пару секунд.", color=discord.Color.orange())
     message = await ctx.send(embed=loading_embed)
 
-    YTDL_OPTS = {
-        'extract_flat': True,
-        'noplaylist': False,
-        'quiet': True,
-    }
-
     try:
-        loop = asyncio.get_event_loop()
-        with yt_dlp.YoutubeDL(YTDL_OPTS) as ydl:
-            data = await loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
+        # Сначала только первая страница — чтобы заиграть, не дожидаясь всего плейлиста
+        first_page = min(PLAYLIST_FIRST_PAGE, limit)
+        entries, data = await fetch_playlist_page(query, 1, first_page)
 
-        if not data or 'entries' not in data:
-            return await message.edit(embed=discord.Embed(description="❌ По этой ссылке не найден плейлист.", color=discord.Color.red()))
+        if entries is None:
+            return message_updates.edit(message, embed=discord.Embed(description="❌ По этой ссылке не найден плейлист.", color=discord.Color.red()))
 
         guild_id = ctx.guild.id
-        if guild_id not in queues: 
-            queues[guild_id] = []
-
-        added_count = 0
-        for entry in data['entries']:
-            if not entry: continue
-            
-            title = entry.get('title')
-            if not title or title.isdigit():
-                title = "⌛ Ожидает загрузки..."
-                
-            url = entry.get('url') or entry.get('webpage_url')
-            
-            if url:
-                queues[guild_id].append({
-                    'url': url,
-                    'title': title
-                })
-                added_count += 1
+        new_tracks = playlist_tracks(entries)
+        added_count = len(new_tracks)
 
         if added_count == 0:
-            return await message.edit(embed=discord.Embed(description="❌ Плейлист оказался пустым.", color=discord.Color.red()))
+            return message_updates.edit(message, embed=discord.Embed(description="❌ Плейлист оказался пустым.", color=discord.Color.red()))
 
-        playlist_title = data.get('title', 'Без названия')
+        enqueue_playlist_tracks(guild_id, new_tracks)
+        schedule_prefetch(guild_id)
 
-        # --- НАЧАЛО ЗАМЕНЫ ---
-        # JSON хранит ключи как строки, поэтому переводим guild_id в строку
-        guild_str = str(ctx.guild.id)
-        
-        if guild_str not in saved_playlists:
-            saved_playlists[guild_str] = []
-            
-        saved_playlists[guild_str].append({
-            'title': playlist_title,
-            'url': query,
-            'query': original_query 
-        })
-        
-        # Оставляем только 10 последних
-        if len(saved_playlists[guild_str]) > 10:
-            saved_playlists[guild_str].pop(0) 
-
-        # Сразу сохраняем обновленный список в файл!
-        save_playlists(saved_playlists)
-        # --- КОНЕЦ ЗАМЕНЫ ---
-
-        # ---> МАГИЯ: Запускаем фоновую подгрузку... (и дальше как было)
+        playlist_title = data.get('title', 'Без названия')
 
-        # ---> МАГИЯ: Запускаем фоновую подгрузку для первых 15 треков <---
-        # Берем только те треки, которые мы только что добавили
-        new_tracks = queues[guild_id][-added_count:]
-        bot.loop.create_task(fetch_missing_titles(new_tracks))
+        remember_playlist(guild_id, playlist_title, query, original_query)
 
-        await message.edit(embed=discord.Embed(
-            description=f"✅ Добавлено **{added_count}** треков из плейлиста: **{playlist_title}**",
-            color=discord.Color.green()
-        ))
+        # Страница пришла неполной — плейлист уже весь тут, иначе остальное дозагрузит фоновая задача
+        if len(entries) < first_page or added_count >= limit:
+            save_playlist_snapshot(query, playlist_title, new_tracks, limit)
+            message_updates.edit(message, embed=discord.Embed(
+                description=f"✅ Добавлено **{added_count}** треков из плейлиста: **{playlist_title}**",
+                color=discord.Color.green()
+            ))
+        else:
+            message_updates.edit(message, embed=discord.Embed(
+                description=f"⏳ **{playlist_title}**: добавлено **{added_count}** треков, загружаю дальше...",
+                color=discord.Color.orange()
+            ))
+            start_playlist_import(guild_id, query, playlist_title, message, len(entries) + 1, list(new_tracks), limit)
 
-        if not ctx.voice_client.is_playing() and not is_processing.get(guild_id):
-            await play_next(ctx)
+        get_state(guild_id).actor.post('start', ctx)
 
     except Exception as e:
         print(f"Ошибка плейлиста: {e}")
-        await message.edit(embed=discord.Embed(description="❌ Ошибка при чтении плейлиста.", color=discord.Color.red()))
+        message_updates.edit(message, embed=discord.Embed(description="❌ Ошибка при чтении плейлиста.", color=discord.Color.red()))
 
 @bot.command(aliases=['pl_history', 'history'])
 async def playlist_history(ctx):
-    guild_id = ctx.guild.id
-    history = saved_playlists.get(guild_id, [])
+    # JSON хранит ключи как строки, поэтому переводим guild_id в строку
+    history = saved_playlists.get(str(ctx.guild.id), [])
     
     if not history:
         return await ctx.send(embed=discord.Embed(description="📭 История плейлистов пока пуста.", color=discord.Color.orange()))
@@ -550,53 +3532,69 @@ async def playlist_history(ctx):
         description=description, 
         color=discord.Color.blurple()
     )
-    embed.set_footer(text="Отображаются последние 10 плейлистов")
+    embed.set_footer(text=f"Отображаются последние {PLAYLIST_HISTORY_SIZE} плейлистов · !replay <номер> — включить снова")
     await ctx.send(embed=embed)
+
+@bot.command(aliases=['pl_replay', 'rp'])
+async def replay(ctx, index: int = 1):
+    """Снова ставит в очередь плейлист из !history (например: !replay 2) — сразу, из сохраненного состава."""
+    history = saved_playlists.get(str(ctx.guild.id), [])
+    if not 1 <= index <= len(history):
+        return await ctx.send(embed=discord.Embed(description=f"❌ В истории {len(history)} плейлистов — смотри `!history`.", color=discord.Color.red()))
+    item = history[-index]
+
+    snapshot = await load_playlist_snapshot(item['url'])
+    if not snapshot or not snapshot['tracks']:
+        # Плейлист так и не дочитали до конца (или это старая запись) — грузим как обычно
+        return await playlist(ctx, query=item['url'])
+
+    if not ctx.message.author.voice:
+        return await ctx.send(embed=discord.Embed(description="❌ Зайди в голосовой канал!", color=discord.Color.red()))
+    if not ctx.voice_client:
+        await ctx.message.author.voice.channel.connect()
+
+    guild_id = ctx.guild.id
+    tracks = [unpack_track(data) for data in snapshot['tracks']]
+    enqueue_playlist_tracks(guild_id, tracks)
+    queue = get_queue(guild_id)
+    # Места этих треков в очереди: при сверке с источником удалять будем только их
+    slots = [queue.seq(i) for i in range(len(queue) - len(tracks), len(queue))]
+    schedule_prefetch(guild_id)
+    remember_playlist(guild_id, item['title'], item['url'], item['query'])
+    get_state(guild_id).actor.post('start', ctx)
+
+    text = f"⚡ **{item['title']}**: добавлено **{len(tracks)}** треков из сохраненного"
+    if time.time() - snapshot['updated'] < PLAYLIST_REFRESH_AFTER:
+        return await ctx.send(embed=discord.Embed(description=text, color=discord.Color.green()))
+    message = await ctx.send(embed=discord.Embed(description=f"{text}, сверяю с источником...", color=discord.Color.orange()))
+    start_playlist_import(guild_id, item['url'], item['title'], message, snapshot, slots, worker=refresh_playlist)
         
 @bot.command()
 async def clear(ctx):
     """Очищает очередь, если ты случайно загрузил слишком длинный плейлист."""
     guild_id = ctx.guild.id
-    if guild_id in queues:
-        queues[guild_id] = []
+    cancel_playlist_imports(guild_id)
+    queue = peek_queue(guild_id)
+    if queue is not None:
+        queue.clear()
+        cancel_prefetch(guild_id)
+        title_backfill.cancel_guild(guild_id)
         await ctx.send(embed=discord.Embed(description="🗑️ **Очередь полностью очищена!**", color=discord.Color.blue()))
     else:
         await ctx.send(embed=discord.Embed(description="Очередь и так пуста.", color=discord.Color.orange()))
 
-@bot.command(aliases=['skip'])
-async def next(ctx, count: int = 1):
+# Функция называется не next, чтобы не затенять встроенный next() для всего модуля
+@bot.command(name='next', aliases=['skip'])
+async def next_track(ctx, count: int = 1):
     """Пропускает текущий трек или сразу несколько (например: !skip 5)"""
     if count < 1:
         return await ctx.send(embed=discord.Embed(description="❌ Число должно быть 1 или больше!", color=discord.Color.red()))
 
-    guild_id = ctx.guild.id
-
     # Проверяем, играет ли что-то прямо сейчас (или стоит на паузе)
     if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-        
-        # Если просят пропустить больше 1 трека, убираем их из очереди
-        if count > 1 and guild_id in queues:
-            # Считаем, сколько треков удалить из начала очереди
-            # Вычитаем 1, так как текущий играющий трек мы пропустим просто остановив плеер
-            to_skip = min(count - 1, len(queues[guild_id]))
-            
-            for _ in range(to_skip):
-                skipped_track = queues[guild_id].pop(0)
-                
-                # Сохраняем пропущенные треки в историю
-                if guild_id not in history_queues: 
-                    history_queues[guild_id] = []
-                history_queues[guild_id].append(skipped_track)
-                if len(history_queues[guild_id]) > 50: 
-                    history_queues[guild_id].pop(0)
-                
-                # Если включен повтор очереди (loop_mode), отправляем их в конец списка
-                if loop_mode.get(guild_id, True):
-                    queues[guild_id].append(skipped_track)
-
-        # Останавливаем текущий трек. Это автоматически вызовет функцию play_next 
-        # и бот начнет играть уже нужный трек
-        ctx.voice_client.stop()
+        # Актор уберет count - 1 треков из начала очереди и переключит на нужный;
+        # несколько !skip подряд он сложит в одно переключение
+        get_state(ctx.guild.id).actor.post('skip', ctx, count)
         
         # Выбираем правильный текст для сообщения
         text = "⏭️ **Трек пропущен!**" if count == 1 else f"⏭️ **Пропущено треков: {count}**"
@@ -606,9 +3604,9 @@ async def next(ctx, count: int = 1):
         await ctx.send(embed=discord.Embed(description="В данный момент ничего не играет.", color=discord.Color.orange()))
 @bot.command(aliases=['queue', 'q'])
 async def query(ctx):
-    guild_id = ctx.guild.id
-    playing_now = current_tracks.get(guild_id)
-    queue_list = queues.get(guild_id, [])
+    state = guild_states.get(ctx.guild.id)
+    playing_now = state.current if state else None
+    queue_list = state.queue if state else []
 
     # Если совсем ничего нет
     if not playing_now and not queue_list:
@@ -627,30 +3625,127 @@ async def query(ctx):
     else:
         await ctx.send(embed=view.create_embed(), view=view)
 
+@bot.command(aliases=['search'])
+async def find(ctx, *, query: str):
+    """Ищет треки в очереди по названию (например: !find noize)"""
+    queue = peek_queue(ctx.guild.id)
+    if not queue:
+        return await ctx.send(embed=discord.Embed(description="Очередь пуста.", color=discord.Color.orange()))
+
+    matches, exact = queue.find(query)
+    if not matches:
+        return await ctx.send(embed=discord.Embed(description=f"🔎 В очереди нет ничего похожего на `{query}`.", color=discord.Color.orange()))
+
+    embed = discord.Embed(
+        title="🔎 Нашлось в очереди" if exact else "🔎 Точных совпадений нет, вот похожие",
+        description="\n".join(f"**{i + 1}.** {track.title}" for i, track in matches),
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text="!jump <номер> — сыграть сразу, !remove <номер> — убрать")
+    await ctx.send(embed=embed)
+
+@bot.command(aliases=['j'])
+async def jump(ctx, *, target: str):
+    """Сразу играет трек из очереди по номеру или по названию (например: !jump 120 или !jump noize)"""
+    guild_id = ctx.guild.id
+    queue = peek_queue(guild_id)
+    if not ctx.voice_client or not queue:
+        return await ctx.send(embed=discord.Embed(description="Очередь пуста.", color=discord.Color.orange()))
+
+    if target.isdigit():
+        position = int(target) - 1
+        if not 0 <= position < len(queue):
+            return await ctx.send(embed=discord.Embed(description=f"❌ В очереди всего {len(queue)} треков.", color=discord.Color.red()))
+    else:
+        matches, _ = queue.find(target, 1)
+        if not matches:
+            return await ctx.send(embed=discord.Embed(description=f"🔎 В очереди нет ничего похожего на `{target}`.", color=discord.Color.orange()))
+        position = matches[0][0]
+
+    # Переставляем трек в начало, остальная очередь не теряется
+    track = queue.remove([position])[0]
+    queue.appendleft(track)
+    schedule_prefetch(guild_id)
+
+    if ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
+        get_state(guild_id).actor.post('skip', ctx, 1) # следующим возьмется он
+    else:
+        get_state(guild_id).actor.post('start', ctx)
+    await ctx.send(embed=discord.Embed(description=f"⤴️ **Переключаюсь на:** {track.title}", color=discord.Color.blue()))
+
+def removed_text(count):
+    return f"🗑️ **Убрано треков: {count}**" if count else "Ничего не убрано."
+
+@bot.command(aliases=['rm'])
+async def remove(ctx, *, positions: str):
+    """Убирает из очереди трек или диапазон (например: !remove 7 или !remove 5-20)"""
+    guild_id = ctx.guild.id
+    queue = peek_queue(guild_id)
+    match = re.fullmatch(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?", positions)
+    if not match:
+        return await ctx.send(embed=discord.Embed(description="❌ Укажи номер или диапазон, например `!remove 5-20`.", color=discord.Color.red()))
+    if not queue:
+        return await ctx.send(embed=discord.Embed(description="Очередь пуста.", color=discord.Color.orange()))
+
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    first, last = min(first, last), max(first, last)
+    # Номер мимо очереди — скорее опечатка: молча убирать соседний трек нельзя
+    if first < 1 or last > len(queue):
+        return await ctx.send(embed=discord.Embed(description=f"❌ Номера в очереди — от 1 до {len(queue)}.", color=discord.Color.red()))
+    removed = queue.remove(range(first - 1, last))
+    schedule_prefetch(guild_id)
+    await ctx.send(embed=discord.Embed(description=removed_text(len(removed)), color=discord.Color.blue()))
+
+@bot.command(aliases=['rmby'])
+async def remove_by(ctx, *, uploader: str):
+    """Убирает из очереди все треки автора (например: !remove_by noize mc)"""
+    guild_id = ctx.guild.id
+    queue = peek_queue(guild_id)
+    if not queue:
+        return await ctx.send(embed=discord.Embed(description="Очередь пуста.", color=discord.Color.orange()))
+
+    removed = queue.remove(queue.find_uploader(uploader))
+    schedule_prefetch(guild_id)
+    await ctx.send(embed=discord.Embed(description=removed_text(len(removed)), color=discord.Color.blue()))
+
+@bot.command(aliases=['dedupe'])
+async def dedup(ctx):
+    """Убирает из очереди повторы одного и того же трека (остается первый)."""
+    guild_id = ctx.guild.id
+    queue = peek_queue(guild_id)
+    if not queue:
+        return await ctx.send(embed=discord.Embed(description="Очередь пуста.", color=discord.Color.orange()))
+
+    current = get_state(guild_id).current
+    seen = {canonical_url(current.url)} if current else set()
+    duplicates = []
+    for i, track in enumerate(queue):
+        key = canonical_url(track.url)
+        if key in seen:
+            duplicates.append(i)
+        seen.add(key)
+
+    removed = queue.remove(duplicates)
+    schedule_prefetch(guild_id)
+    await ctx.send(embed=discord.Embed(description=removed_text(len(removed)), color=discord.Color.blue()))
+
 @bot.command()
 async def stop(ctx):
-    guild_id = ctx.guild.id
-    if guild_id in queues: queues[guild_id] = []
-    if guild_id in current_tracks: del current_tracks[guild_id]
-    if guild_id in playback_info: del playback_info[guild_id] 
-    
-    # ---> УДАЛЯЕМ СООБЩЕНИЕ <---
-    if guild_id in now_playing_messages:
-        try:
-            await now_playing_messages[guild_id].delete()
-        except:
-            pass
-        del now_playing_messages[guild_id]
-        
-    if ctx.voice_client:
-        await ctx.voice_client.disconnect()
+    had_voice = ctx.voice_client is not None
+    # Ждем, пока актор все остановит: переключение, которое шло в этот момент, закончится первым
+    await get_state(ctx.guild.id).actor.post('stop', ctx)
+    if had_voice:
         await ctx.send(embed=discord.Embed(description="⏹️ **Музыка остановлена. Очередь очищена.**", color=discord.Color.red()))
 
 @bot.command()
 async def shuffle(ctx):
     guild_id = ctx.guild.id
-    if guild_id in queues and len(queues[guild_id]) > 1:
-        random.shuffle(queues[guild_id])
+    queue = peek_queue(guild_id)
+    if queue and len(queue) > 1:
+        queue.shuffle()
+        title_backfill.add(guild_id, 0, len(queue))
+        schedule_prefetch(guild_id)
         await ctx.send(embed=discord.Embed(description="🔀 **Очередь перемешана!**", color=discord.Color.purple()))
     else:
         await ctx.send(embed=discord.Embed(description="В очереди недостаточно треков.", color=discord.Color.orange()))
@@ -674,8 +3769,12 @@ async def help(ctx):
     )
     embed.add_field(name="▶️ Основные", value="`!play <название>` — Включить трек\n`!stop` — Остановить и выгнать бота", inline=False)
     embed.add_field(name="📋 Очередь", value="`!queue` — Показать список\n`!next` — Следующая песня\n`!shuffle` — Перемешать", inline=False)
+    embed.add_field(name="🔎 Поиск по очереди", value=("`!find <текст>` — Найти трек в очереди\n`!jump <номер или текст>` — Сыграть его сразу\n"
+                                                     "`!remove <номер>` или `!remove 5-20` — Убрать треки\n`!remove_by <автор>` — Убрать все треки автора\n"
+                                                     "`!dedup` — Убрать повторы"), inline=False)
     embed.add_field(name="⏳ Перемотка", value="`!forward <сек>` (или `!ff`) — Вперед\n`!backwards <сек>` (или `!rw`) — Назад", inline=False)
-    embed.add_field(name="📜 Плейлисты", value="`!playlist <ссылка>` — Добавить весь плейлист из SoundCloud", inline=False)
+    embed.add_field(name="📜 Плейлисты", value=("`!playlist <ссылка> [кол-во]` — Добавить плейлист из SoundCloud (остановить загрузку — `!clear`)\n"
+                                                  "`!history` — Последние плейлисты\n`!replay <номер>` — Включить плейлист из истории снова"), inline=False)
     embed.add_field(name="🎤 Авторы", value="`!author \"имя\" <кол-во>` — Захватить топ треков автора", inline=False)
     embed.set_footer(text="Приятного прослушивания! 🎧")
     await ctx.send(embed=embed)
@@ -708,57 +3807,52 @@ async def play_author(ctx, *, query: str):
     ))
 
     try:
-        loop = asyncio.get_event_loop()
         # Ищем ровно {count} треков по имени {name}
         search_query = f"scsearch{count}:{name}"
         
         YTDL_SEARCH_OPTS = {'extract_flat': True, 'quiet': True, 'force_generic_extractor': False}
 
-        with yt_dlp.YoutubeDL(YTDL_SEARCH_OPTS) as ydl:
-            data = await loop.run_in_executor(None, lambda: ydl.extract_info(search_query, download=False))
+        data = await resolver.extract(search_query, YTDL_SEARCH_OPTS, timeout=RESOLVE_TIMEOUT * 4, site='play_author')
 
         if not data or 'entries' not in data or len(data['entries']) == 0:
-            return await message.edit(embed=discord.Embed(description=f"❌ Ничего не найдено по запросу: {name}", color=discord.Color.red()))
+            return message_updates.edit(message, embed=discord.Embed(description=f"❌ Ничего не найдено по запросу: {name}", color=discord.Color.red()))
 
         guild_id = ctx.guild.id
-        if guild_id not in queues: queues[guild_id] = []
+        queue = get_queue(guild_id)
 
         added_count = 0
-        new_tracks = []
         for entry in data['entries']:
             if not entry: continue
             t_url = entry.get('url') or entry.get('webpage_url')
             if t_url:
-                track_data = {'url': t_url, 'title': entry.get('title', 'Трек SoundCloud')}
-                queues[guild_id].append(track_data)
-                new_tracks.append(track_data)
+                track = intern_track(t_url, entry.get('title', 'Трек SoundCloud'), entry.get('duration') or 0, entry.get('uploader'))
+                queue.append(track)
                 added_count += 1
 
-        bot.loop.create_task(fetch_missing_titles(new_tracks))
+        title_backfill.add(guild_id, len(queue) - added_count, added_count)
+        schedule_prefetch(guild_id)
 
-        await message.edit(embed=discord.Embed(
+        message_updates.edit(message, embed=discord.Embed(
             description=f"🔥 **{name}** захвачен!\nДобавлено в очередь: **{added_count}** треков.", 
             color=discord.Color.green()
         ))
 
-        if not ctx.voice_client.is_playing() and not is_processing.get(guild_id):
-            await play_next(ctx)
+        get_state(guild_id).actor.post('start', ctx)
 
     except Exception as e:
         print(f"Ошибка AUTHOR: {e}")
-        await message.edit(embed=discord.Embed(description="❌ Произошел сбой.", color=discord.Color.red()))
+        message_updates.edit(message, embed=discord.Embed(description="❌ Произошел сбой.", color=discord.Color.red()))
     
 @bot.command(aliases=['repeat'])
 async def loop(ctx):
     """Включает или выключает бесконечный повтор очереди."""
-    guild_id = ctx.guild.id
+    state = get_state(ctx.guild.id)
     
     # Меняем текущее значение на противоположное (по умолчанию включено)
-    current_loop = loop_mode.get(guild_id, True)
-    loop_mode[guild_id] = not current_loop
+    state.loop = not state.loop
     
-    state = "✅ **Включен**" if loop_mode[guild_id] else "❌ **Выключен**"
-    await ctx.send(embed=discord.Embed(description=f"🔁 Бесконечный повтор очереди: {state}", color=discord.Color.blue()))
+    text = "✅ **Включен**" if state.loop else "❌ **Выключен**"
+    await ctx.send(embed=discord.Embed(description=f"🔁 Бесконечный повтор очереди: {text}", color=discord.Color.blue()))
     
 @bot.command(aliases=['vol'])
 async def volume(ctx, vol: int):
@@ -775,16 +3869,180 @@ async def volume(ctx, vol: int):
     # Дискорд принимает громкость от 0.0 до 2.0 (где 1.0 - это 100%)
     volume_float = vol / 100.0
     
-    # Сохраняем в наш словарь и сразу записываем в файл
+    # Сохраняем в наш словарь, а в базу оно уйдет в фоне
     persistent_settings[guild_str]["volume"] = volume_float
-    save_settings(persistent_settings)
+    store.mark('settings', guild_str, persistent_settings[guild_str])
 
     # Если бот прямо сейчас что-то играет, меняем громкость на лету!
-    if ctx.voice_client and ctx.voice_client.source:
-        ctx.voice_client.source.volume = volume_float
+    # Громкость делает FFmpeg, поэтому перезапускаем его с того же места (ссылка уже известна)
+    state = guild_states.get(ctx.guild.id)
+    if ctx.voice_client and ctx.voice_client.source and state and state.playback:
+        restart_playback(ctx, current_position(ctx.guild.id))
 
     await ctx.send(embed=discord.Embed(description=f"🔊 **Громкость установлена на {vol}%**", color=discord.Color.blue()))
 
+@bot.command(aliases=['health'])
+async def shards(ctx):
+    """Показывает нагрузку всех процессов бота."""
+    now = time.time()
+    embed = discord.Embed(title="🧩 Процессы бота", color=discord.Color.blurple())
+    for label, data in sorted((await store.fetch_health()).items()):
+        stale = now - data['updated'] > HEALTH_STALE_AFTER
+        latency = '—' if data['latency_ms'] is None else f"{data['latency_ms']} мс"
+        rss = '—' if data['rss_mb'] is None else f"{data['rss_mb']:.0f} МБ"
+        embed.add_field(
+            name=f"{'💀' if stale else '🟢'} Шарды {label} (pid {data['pid']})",
+            value=(f"Серверов: **{data['guilds']}** · Голосовых: **{data['voice_clients']}** · Играет: **{data['playing']}**\n"
+                   f"Треков в очередях: **{data['queued_tracks']}** · FFmpeg: **{data['ffmpeg']}**\n"
+                   f"Пинг: **{latency}** · CPU: **{data['cpu_percent']:.0f}%** · RAM: **{rss}**"),
+            inline=False
+        )
+    await ctx.send(embed=embed)
+
+@bot.command(aliases=['procs'])
+async def ffmpeg(ctx):
+    """Показывает запущенные процессы FFmpeg."""
+    data = ffmpeg_manager.stats()
+    embed = discord.Embed(
+        title="🎛️ Процессы FFmpeg",
+        description=(f"Запущено: **{data['running']}** / {FFMPEG_MAX_PROCESSES} · "
+                     f"CPU: **{data['cpu_percent']:.0f}%** / {FFMPEG_CPU_BUDGET:.0f}% · RAM: **{data['rss_mb']:.0f} МБ**\n"
+                     f"Всего запусков: **{data['spawned']}** · Ошибок: **{data['failed']}** · "
+                     f"Облегченных: **{data['degraded']}** · Убрано сирот: **{data['reaped']}**"),
+        color=discord.Color.blurple()
+    )
+    lines = []
+    for proc in sorted(data['processes'], key=lambda p: -p['cpu_percent'])[:15]:
+        rss = '—' if proc['rss_mb'] is None else f"{proc['rss_mb']:.0f} МБ"
+        lines.append(f"`{proc['pid']}` {proc['kind']} · CPU {proc['cpu_percent']:.0f}% · {rss} · {proc['lifetime'] / 60:.0f} мин")
+    if lines:
+        embed.add_field(name="Самые прожорливые", value="\n".join(lines), inline=False)
+    await ctx.send(embed=embed)
+
+def format_bytes(size):
+    return f"{size / 1024 / 1024:.1f} МБ" if size >= 1024 * 1024 else f"{size / 1024:.0f} КБ"
+
+@bot.command(aliases=['mem'])
+async def memory(ctx):
+    """Показывает, сколько памяти держат серверы (треки общие для всех и считаются отдельно)."""
+    sizes = sorted(((state.memory(), state) for state in guild_states.values()), key=lambda item: -item[0])
+    embed = discord.Embed(
+        title="🧠 Память серверов",
+        description=(f"В памяти: **{len(sizes)}** серверов, **{format_bytes(sum(size for size, _ in sizes))}** · "
+                     f"Выгружено в снимки: **{len(pending_restore)}**\n"
+                     f"Уникальных треков: **{len(track_store)}** (~{format_bytes(len(track_store) * sys.getsizeof(Track('', '')))})"),
+        color=discord.Color.blurple()
+    )
+    state = guild_states.get(ctx.guild.id)
+    if state:
+        embed.add_field(name="Этот сервер", value=(f"**{format_bytes(state.memory())}** · Очередь: **{len(state.queue)}** · "
+                                                    f"История: **{len(state.history)}**"), inline=False)
+    lines = []
+    for size, top in sizes[:10]:
+        guild = bot.get_guild(top.guild_id)
+        lines.append(f"{guild.name if guild else top.guild_id} · {format_bytes(size)} · очередь {len(top.queue)}")
+    if lines:
+        embed.add_field(name="Больше всех", value="\n".join(lines), inline=False)
+    await ctx.send(embed=embed)
+
+@bot.command(aliases=['cache'])
+async def stats(ctx):
+    """Показывает статистику кэша ссылок и пула извлечения."""
+    cache_stats = resolve_cache.stats()
+    resolver_stats = resolver.stats()
+    search_stats = search_cache.stats()
+    backfill_stats = title_backfill.stats()
+    updates = message_updates.stats()
+    failed = failed_tracks.stats()
+    breaker = host_breaker.stats()
+    seek = seek_stats.stats()
+    streams = stream_health.stats()
+    audio = audio_cache.stats()
+    measured = len(loudness.values)
+    cpu = stream_cpu.stats([state.playback['source'] for state in guild_states.values()
+                            if state.playback and state.playback.get('source')])
+    embed = discord.Embed(title="📊 Статистика", color=discord.Color.blurple())
+    embed.add_field(
+        name="🔗 Кэш ссылок",
+        value=(f"Попаданий: **{cache_stats['hits']}**\n"
+               f"Промахов: **{cache_stats['misses']}**\n"
+               f"Записей: **{cache_stats['size']}** / {RESOLVE_CACHE_SIZE}\n"
+               f"Hit rate: **{cache_stats['hit_rate']:.0%}**"),
+        inline=False
+    )
+    embed.add_field(
+        name="🔍 Кэш поиска",
+        value=f"Попаданий: **{search_stats['hits']}** · Промахов: **{search_stats['misses']}** · Записей: **{search_stats['size']}**",
+        inline=False
+    )
+    embed.add_field(
+        name="⚙️ Пул извлечения",
+        value=f"Процессов: **{resolver_stats['workers']}**\nЗаявок в очереди: **{resolver_stats['queued']}**",
+        inline=False
+    )
+    embed.add_field(
+        name="💾 Кэш аудио",
+        value=(f"Файлов: **{audio['files']}** · Занято: **{audio['mb']:.0f}** / {AUDIO_CACHE_MB} МБ\n"
+               f"С диска: **{audio['hits']}** · По сети: **{audio['misses']}** · Качается: **{audio['filling']}**"),
+        inline=False
+    )
+    embed.add_field(
+        name="🖥️ Процессор на поток",
+        value=" · ".join(f"{mode.upper()}: **{'—' if value is None else f'{value:.1f}%'}**" for mode, value in cpu.items()),
+        inline=False
+    )
+    embed.add_field(
+        name="🎚️ Выравнивание громкости",
+        value=f"Измерено треков: **{measured}** · В работе: **{len(loudness.pending)}** · Цель: **{LOUDNESS_TARGET:g} LUFS**",
+        inline=False
+    )
+    embed.add_field(
+        name="⏩ Перемотка",
+        value=(f"Последняя: **{seek['last_ms']:.0f} мс** · Медиана: **{seek['median_ms']:.0f} мс**\n"
+               f"Из буфера: **{seek['buffered']}** · С перезапуском FFmpeg: **{seek['restarts']}**"),
+        inline=False
+    )
+    embed.add_field(
+        name="🎼 Треки в памяти",
+        value=f"Уникальных: **{len(track_store)}** · Мест в очередях: **{sum(len(state.queue) for state in guild_states.values())}**",
+        inline=False
+    )
+    embed.add_field(
+        name="⌛ Подгрузка названий",
+        value=f"Ожидают: **{backfill_stats['waiting']}** · Грузятся: **{backfill_stats['running']}**",
+        inline=False
+    )
+    embed.add_field(
+        name="✏️ Правки сообщений",
+        value=(f"Отправлено: **{updates['sent']}** · Схлопнуто: **{updates['coalesced']}** · "
+               f"429 от Discord: **{updates['rate_limited']}** · Ждут: **{updates['waiting']}**"),
+        inline=False
+    )
+    embed.add_field(
+        name="🚫 Нерабочие треки",
+        value=(f"В черном списке: **{failed['size']}** · Пропущено мгновенно: **{failed['hits']}** · "
+               f"Хосты на паузе: **{', '.join(breaker['open']) or 'нет'}** (срабатываний: {breaker['trips']})"),
+        inline=False
+    )
+    embed.add_field(
+        name="🩹 Обрывы потоков",
+        value=(f"Раньше конца: **{streams['eof']}** · Зависли: **{streams['stall']}** · Ссылка протухла: **{streams['expired']}**\n"
+               f"Восстановлено: **{streams['recovered']}** (медиана **{streams['median_ms']:.0f} мс**) · Не удалось: **{streams['gave_up']}**"),
+        inline=False
+    )
+    await ctx.send(embed=embed)
+
 # --- ЗАПУСК ---
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-bot.run(DISCORD_TOKEN)
\ No newline at end of file
+
+# Защита нужна для пула процессов: на Windows дочерние процессы заново импортируют этот файл
+if __name__ == "__main__":
+    try:
+        bot.run(DISCORD_TOKEN)
+    finally:
+        resolver.shutdown()
+        audio_cache.downloader.shutdown()
+        save_search_cache()
+        # Снимки тут не пересобираем: к этому моменту бот уже вышел из голосовых каналов,
+        # а на диске лежит последний снимок, сделанный во время игры
+        store.flush()
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""Запускает бота в несколько процессов, каждый со своей группой шардов.
+
+    SHARD_COUNT=8 SHARD_PROCESSES=4 python launcher.py
+
+Упавший процесс перезапускается с нарастающей паузой, Ctrl+C гасит всех.
+Кэши и очереди процессы делят через общую SQLite базу (DATABASE_FILE).
+"""
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0') or 0)
+SHARD_PROCESSES = int(os.getenv('SHARD_PROCESSES', '0') or 0) or os.cpu_count() or 1
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'bot_data.sqlite3')
+# Как часто печатать сводку по процессам
+HEALTH_REPORT_INTERVAL = 60
+# Пауза перед перезапуском растет до этого потолка; процесс, проживший дольше, считаем здоровым
+RESTART_MAX_DELAY = 60
+HEALTHY_UPTIME = 300
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+
+def shard_groups():
+    """Раскладывает шарды по процессам по кругу: 0,4,8.. / 1,5,9.. и т.д."""
+    processes = min(SHARD_PROCESSES, SHARD_COUNT)
+    return [list(range(first, SHARD_COUNT, processes)) for first in range(processes)]
+
+
+class ShardProcess:
+    def __init__(self, shard_ids):
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = 0.0
+        self.restarts = 0
+        self.restart_at = 0.0
+
+    @property
+    def label(self):
+        return ','.join(map(str, self.shard_ids))
+
+    def start(self):
+        env = {**os.environ, 'SHARD_COUNT': str(SHARD_COUNT), 'SHARD_IDS': self.label}
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+        self.started = time.monotonic()
+        print(f"Шарды {self.label}: запущен процесс {self.process.pid}")
+
+    def check(self):
+        """Перезапускает процесс, если он умер. Возвращает код выхода или None."""
+        now = time.monotonic()
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return None
+        code = self.process.poll()
+        if code is None:
+            return None
+        if now - self.started > HEALTHY_UPTIME:
+            self.restarts = 0
+        delay = min(RESTART_MAX_DELAY, 2 ** self.restarts)
+        self.restarts += 1
+        self.restart_at = now + delay
+        self.process = None
+        print(f"Шарды {self.label}: процесс упал с кодом {code}, перезапуск через {delay} с")
+        return code
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, timeout):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def report_health():
+    """Печатает то, что процессы сами пишут в базу (см. health_loop в bot.py)."""
+    try:
+        db = sqlite3.connect(DATABASE_FILE, timeout=5)
+        try:
+            rows = db.execute("SELECT label, data FROM shard_health").fetchall()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        print(f"Ошибка чтения здоровья шардов: {e}")
+        return
+    now = time.time()
+    for label, data in sorted(rows):
+        health = json.loads(data)
+        age = now - health['updated']
+        print(f"  [{label}] pid {health['pid']}: серверов {health['guilds']}, голосовых {health['voice_clients']}, "
+              f"ffmpeg {health['ffmpeg']}, CPU {health['cpu_percent']:.0f}%, "
+              f"RAM {health['rss_mb'] or 0:.0f} МБ, пинг {health['latency_ms']} мс, обновлено {age:.0f} с назад")
+
+
+def main():
+    if SHARD_COUNT < 1:
+        sys.exit("Укажите SHARD_COUNT (общее число шардов) в .env или окружении")
+
+    shards = [ShardProcess(group) for group in shard_groups()]
+    stopping = False
+
+    def handle_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGTERM, handle_stop)
+
+    for shard in shards:
+        shard.start()
+
+    next_report = time.monotonic() + HEALTH_REPORT_INTERVAL
+    while not stopping:
+        for shard in shards:
+            shard.check()
+        if time.monotonic() >= next_report:
+            report_health()
+            next_report = time.monotonic() + HEALTH_REPORT_INTERVAL
+        time.sleep(1)
+
+    print("Останавливаем процессы...")
+    for shard in shards:
+        shard.stop()
+    for shard in shards:
+        shard.wait(15)
+
+
+if __name__ == "__main__":
+    main()
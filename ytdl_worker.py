@@ -0,0 +1,42 @@
+"""Код, который выполняется внутри процессов-воркеров пула извлечения.
+
+Модуль специально ничего не знает про Discord: его импортирует каждый
+дочерний процесс, и он должен подниматься быстро.
+"""
+import json
+import yt_dlp
+
+# Прогретые экземпляры YoutubeDL: живут, пока жив процесс (ключ — настройки)
+ydl_instances = {}
+
+def get_ydl(options):
+    key = json.dumps(options, sort_keys=True)
+    ydl = ydl_instances.get(key)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(options)
+        ydl_instances[key] = ydl
+    return ydl
+
+def init_worker(preload):
+    """Вызывается один раз при старте процесса: заранее создаем YoutubeDL под частые настройки."""
+    for options in preload:
+        get_ydl(options)
+
+def extract(url, options):
+    """Достает информацию о ссылке. Возвращает обычный dict, который можно передать между процессами."""
+    ydl = get_ydl(options)
+    info = ydl.extract_info(url, download=False)
+    if info is None:
+        return None
+    return ydl.sanitize_info(info)
+
+def download(url, outtmpl, options):
+    """Скачивает аудио как есть, без перекодирования. Возвращает путь к файлу и длину трека."""
+    # outtmpl у каждой загрузки свой, поэтому тут отдельный экземпляр
+    with yt_dlp.YoutubeDL({**options, 'outtmpl': outtmpl}) as ydl:
+        info = ydl.extract_info(url, download=True)
+        if info is None:
+            return None
+        downloads = info.get('requested_downloads')
+        path = downloads[0]['filepath'] if downloads else ydl.prepare_filename(info)
+    return {'path': path, 'duration': info.get('duration') or 0, 'acodec': info.get('acodec')}